@@ -0,0 +1,316 @@
+"""
+Пакетная обработка PDF из командной строки (без GUI и PySide6)
+
+Сегментация и OCR тех же движков, что и в GUI (local_vlm, openrouter,
+datalab; batch или legacy режим), с сохранением annotation.json/document.md
+и необязательной загрузкой в R2.
+
+Примеры:
+    python -m app.cli doc.pdf -o out --backend openrouter
+    python -m app.cli a.pdf b.pdf -o out --segment --backend datalab --upload-r2 -j 2
+"""
+
+import argparse
+import logging
+import os
+import shutil
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Движок OCR CLI -> значение config['backend'] (как в OCRDialog)
+BACKENDS = {
+    "local_vlm": "local",
+    "openrouter": "openrouter",
+    "datalab": "datalab",
+}
+
+DEFAULT_VLM_MODEL = "qwen3-vl-32b-instruct"
+DEFAULT_OPENROUTER_MODEL = "qwen/qwen3-vl-30b-a3b-instruct"
+
+# Шаг логирования прогресса, %
+PROGRESS_STEP = 10
+
+
+def setup_logging(verbose: bool = False):
+    """Логирование в stderr (stdout остаётся для итоговых путей)"""
+    logging.basicConfig(
+        level=logging.DEBUG if verbose else logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S',
+        stream=sys.stderr,
+        force=True
+    )
+    logging.getLogger('PIL').setLevel(logging.INFO)
+
+
+def default_annotation_path(pdf_path: Path) -> Path:
+    """Разметка рядом с PDF (так же её сохраняет GUI)"""
+    return pdf_path.parent / f"{pdf_path.stem}_annotation.json"
+
+
+def create_empty_annotation(pdf_document):
+    """Пустой Document со страницами PDF (размеры в пикселях рендера)"""
+    from app.models import Document, Page
+
+    doc = Document(pdf_path=pdf_document.pdf_path)
+    for page_num in range(pdf_document.page_count):
+        dims = pdf_document.get_page_dimensions(page_num) or (595, 842)
+        doc.pages.append(Page(page_number=page_num, width=dims[0], height=dims[1]))
+    return doc
+
+
+def restore_previous_ocr(document, previous) -> int:
+    """
+    Перенести результаты прошлого прогона (ocr_text, ocr_fingerprint, image_file)
+    в блоки с теми же ID - инкрементальный OCR пропустит неизменённые блоки
+
+    Args:
+        document: текущая разметка
+        previous: разметка из out/<имя>/annotation.json прошлого прогона
+
+    Returns:
+        Число блоков с перенесённым результатом
+    """
+    previous_blocks = {b.id: b for p in previous.pages for b in p.blocks}
+    restored = 0
+    for page in document.pages:
+        for block in page.blocks:
+            old = previous_blocks.get(block.id)
+            if old is None or not old.ocr_fingerprint:
+                continue
+            block.ocr_text = old.ocr_text
+            block.ocr_fingerprint = old.ocr_fingerprint
+            block.image_file = old.image_file
+            restored += 1
+    return restored
+
+
+def create_prompt_loader():
+    """
+    Загрузчик промптов из R2 через локальный кеш (без R2 - сохранённые на диске)
+
+    Returns:
+        Функция имя промпта -> dict system/user
+    """
+    from app.prompt_cache import PromptCache
+
+    try:
+        from app.r2_storage import R2Storage
+        r2_storage = R2Storage()
+    except Exception as e:
+        logger.warning(f"R2 недоступен, используются сохранённые промпты: {e}")
+        r2_storage = None
+
+    cache = PromptCache(r2_storage, prefix="prompts")
+    cache.prefetch()
+    return cache.load_prompt
+
+
+def build_config(args, output_dir: Path) -> dict:
+    """Настройки прогона OCRPipeline из аргументов командной строки"""
+    backend = BACKENDS[args.backend]
+    return {
+        'output_dir': str(output_dir),
+        'crops_dir': str(output_dir / "crops"),
+        'backend': backend,
+        'vlm_server_url': "",
+        'vlm_model_name': args.vlm_model,
+        'text_model': args.text_model,
+        'table_model': args.table_model or args.text_model,
+        'image_model': args.image_model or args.text_model,
+        'prompt_loader': create_prompt_loader(),
+        'use_batch_ocr': args.mode == "batch",
+        'incremental_ocr': args.incremental,
+        'use_ocr_cache': args.ocr_cache,
+        'use_datalab': backend == "datalab",
+        'datalab_image_backend': args.image_backend,
+        'datalab_api_key': os.getenv('DATALAB_API_KEY', ''),
+        'upload_r2': args.upload_r2,
+    }
+
+
+def _progress_logger(name: str):
+    """Callback прогресса: строка в лог каждые PROGRESS_STEP процентов"""
+    last = [-PROGRESS_STEP]
+
+    def report(current: int, total: int):
+        percent = 100 * current // total if total else 100
+        if percent - last[0] >= PROGRESS_STEP or current == total:
+            last[0] = percent
+            logger.info(f"{name}: {current}/{total} ({percent}%)")
+
+    return report
+
+
+def process_document(pdf_path: str, annotation_path: Optional[str], args) -> str:
+    """
+    Обработать один PDF: разметка, сегментация (опционально), OCR
+
+    Args:
+        pdf_path: путь к PDF
+        annotation_path: JSON разметки (None - рядом с PDF или пустая разметка)
+        args: аргументы командной строки
+
+    Returns:
+        Папка с результатами
+    """
+    from app.annotation_io import AnnotationIO
+    from app.page_cache import get_page_cache
+    from app.pdf_utils import PDFDocument
+
+    pdf = Path(pdf_path)
+    output_dir = Path(args.output_dir) / (args.name or pdf.stem)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    (output_dir / "crops").mkdir(exist_ok=True)
+
+    pdf_document = PDFDocument(str(pdf))
+    if not pdf_document.open():
+        raise RuntimeError(f"Не удалось открыть PDF: {pdf}")
+
+    try:
+        page_images = get_page_cache().view(str(pdf))
+
+        # Результат прошлого прогона в той же папке (ocr_text и отпечатки блоков)
+        previous_path = output_dir / "annotation.json"
+        previous = AnnotationIO.load_annotation(str(previous_path)) if previous_path.exists() else None
+
+        annotation = Path(annotation_path) if annotation_path else default_annotation_path(pdf)
+        if annotation.exists():
+            document = AnnotationIO.load_annotation(str(annotation))
+            if document is None:
+                raise RuntimeError(f"Не удалось прочитать разметку: {annotation}")
+        elif annotation_path:
+            raise FileNotFoundError(f"Разметка не найдена: {annotation}")
+        elif previous is not None:
+            logger.info(f"{pdf.name}: разметка из прошлого прогона {previous_path}")
+            document, previous = previous, None
+        else:
+            logger.info(f"{pdf.name}: разметки нет, создана пустая")
+            document = create_empty_annotation(pdf_document)
+        document.pdf_path = str(pdf)
+
+        if args.segment:
+            from app.segmentation_api import segment_with_api
+            logger.info(f"{pdf.name}: сегментация")
+            pages = segment_with_api(str(pdf), document.pages, page_images, None, args.category)
+            if pages is not None:
+                document.pages = pages
+
+        if previous is not None and args.incremental:
+            restored = restore_previous_ocr(document, previous)
+            logger.info(f"{pdf.name}: результаты прошлого прогона у {restored} блоков")
+
+        blocks_count = sum(len(p.blocks) for p in document.pages)
+        logger.info(f"{pdf.name}: {len(document.pages)} страниц, {blocks_count} блоков")
+
+        shutil.copy2(pdf, output_dir / pdf.name)
+
+        if args.segment_only:
+            AnnotationIO.save_annotation(document, str(output_dir / "annotation.json"))
+            return str(output_dir)
+
+        from app.ocr_pipeline import OCRPipeline
+        pipeline = OCRPipeline(
+            document, pdf_document, page_images, build_config(args, output_dir),
+            progress_callback=_progress_logger(pdf.name)
+        )
+        pipeline.run()
+        return str(output_dir)
+    finally:
+        pdf_document.close()
+
+
+def _process_entry(entry):
+    """Обработка документа в отдельном процессе (-j)"""
+    pdf_path, annotation_path, args = entry
+    setup_logging(args.verbose)
+    return process_document(pdf_path, annotation_path, args)
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="python -m app.cli",
+        description="Сегментация и OCR PDF без GUI"
+    )
+    parser.add_argument("pdfs", nargs="+", help="PDF файлы")
+    parser.add_argument("-a", "--annotation", action="append", default=[],
+                        help="JSON разметки (по одному на PDF, в том же порядке; "
+                             "по умолчанию <имя>_annotation.json рядом с PDF, а без него - "
+                             "annotation.json прошлого прогона в папке результатов). "
+                             "Геометрия блоков берётся из этой разметки; результаты OCR "
+                             "и отпечатки - из <output-dir>/<имя>/annotation.json прошлого прогона")
+    parser.add_argument("-o", "--output-dir", required=True,
+                        help="папка результатов (для каждого PDF - подпапка по имени файла)")
+    parser.add_argument("--name", help="имя подпапки/проекта R2 (только для одного PDF)")
+    parser.add_argument("--backend", choices=sorted(BACKENDS), default="local_vlm", help="движок OCR")
+    parser.add_argument("--mode", choices=["batch", "legacy"], default="batch",
+                        help="batch - группы блоков в одном запросе, legacy - блок на запрос")
+    parser.add_argument("--vlm-model", default=DEFAULT_VLM_MODEL, help="модель локального VLM")
+    parser.add_argument("--text-model", default=DEFAULT_OPENROUTER_MODEL, help="модель OpenRouter для текста")
+    parser.add_argument("--table-model", help="модель OpenRouter для таблиц (по умолчанию --text-model)")
+    parser.add_argument("--image-model", help="модель OpenRouter для картинок (по умолчанию --text-model)")
+    parser.add_argument("--image-backend", choices=["local", "openrouter"], default="openrouter",
+                        help="движок IMAGE блоков в режиме datalab")
+    parser.add_argument("--segment", action="store_true", help="сегментация через API перед OCR")
+    parser.add_argument("--segment-only", action="store_true", help="только сегментация, без OCR")
+    parser.add_argument("--category", default="", help="категория блоков, созданных сегментацией")
+    parser.add_argument("--no-incremental", dest="incremental", action="store_false",
+                        help="распознавать все блоки, а не только изменённые "
+                             "с прошлого прогона в ту же папку результатов")
+    parser.add_argument("--no-ocr-cache", dest="ocr_cache", action="store_false",
+                        help="не использовать кеш результатов OCR")
+    parser.add_argument("--upload-r2", action="store_true", help="загрузить результаты в R2")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="документов параллельно (процессов)")
+    parser.add_argument("-v", "--verbose", action="store_true", help="отладочный лог")
+
+    args = parser.parse_args(argv)
+    if args.segment_only:
+        args.segment = True
+    if args.annotation and len(args.annotation) != len(args.pdfs):
+        parser.error("число --annotation должно совпадать с числом PDF")
+    if args.name and len(args.pdfs) > 1:
+        parser.error("--name допустим только для одного PDF")
+    if args.jobs < 1:
+        parser.error("--jobs должен быть не меньше 1")
+    return args
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    setup_logging(args.verbose)
+
+    from dotenv import load_dotenv
+    load_dotenv()
+
+    annotations = args.annotation or [None] * len(args.pdfs)
+    entries = [(pdf, annotation, args) for pdf, annotation in zip(args.pdfs, annotations)]
+
+    failed = 0
+    if args.jobs > 1 and len(entries) > 1:
+        with ProcessPoolExecutor(max_workers=min(args.jobs, len(entries))) as pool:
+            futures = [(entry[0], pool.submit(_process_entry, entry)) for entry in entries]
+            for pdf_path, future in futures:
+                try:
+                    print(future.result())
+                except Exception as e:
+                    failed += 1
+                    logger.error(f"{pdf_path}: {e}", exc_info=args.verbose)
+    else:
+        for pdf_path, annotation_path, _ in entries:
+            try:
+                print(process_document(pdf_path, annotation_path, args))
+            except Exception as e:
+                failed += 1
+                logger.error(f"{pdf_path}: {e}", exc_info=args.verbose)
+
+    if failed:
+        logger.error(f"Ошибок: {failed} из {len(entries)}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -4,13 +4,22 @@ Datalab OCR - распознавание текста/таблиц через Da
 """
 
 import logging
+import math
+import queue
+import re
+import threading
 import time
 import io
 import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from dataclasses import dataclass, field
 from pathlib import Path
-from typing import List, Tuple, Optional, Dict, Any
+from typing import Callable, Iterable, Iterator, List, Tuple, Optional, Dict, Any, Union
 from PIL import Image
 import requests
+import requests.adapters
+from app.image_encoding import EncodedImage, encode_within
 
 logger = logging.getLogger(__name__)
 
@@ -21,6 +30,35 @@ MAX_HEIGHT = 9000        # Максимальная высота батча
 MAX_BLOCK_HEIGHT = 9000  # Максимальная высота блока (разбивка)
 MAX_FILE_SIZE_MB = 200    # Лимит размера файла
 
+# Маркеры блоков в ленте (разбор результата по блокам)
+MARKER_HEIGHT = 80        # Полоса с маркером над блоком
+MARKER_FONT_SIZE = 40     # Размер шрифта маркера (без масштабирования)
+MARKER_MIN_WIDTH = 640    # Минимальная ширина колонки, чтобы маркер поместился
+
+
+@dataclass
+class _PollJob:
+    """Задача Datalab, ожидающая результата (для recognize_many)"""
+    check_url: str
+    queue_deadline: float            # предел ожидания в очереди Datalab
+    next_poll: float
+    interval: float
+    deadline: Optional[float] = None  # предел обработки (с момента выхода из очереди)
+
+
+# Конец входной последовательности recognize_stream
+_FEED_END = object()
+
+# Изображение для загрузки: путь к файлу или закодированное в памяти
+UploadImage = Union[str, EncodedImage]
+
+
+def _describe_upload(image: UploadImage) -> str:
+    """Изображение для лога"""
+    if isinstance(image, EncodedImage):
+        return f"{image.format} {image.size[0]}x{image.size[1]} ({len(image) / 1024:.0f} KB)"
+    return image
+
 
 class DatalabOCRClient:
     """Клиент для Datalab Marker API"""
@@ -30,18 +68,44 @@ class DatalabOCRClient:
     MAX_POLL_ATTEMPTS = 60 # 2 минуты максимум
     MAX_RETRIES = 3        # Максимум повторных попыток при таймауте
     
-    def __init__(self, api_key: str):
+    # Пакетный режим (recognize_many)
+    MAX_CONCURRENT_UPLOADS = 4  # Параллельных загрузок/опросов
+    MAX_POLL_INTERVAL = 10      # Потолок интервала опроса (секунд)
+    POLL_BACKOFF = 1.5          # Рост интервала, пока задача в обработке
+    MAX_RETRY_AFTER = 60        # Потолок паузы после 429/5xx при опросе (секунд)
+    
+    # Статусы задачи, ещё не взятой в обработку (время обработки не идёт)
+    QUEUED_STATUSES = ('queued', 'pending', 'waiting')
+    
+    def __init__(self, api_key: str, api_url: Optional[str] = None):
+        """
+        Args:
+            api_key: ключ API Datalab
+            api_url: адрес Marker API (по умолчанию DATALAB_API_URL или API_URL)
+        """
         if not api_key:
             raise ValueError("DATALAB_API_KEY не указан")
         self.api_key = api_key
+        self.api_url = api_url or os.getenv("DATALAB_API_URL") or self.API_URL
         self.headers = {"X-Api-Key": api_key}
+        # Одна сессия: keep-alive для загрузок и частых опросов статуса
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        # Загрузки и опросы идут в отдельных пулах потоков
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=self.MAX_CONCURRENT_UPLOADS * 2)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+    
+    def close(self):
+        """Закрыть пул соединений"""
+        self.session.close()
     
-    def recognize(self, image_path: str, block_prompt: str = None, progress_callback=None, max_retries: int = None) -> str:
+    def recognize(self, image: UploadImage, block_prompt: str = None, progress_callback=None, max_retries: int = None) -> str:
         """
         Отправить изображение на распознавание с автоматическим retry при таймауте.
         
         Args:
-            image_path: путь к изображению
+            image: путь к файлу или EncodedImage (загружается из памяти)
             block_prompt: промпт для коррекции блока (block_correction_prompt)
             progress_callback: функция обратного вызова (message, attempt, max_attempts)
             max_retries: максимум повторных попыток (по умолчанию MAX_RETRIES)
@@ -55,9 +119,9 @@ class DatalabOCRClient:
         for retry_num in range(retries):
             try:
                 if retry_num > 0:
-                    logger.info(f"Datalab OCR: повторная попытка {retry_num + 1}/{retries} для {image_path}")
+                    logger.info(f"Datalab OCR: повторная попытка {retry_num + 1}/{retries} для {_describe_upload(image)}")
                 
-                return self._do_recognize(image_path, block_prompt, progress_callback)
+                return self._do_recognize(image, block_prompt, progress_callback)
                 
             except Exception as e:
                 last_error = e
@@ -76,13 +140,269 @@ class DatalabOCRClient:
         # Все попытки исчерпаны
         raise last_error
     
-    def _do_recognize(self, image_path: str, block_prompt: str = None, progress_callback=None) -> str:
+    def recognize_many(
+        self,
+        images: List[UploadImage],
+        block_prompts=None,
+        progress_callback: Optional[Callable[[int, int], None]] = None,
+        is_cancelled: Optional[Callable[[], bool]] = None
+    ) -> List[Union[str, Exception]]:
+        """
+        Пакетное распознавание: все изображения загружаются сразу, затем
+        все request_check_url опрашиваются параллельно (см. recognize_stream).
+        
+        Args:
+            images: изображения (ленты) - пути к файлам или EncodedImage
+            block_prompts: промпт для всех изображений или список промптов
+            progress_callback: (завершено, всего)
+            is_cancelled: функция проверки отмены
+        
+        Returns:
+            Markdown или исключение для каждого изображения в порядке images
+        """
+        if isinstance(block_prompts, (list, tuple)):
+            prompts = list(block_prompts)
+        else:
+            prompts = [block_prompts] * len(images)
+        
+        results = self.recognize_stream(
+            zip(images, prompts),
+            progress_callback=progress_callback,
+            is_cancelled=is_cancelled,
+            max_pending=max(len(images), 1)
+        )
+        results += [None] * (len(images) - len(results))
+        return results
+    
+    def recognize_stream(
+        self,
+        items: Iterable[Tuple[UploadImage, Optional[str]]],
+        on_result: Optional[Callable[[int, Union[str, Exception]], None]] = None,
+        progress_callback: Optional[Callable[[int, int], None]] = None,
+        is_cancelled: Optional[Callable[[], bool]] = None,
+        max_pending: Optional[int] = None
+    ) -> List[Union[str, Exception]]:
+        """
+        Потоковое распознавание: изображение загружается, как только появилось
+        в items, результаты всех загруженных задач опрашиваются параллельно.
+        
+        items перебирается в фоновом потоке (там же можно рендерить и склеивать
+        ленты); между ним и загрузкой - очередь из max_pending элементов, поэтому
+        подготовка не уходит далеко вперёд отправки.
+        
+        Интервал опроса каждой задачи растёт (POLL_BACKOFF) от POLL_INTERVAL
+        до MAX_POLL_INTERVAL. Время обработки (POLL_INTERVAL * MAX_POLL_ATTEMPTS)
+        отсчитывается с момента, когда задача вышла из очереди Datalab; задача,
+        не завершившаяся за это время, отправляется повторно (до MAX_RETRIES).
+        Ожидание в очереди ограничено тем же временем, умноженным на число
+        волн задач в работе; по его истечении задача завершается ошибкой без
+        повторной отправки (она снова встала бы в ту же очередь и была бы
+        оплачена ещё раз). Ответы 429/5xx при опросе не считаются обработкой:
+        опрос откладывается (Retry-After).
+        
+        Args:
+            items: (путь к файлу или EncodedImage, промпт) - список или генератор
+            on_result: (индекс, markdown или исключение) - окончательный результат
+                элемента (изображение после этого можно освободить)
+            progress_callback: (завершено, получено элементов)
+            is_cancelled: функция проверки отмены
+            max_pending: размер очереди (по умолчанию MAX_CONCURRENT_UPLOADS * 2)
+        
+        Returns:
+            Markdown или исключение для каждого элемента в порядке items
+            (None - не обработан из-за отмены)
+        """
+        pending = queue.Queue(maxsize=max_pending or self.MAX_CONCURRENT_UPLOADS * 2)
+        stop = threading.Event()
+        feed_error: List[BaseException] = []
+        
+        def feed():
+            try:
+                for item in items:
+                    while not stop.is_set():
+                        try:
+                            pending.put(item, timeout=0.2)
+                            break
+                        except queue.Full:
+                            continue
+                    if stop.is_set():
+                        return
+            except BaseException as e:
+                feed_error.append(e)
+            finally:
+                pending.put(_FEED_END)
+        
+        feeder = threading.Thread(target=feed, name="datalab-feed", daemon=True)
+        feeder.start()
+        
+        images: List[Optional[UploadImage]] = []
+        prompts: List[Optional[str]] = []
+        results: List[Union[str, Exception, None]] = []
+        attempts: List[int] = []
+        uploads = {}  # future -> индекс
+        jobs: Dict[int, _PollJob] = {}
+        max_wait = self.POLL_INTERVAL * self.MAX_POLL_ATTEMPTS
+        feeding = True
+        done = 0
+        started = time.monotonic()
+        
+        def finish(i, outcome):
+            nonlocal done
+            results[i] = outcome
+            images[i] = None  # повторной отправки не будет - освобождаем байты ленты
+            done += 1
+            if on_result:
+                on_result(i, outcome)
+        
+        reported = None
+        
+        def report():
+            nonlocal reported
+            if progress_callback and reported != (done, len(images)):
+                reported = (done, len(images))
+                progress_callback(done, len(images))
+        
+        upload_pool = ThreadPoolExecutor(max_workers=self.MAX_CONCURRENT_UPLOADS, thread_name_prefix="datalab-upload")
+        poll_pool = ThreadPoolExecutor(max_workers=self.MAX_CONCURRENT_UPLOADS, thread_name_prefix="datalab-poll")
+        try:
+            while feeding or uploads or jobs:
+                if is_cancelled and is_cancelled():
+                    logger.info("Datalab: распознавание отменено")
+                    break
+                
+                # Новые элементы - сразу в загрузку
+                while feeding:
+                    try:
+                        item = pending.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is _FEED_END:
+                        feeding = False
+                        logger.info(f"Datalab: получено {len(images)} изображений")
+                        break
+                    images.append(item[0])
+                    prompts.append(item[1])
+                    results.append(None)
+                    attempts.append(1)
+                    i = len(images) - 1
+                    if i == 0:
+                        logger.info(f"Datalab: первая загрузка через {time.monotonic() - started:.2f} с")
+                    uploads[upload_pool.submit(self._try_submit, images[i], prompts[i])] = i
+                
+                # Завершённые загрузки становятся задачами опроса
+                for future in [f for f in uploads if f.done()]:
+                    i = uploads.pop(future)
+                    check_url, markdown, error = future.result()
+                    if check_url:
+                        now = time.monotonic()
+                        # Задачи в работе обрабатываются волнами - ожидание в очереди растёт с их числом
+                        waves = math.ceil((len(jobs) + 1) / self.MAX_CONCURRENT_UPLOADS)
+                        jobs[i] = _PollJob(check_url, now + max_wait * waves, now + self.POLL_INTERVAL, self.POLL_INTERVAL)
+                    else:
+                        finish(i, error if error is not None else markdown)
+                
+                now = time.monotonic()
+                due = [i for i, job in jobs.items() if job.next_poll <= now]
+                if not due:
+                    report()
+                    next_poll = min((job.next_poll for job in jobs.values()), default=now + self.POLL_INTERVAL)
+                    # Пока идут загрузки или подготовка - просыпаемся чаще
+                    wait = min(next_poll - now, 0.1) if (feeding or uploads) else next_poll - now
+                    time.sleep(max(wait, 0.01))
+                    continue
+                
+                statuses = poll_pool.map(lambda i: self._check_status(jobs[i].check_url), due)
+                for i, (status, payload) in zip(due, statuses):
+                    job = jobs[i]
+                    if status in ('complete', 'failed'):
+                        del jobs[i]
+                        if status == 'complete':
+                            finish(i, payload)
+                        else:
+                            logger.error(f"Datalab processing failed: {payload}")
+                            finish(i, Exception(f"Datalab failed: {payload}"))
+                        continue
+                    
+                    now = time.monotonic()
+                    if job.deadline is None and status not in self.QUEUED_STATUSES and status != 'retry':
+                        # Задача вышла из очереди - пошло время обработки
+                        job.deadline = now + max_wait
+                    
+                    if job.deadline is not None and now >= job.deadline:
+                        del jobs[i]
+                        # Повтор только если задача действительно обрабатывалась (не во время 429/5xx)
+                        if attempts[i] < self.MAX_RETRIES and status != 'retry':
+                            logger.warning(f"Datalab таймаут, повторная отправка {_describe_upload(images[i])} "
+                                           f"({attempts[i] + 1}/{self.MAX_RETRIES})")
+                            attempts[i] += 1
+                            uploads[upload_pool.submit(self._try_submit, images[i], prompts[i])] = i
+                        else:
+                            finish(i, Exception("Datalab: превышено время ожидания"))
+                    elif job.deadline is None and now >= job.queue_deadline:
+                        del jobs[i]
+                        finish(i, Exception("Datalab: превышено время ожидания в очереди"))
+                    elif status == 'retry':
+                        # 429/5xx/сеть: откладываем опрос (Retry-After, иначе backoff)
+                        job.interval = min(max(job.interval * self.POLL_BACKOFF, payload or 0), self.MAX_RETRY_AFTER)
+                        job.next_poll = now + job.interval
+                    else:
+                        # Ещё в обработке - опрашиваем реже
+                        job.interval = min(job.interval * self.POLL_BACKOFF, self.MAX_POLL_INTERVAL)
+                        job.next_poll = now + job.interval
+                report()
+        finally:
+            stop.set()
+            upload_pool.shutdown(wait=True, cancel_futures=True)
+            poll_pool.shutdown(wait=True)
+            # Освобождаем поток подготовки, если он ждёт места в очереди
+            while feeder.is_alive():
+                try:
+                    pending.get(timeout=0.2)
+                except queue.Empty:
+                    pass
+        
+        if feed_error and not (is_cancelled and is_cancelled()):
+            raise feed_error[0]
+        return results
+    
+    def _try_submit(self, image: UploadImage, block_prompt: str = None) -> Tuple[Optional[str], Optional[str], Optional[Exception]]:
+        """_submit без исключений: (check_url, markdown, ошибка)"""
+        try:
+            check_url, markdown = self._submit(image, block_prompt)
+            return check_url, markdown, None
+        except Exception as e:
+            logger.error(f"Datalab: ошибка отправки {_describe_upload(image)}: {e}")
+            return None, None, e
+    
+    def _do_recognize(self, image: UploadImage, block_prompt: str = None, progress_callback=None) -> str:
         """Внутренний метод распознавания (одна попытка)"""
-        logger.info(f"Datalab OCR: отправка {image_path}")
+        check_url, markdown = self._submit(image, block_prompt)
+        if check_url is None:
+            return markdown
+        
+        # Поллинг результата
+        return self._poll_result(check_url, progress_callback)
+    
+    def _submit(self, image: UploadImage, block_prompt: str = None) -> Tuple[Optional[str], Optional[str]]:
+        """
+        Загрузить изображение
+        
+        Returns:
+            (request_check_url, None) или (None, markdown) для синхронного ответа
+        """
+        logger.info(f"Datalab OCR: отправка {_describe_upload(image)}")
         
         # Отправка запроса
-        with open(image_path, 'rb') as f:
-            files = {'file': (os.path.basename(image_path), f, 'image/png')}
+        if isinstance(image, EncodedImage):
+            upload = nullcontext(image.data)
+            filename, mime = f"image{image.extension}", image.mime
+        else:
+            upload = open(image, 'rb')
+            filename = os.path.basename(image)
+            mime = 'image/jpeg' if image.lower().endswith(('.jpg', '.jpeg')) else 'image/png'
+        
+        with upload as content:
+            files = {'file': (filename, content, mime)}
             # Параметры оптимизированы для строительных чертежей
             # https://documentation.datalab.to/api-reference/marker
             data = {
@@ -98,9 +418,8 @@ class DatalabOCRClient:
             if block_prompt:
                 data['block_correction_prompt'] = block_prompt
             
-            response = requests.post(
-                self.API_URL,
-                headers=self.headers,
+            response = self.session.post(
+                self.api_url,
                 files=files,
                 data=data,
                 timeout=120
@@ -122,11 +441,47 @@ class DatalabOCRClient:
         if not request_check_url:
             # Синхронный ответ (маловероятно, но возможно)
             if 'markdown' in result:
-                return result['markdown']
+                return None, result['markdown']
             raise Exception("Нет request_check_url в ответе")
         
-        # Поллинг результата
-        return self._poll_result(request_check_url, progress_callback)
+        return request_check_url, None
+    
+    def _check_status(self, check_url: str) -> Tuple[str, Optional[str]]:
+        """
+        Один запрос статуса
+        
+        Returns:
+            ('complete', markdown), ('failed', ошибка), ('retry', Retry-After в секундах
+            или None) при 429/5xx/сетевой ошибке или (статус, None) пока в обработке
+        """
+        try:
+            response = self.session.get(check_url, timeout=30)
+        except requests.RequestException as e:
+            logger.warning(f"Poll request failed: {e}")
+            return 'retry', None
+        
+        if response.status_code == 429 or response.status_code >= 500:
+            logger.warning(f"Datalab poll: HTTP {response.status_code}, опрос отложен")
+            try:
+                return 'retry', float(response.headers.get('Retry-After', ''))
+            except ValueError:
+                return 'retry', None
+        if not 200 <= response.status_code < 300:
+            # 401/403/404 и т.п. не исправятся повторным опросом
+            return 'failed', f"HTTP {response.status_code}: {response.text[:200]}"
+        
+        try:
+            result = response.json()
+        except ValueError as e:
+            logger.warning(f"Poll response is not JSON: {e}")
+            return 'retry', None
+        
+        status = result.get('status', '')
+        if status == 'complete':
+            return status, result.get('markdown') or ''
+        if status == 'failed':
+            return status, result.get('error', 'Unknown error')
+        return status or 'pending', None
     
     def _poll_result(self, check_url: str, progress_callback=None) -> str:
         """Ожидание и получение результата"""
@@ -138,28 +493,18 @@ class DatalabOCRClient:
             if progress_callback:
                 progress_callback(f"Ожидание результата от Datalab... ({attempt + 1}/{self.MAX_POLL_ATTEMPTS})", attempt, self.MAX_POLL_ATTEMPTS)
             
-            try:
-                response = requests.get(check_url, headers=self.headers, timeout=30)
-                result = response.json()
-                
-                status = result.get('status', '')
-                
-                if status == 'complete':
-                    logger.info("Datalab: обработка завершена")
-                    markdown = result.get('markdown') or ''
-                    return markdown
-                
-                elif status == 'failed':
-                    error = result.get('error', 'Unknown error')
-                    logger.error(f"Datalab processing failed: {error}")
-                    raise Exception(f"Datalab failed: {error}")
-                
-                # Продолжаем ждать
-                logger.debug(f"Datalab status: {status}, attempt {attempt + 1}")
-                
-            except requests.RequestException as e:
-                logger.warning(f"Poll request failed: {e}")
-                # Продолжаем попытки
+            status, payload = self._check_status(check_url)
+            
+            if status == 'complete':
+                logger.info("Datalab: обработка завершена")
+                return payload
+            
+            elif status == 'failed':
+                logger.error(f"Datalab processing failed: {payload}")
+                raise Exception(f"Datalab failed: {payload}")
+            
+            # Продолжаем ждать
+            logger.debug(f"Datalab status: {status}, attempt {attempt + 1}")
         
         raise Exception("Datalab: превышено время ожидания")
 
@@ -187,7 +532,7 @@ def create_image_placeholder(block_id: str, width: int = TARGET_WIDTH, height: i
     Returns:
         PIL Image с текстом placeholder
     """
-    from PIL import ImageDraw, ImageFont
+    from PIL import ImageDraw
     
     # Используем короткий ID (первые 8 символов) для лучшего распознавания
     short_id = block_id.replace('-', '')[:8].upper()
@@ -205,17 +550,7 @@ def create_image_placeholder(block_id: str, width: int = TARGET_WIDTH, height: i
     # Текст placeholder - простой формат с разделителями
     placeholder_text = f"===IMGBLOCK_{short_id}==="
     
-    # Пытаемся использовать крупный шрифт
-    font = None
-    for font_name in ["arial.ttf", "Arial.ttf", "DejaVuSans.ttf", "FreeSans.ttf"]:
-        try:
-            font = ImageFont.truetype(font_name, 40)
-            break
-        except:
-            continue
-    
-    if font is None:
-        font = ImageFont.load_default()
+    font = _load_marker_font(MARKER_FONT_SIZE)
     
     # Центрируем текст
     bbox = draw.textbbox((0, 0), placeholder_text, font=font)
@@ -230,6 +565,18 @@ def create_image_placeholder(block_id: str, width: int = TARGET_WIDTH, height: i
     return img
 
 
+def _load_marker_font(size: int):
+    """Крупный шрифт для маркеров (или шрифт по умолчанию)"""
+    from PIL import ImageFont
+    
+    for font_name in ["arial.ttf", "Arial.ttf", "DejaVuSans.ttf", "FreeSans.ttf"]:
+        try:
+            return ImageFont.truetype(font_name, size)
+        except:
+            continue
+    return ImageFont.load_default()
+
+
 def get_short_id(block_id: str) -> str:
     """Получить короткий ID для placeholder"""
     return block_id.replace('-', '')[:8].upper()
@@ -241,6 +588,82 @@ def get_placeholder_marker(block_id: str) -> str:
     return f"===IMGBLOCK_{short_id}==="
 
 
+def get_block_marker(block_id: str) -> str:
+    """Текстовый маркер начала текстового блока в ленте"""
+    return f"===BLOCK_{get_short_id(block_id)}==="
+
+
+# Маркер блока в markdown Datalab. OCR может экранировать '_' и '=', обернуть
+# маркер в **...** или заголовок; совпадение включает оформление и пробелы
+# вокруг маркера, текст, слитый с ним в одну строку, остаётся. Открывающее
+# выделение берётся только после пробела/начала строки, чтобы не съесть
+# закрывающее ** соседнего текста.
+_BLOCK_MARKER_RE = re.compile(
+    r"(?:^[ \t]*#{1,6}[ \t]+|[ \t]*)"
+    r"(?:(?<!\S)(?P<em>\*\*|__|\*))?[ \t]*"
+    r"(?:\\?=)+[ \t]*BLOCK[ \t]*\\?_?[ \t]*(?P<id>[0-9A-Za-z]{8})[ \t]*(?:\\?=)*"
+    r"[ \t]*(?(em)(?P=em)?)[ \t]*",
+    re.MULTILINE
+)
+
+# Типичные ошибки OCR в шестнадцатеричном ID
+_SHORT_ID_FIXES = str.maketrans({"O": "0", "I": "1", "L": "1", "S": "5"})
+
+
+def _normalize_short_id(short_id: str) -> str:
+    return short_id.upper().translate(_SHORT_ID_FIXES)
+
+
+def split_markdown_by_markers(markdown: str, block_ids: List[str]) -> Tuple[str, Dict[str, str]]:
+    """
+    Разделить markdown ленты по маркерам блоков (get_block_marker)
+    
+    Args:
+        markdown: результат Datalab для одной ленты
+        block_ids: ID блоков, чьи маркеры есть в ленте
+    
+    Returns:
+        (текст до первого маркера, {block_id: текст блока}) - блоки,
+        маркер которых не распознан, в словарь не попадают
+    """
+    by_short_id = {_normalize_short_id(get_short_id(block_id)): block_id for block_id in block_ids}
+    leading: List[str] = []
+    sections: Dict[str, List[str]] = {}
+    current = leading
+    pos = 0
+    
+    for match in _BLOCK_MARKER_RE.finditer(markdown):
+        current.append(markdown[pos:match.start()])
+        pos = match.end()
+        block_id = by_short_id.get(_normalize_short_id(match.group('id')))
+        # Нераспознанный маркер: текст остаётся у предыдущего блока
+        if block_id is not None:
+            current = sections.setdefault(block_id, [])
+    current.append(markdown[pos:])
+    
+    return "".join(leading).strip(), {block_id: "".join(parts).strip() for block_id, parts in sections.items()}
+
+
+def strip_block_markers(markdown: str) -> str:
+    """
+    Удалить маркеры блоков из markdown
+
+    >>> strip_block_markers("**===BLOCK_1A2B3C4D===** Текст")
+    'Текст'
+    >>> strip_block_markers("до **===BLOCK_1A2B3C4D===** после")
+    'до после'
+    >>> strip_block_markers("**жирный** ===BLOCK_1A2B3C4D===\\nТекст")
+    '**жирный**\\nТекст'
+    """
+    def drop(match):
+        # Маркер посреди строки разделял слова - оставляем один пробел
+        at_line_start = match.start() == 0 or markdown[match.start() - 1] == "\n"
+        at_line_end = match.end() == len(markdown) or markdown[match.end()] == "\n"
+        return "" if at_line_start or at_line_end else " "
+    
+    return re.sub(r"\n{3,}", "\n\n", _BLOCK_MARKER_RE.sub(drop, markdown)).strip()
+
+
 def split_large_block(image: Image.Image, max_height: int = MAX_BLOCK_HEIGHT) -> List[Image.Image]:
     """
     Разделить большой блок на части по высоте
@@ -268,20 +691,381 @@ def split_large_block(image: Image.Image, max_height: int = MAX_BLOCK_HEIGHT) ->
     return parts
 
 
+# Режимы упаковки лент: 'stack' - блоки друг под другом на всю ширину,
+# 'shelf' - узкие блоки раскладываются в несколько колонок
+PACKING_MODES = ("stack", "shelf")
+DEFAULT_PACKING = "stack"
+
+
+def get_packing_mode() -> str:
+    """Режим упаковки лент из окружения (DATALAB_PACKING)"""
+    mode = os.getenv("DATALAB_PACKING", DEFAULT_PACKING).lower()
+    return mode if mode in PACKING_MODES else DEFAULT_PACKING
+
+
+@dataclass
+class StripRegion:
+    """Область ленты: (часть) масштабированного изображения блока и её место"""
+    index: int                      # индекс изображения в block_images
+    size: Tuple[int, int]           # размер изображения после масштабирования
+    src: Tuple[int, int, int, int]  # вырезаемая часть масштабированного изображения
+    dst: Tuple[int, int]            # левый верхний угол в ленте
+    marker_height: int = 0          # полоса маркера над областью (0 - без маркера)
+
+
+@dataclass
+class StripLayout:
+    """
+    План одной ленты
+    
+    regions идут в порядке чтения (сверху вниз, колонки слева направо),
+    по region.index восстанавливается соответствие областей блокам.
+    """
+    width: int
+    height: int
+    regions: List[StripRegion] = field(default_factory=list)
+    
+    def block_order(self) -> List[int]:
+        """Индексы изображений в порядке чтения (без повторов для частей)"""
+        order = []
+        for region in self.regions:
+            if not order or order[-1] != region.index:
+                order.append(region.index)
+        return order
+    
+    @property
+    def fill_ratio(self) -> float:
+        """Доля площади ленты, занятая блоками"""
+        used = sum((r.src[2] - r.src[0]) * (r.src[3] - r.src[1]) for r in self.regions)
+        return used / max(self.width * self.height, 1)
+
+
+def _is_narrow(size: Tuple[int, int], marker: int, padding: int, max_height: int, target_width: int) -> bool:
+    """Блок помещается в колонку полосы shelf (не шире половины ленты)"""
+    return size[0] <= (target_width - padding) // 2 and size[1] + marker <= max_height
+
+
+def plan_strips(
+    sizes: List[Tuple[int, int]],
+    padding: int = BLOCK_PADDING,
+    max_height: int = MAX_HEIGHT,
+    target_width: int = TARGET_WIDTH,
+    packing: str = "stack",
+    marker_flags: Optional[List[bool]] = None
+) -> List[StripLayout]:
+    """
+    Разложить блоки по лентам (только геометрия, без пикселей)
+    
+    - Широкие блоки масштабируются до target_width и идут друг под другом,
+      блоки выше MAX_BLOCK_HEIGHT делятся на части
+    - В режиме 'shelf' подряд идущие узкие блоки (не шире половины ленты)
+      раскладываются в полосу из нескольких колонок без масштабирования;
+      колонки заполняются сверху вниз, поэтому порядок чтения сохраняется
+    
+    Args:
+        sizes: размеры изображений блоков (width, height) в порядке документа
+        padding: отступ между блоками
+        max_height: максимальная высота ленты
+        target_width: ширина ленты
+        packing: 'stack' или 'shelf'
+        marker_flags: для каких изображений оставить над первой частью
+            полосу MARKER_HEIGHT под маркер блока (render_strip)
+    
+    Returns:
+        Планы лент в порядке документа
+    """
+    def marker_for(index: int) -> int:
+        return MARKER_HEIGHT if marker_flags and marker_flags[index] else 0
+    
+    strips: List[StripLayout] = []
+    current = StripLayout(target_width, 0)
+    
+    def close_strip():
+        nonlocal current
+        if current.regions:
+            strips.append(current)
+        current = StripLayout(target_width, 0)
+    
+    def place_full_width(index: int, size: Tuple[int, int], src: Tuple[int, int, int, int]):
+        marker = marker_for(index) if src[1] == 0 else 0
+        height = src[3] - src[1] + marker
+        needed = height + (padding if current.regions else 0)
+        if current.height + needed > max_height and current.regions:
+            close_strip()
+            needed = height
+        y = current.height + needed - height + marker
+        current.regions.append(StripRegion(index, size, src, (0, y), marker))
+        current.height += needed
+    
+    def is_narrow(index: int) -> bool:
+        return packing == "shelf" and _is_narrow(sizes[index], marker_for(index), padding, max_height, target_width)
+    
+    i = 0
+    while i < len(sizes):
+        width, height = sizes[i]
+        
+        if not is_narrow(i):
+            # Масштабируем до ширины ленты (как resize_to_width)
+            scaled = (target_width, int(height * (target_width / width)))
+            marker = marker_for(i)
+            if scaled[1] + marker > MAX_BLOCK_HEIGHT:
+                # Большой блок начинает новую ленту и делится на части
+                # (первая часть короче на полосу маркера)
+                close_strip()
+                y = 0
+                while y < scaled[1]:
+                    y_end = min(y + MAX_BLOCK_HEIGHT - (marker if y == 0 else 0), scaled[1])
+                    place_full_width(i, scaled, (0, y, target_width, y_end))
+                    y = y_end
+            else:
+                place_full_width(i, scaled, (0, 0) + scaled)
+            i += 1
+            continue
+        
+        # Серия подряд идущих узких блоков (высота - вместе с полосой маркера)
+        run = []
+        while i < len(sizes) and is_narrow(i):
+            run.append((i, (sizes[i][0], sizes[i][1] + marker_for(i))))
+            i += 1
+        
+        widest = max(size[0] for _, size in run)
+        if marker_flags:
+            widest = max(widest, MARKER_MIN_WIDTH)
+        columns = max(2, (target_width + padding) // (widest + padding))
+        column_width = (target_width - padding * (columns - 1)) // columns
+        
+        while run:
+            top = current.height + (padding if current.regions else 0)
+            available = max_height - top
+            if available < run[0][1][1]:
+                close_strip()
+                continue
+            
+            # Высота полосы: колонки примерно поровну, но не выше остатка ленты
+            run_height = sum(size[1] for _, size in run) + padding * (len(run) - 1)
+            tallest = max(size[1] for _, size in run)
+            band_limit = min(available, max(tallest, -(-run_height // columns)))
+            
+            column, column_y, band_height, placed = 0, 0, 0, 0
+            for index, size in run:
+                needed = size[1] + (padding if column_y else 0)
+                if column_y + needed > band_limit:
+                    column += 1
+                    column_y, needed = 0, size[1]
+                    if column >= columns or size[1] > band_limit:
+                        break
+                x = column * (column_width + padding)
+                y = top + column_y + needed - size[1]
+                marker = marker_for(index)
+                image_size = sizes[index]
+                current.regions.append(StripRegion(index, image_size, (0, 0) + image_size, (x, y + marker), marker))
+                column_y += needed
+                band_height = max(band_height, column_y)
+                placed += 1
+            
+            run = run[placed:]
+            current.height = top + band_height
+    
+    close_strip()
+    return strips
+
+
+def render_strip(
+    block_images: List[Image.Image],
+    layout: StripLayout,
+    marker_ids: Optional[List[Optional[str]]] = None
+) -> Image.Image:
+    """
+    Собрать изображение ленты по плану
+    
+    Args:
+        block_images: изображения блоков
+        layout: план ленты (plan_strips)
+        marker_ids: ID блока для маркера над изображением (get_block_marker)
+    """
+    canvas = Image.new('RGB', (layout.width, layout.height), (255, 255, 255))
+    draw, font = None, None
+    
+    scaled_index, scaled = None, None
+    for region in layout.regions:
+        # Части одного блока идут подряд - масштабируем один раз
+        if region.index != scaled_index:
+            img = block_images[region.index]
+            if img.size != region.size:
+                img = img.resize(region.size, Image.LANCZOS)
+            # Конвертируем в RGB если нужно
+            if img.mode != 'RGB':
+                img = img.convert('RGB')
+            scaled_index, scaled = region.index, img
+        
+        part = scaled if region.src == (0, 0) + region.size else scaled.crop(region.src)
+        canvas.paste(part, region.dst)
+        
+        if region.marker_height and marker_ids and marker_ids[region.index]:
+            if draw is None:
+                from PIL import ImageDraw
+                draw, font = ImageDraw.Draw(canvas), _load_marker_font(MARKER_FONT_SIZE)
+            x, y = region.dst
+            draw.text((x, y - region.marker_height + (region.marker_height - MARKER_FONT_SIZE) // 2),
+                      get_block_marker(marker_ids[region.index]), fill=(0, 0, 0), font=font)
+    
+    return canvas
+
+
+def pack_blocks(
+    block_images: List[Image.Image],
+    padding: int = BLOCK_PADDING,
+    max_height: int = MAX_HEIGHT,
+    target_width: int = TARGET_WIDTH,
+    packing: Optional[str] = None,
+    marker_ids: Optional[List[Optional[str]]] = None
+) -> Iterator[Tuple[Image.Image, StripLayout]]:
+    """
+    Ленты вместе с планами (для сопоставления областей ленты с блоками)
+    
+    Args:
+        marker_ids: ID блока для каждого изображения или None (продолжение
+            предыдущего блока) - над изображением рисуется маркер блока,
+            по которому результат разбирается обратно (demux_strip_results)
+    
+    Yields:
+        (изображение ленты, StripLayout) - ленты собираются по одной
+    """
+    marker_flags = [m is not None for m in marker_ids] if marker_ids else None
+    layouts = plan_strips(
+        [img.size for img in block_images], padding, max_height, target_width,
+        packing or get_packing_mode(), marker_flags
+    )
+    for layout in layouts:
+        yield render_strip(block_images, layout, marker_ids), layout
+
+
+class StripPacker:
+    """
+    Потоковая склейка лент: изображения добавляются по одному, готовые ленты
+    отдаются сразу. В памяти держатся только изображения незакрытых лент.
+    
+    Лента закрыта, если все её блоки раньше последнего изображения (а в режиме
+    'shelf' - раньше начала текущей серии узких блоков, раскладка которой ещё
+    может измениться). Длинная серия не держится в памяти дольше MAX_OPEN_STRIPS
+    лент - она закрывается по частям. Индексы в StripLayout - сквозные с начала потока.
+    
+    Использование:
+        packer = StripPacker(packing='shelf')
+        for crop, block_id in crops:
+            for strip, layout in packer.add(crop, block_id):
+                send(strip)
+        for strip, layout in packer.flush():
+            send(strip)
+    """
+    
+    MAX_OPEN_STRIPS = 2
+    
+    def __init__(
+        self,
+        padding: int = BLOCK_PADDING,
+        max_height: int = MAX_HEIGHT,
+        target_width: int = TARGET_WIDTH,
+        packing: Optional[str] = None
+    ):
+        self.padding = padding
+        self.max_height = max_height
+        self.target_width = target_width
+        self.packing = packing or get_packing_mode()
+        self._images: List[Image.Image] = []
+        self._marker_ids: List[Optional[str]] = []
+        self._offset = 0  # сквозной индекс self._images[0]
+    
+    def add(self, image: Image.Image, marker_id: Optional[str] = None) -> List[Tuple[Image.Image, StripLayout]]:
+        """
+        Добавить изображение блока
+        
+        Args:
+            image: кроп блока (части)
+            marker_id: ID блока для маркера (None - без маркера / продолжение блока)
+        
+        Returns:
+            Закрывшиеся ленты [(изображение, StripLayout)]
+        """
+        self._images.append(image)
+        self._marker_ids.append(marker_id)
+        return self._emit(final=False)
+    
+    def flush(self) -> List[Tuple[Image.Image, StripLayout]]:
+        """Отдать оставшиеся ленты"""
+        return self._emit(final=True)
+    
+    def _open_from(self) -> int:
+        """Индекс (в буфере), начиная с которого раскладка ещё может измениться"""
+        index = len(self._images) - 1
+        if self.packing == "shelf" and self._narrow(index):
+            while index > 0 and self._narrow(index - 1):
+                index -= 1
+        return index
+    
+    def _narrow(self, index: int) -> bool:
+        return _is_narrow(self._images[index].size, self._marker(index),
+                          self.padding, self.max_height, self.target_width)
+    
+    def _marker(self, index: int) -> int:
+        return MARKER_HEIGHT if self._marker_ids[index] is not None else 0
+    
+    def _emit(self, final: bool) -> List[Tuple[Image.Image, StripLayout]]:
+        if not self._images:
+            return []
+        
+        marker_flags = [m is not None for m in self._marker_ids]
+        layouts = plan_strips(
+            [img.size for img in self._images], self.padding, self.max_height, self.target_width,
+            self.packing, marker_flags if any(marker_flags) else None
+        )
+        
+        if final:
+            ready = len(layouts)
+        else:
+            open_from = self._open_from()
+            if len(layouts) > self.MAX_OPEN_STRIPS + 1:
+                # Серия узких блоков слишком длинная - закрываем её начало
+                open_from = len(self._images) - 1
+            ready = 0
+            while ready < len(layouts) - 1 and max(r.index for r in layouts[ready].regions) < open_from:
+                ready += 1
+            # Лента, продолжающая части блока из готовой, должна начинаться с нового блока
+            while ready and layouts[ready].regions[0].index == layouts[ready - 1].regions[-1].index:
+                ready -= 1
+        if not ready:
+            return []
+        
+        strips = []
+        for layout in layouts[:ready]:
+            image = render_strip(self._images, layout, self._marker_ids)
+            for region in layout.regions:
+                region.index += self._offset
+            strips.append((image, layout))
+        
+        consumed = layouts[ready].regions[0].index if ready < len(layouts) else len(self._images)
+        del self._images[:consumed]
+        del self._marker_ids[:consumed]
+        self._offset += consumed
+        return strips
+
+
 def concatenate_blocks(
     block_images: List[Image.Image],
     padding: int = BLOCK_PADDING,
     max_height: int = MAX_HEIGHT,
-    target_width: int = TARGET_WIDTH
+    target_width: int = TARGET_WIDTH,
+    packing: Optional[str] = None
 ) -> List[Image.Image]:
     """
-    Склеить блоки в вертикальные ленты
+    Склеить блоки в ленты
     
     Args:
         block_images: список PIL изображений блоков
         padding: отступ между блоками
         max_height: максимальная высота одного батча
         target_width: целевая ширина
+        packing: 'stack' или 'shelf' (None - из DATALAB_PACKING), см. plan_strips
     
     Returns:
         Список склеенных изображений (батчей)
@@ -289,116 +1073,112 @@ def concatenate_blocks(
     if not block_images:
         return []
     
-    batches = []
-    current_batch = []
-    current_height = 0
-    
-    for img in block_images:
-        # Сначала ресайзим до целевой ширины
-        resized_img = resize_to_width(img, target_width)
-        
-        # Если блок после ресайза больше MAX_BLOCK_HEIGHT - делим на части
-        if resized_img.height > MAX_BLOCK_HEIGHT:
-            # Сохраняем накопленный батч перед обработкой большого блока
-            if current_batch:
-                batches.append(_create_batch_image(current_batch, padding, target_width))
-                current_batch = []
-                current_height = 0
-            
-            # Делим большой блок на части
-            parts = split_large_block(resized_img, MAX_BLOCK_HEIGHT)
-            logger.info(f"Большой блок {resized_img.width}x{resized_img.height} разделён на {len(parts)} частей после ресайза")
-            
-            # Каждую часть добавляем в батчи
-            for part in parts:
-                needed_height = part.height + (padding if current_batch else 0)
-                
-                if current_height + needed_height > max_height and current_batch:
-                    batches.append(_create_batch_image(current_batch, padding, target_width))
-                    current_batch = [part]
-                    current_height = part.height
-                else:
-                    current_batch.append(part)
-                    current_height += needed_height
-        else:
-            # Обычный блок - добавляем в текущий батч
-            needed_height = resized_img.height + (padding if current_batch else 0)
-            
-            if current_height + needed_height > max_height and current_batch:
-                # Сохраняем текущий батч, начинаем новый
-                batches.append(_create_batch_image(current_batch, padding, target_width))
-                current_batch = [resized_img]
-                current_height = resized_img.height
-            else:
-                current_batch.append(resized_img)
-                current_height += needed_height
-    
-    # Последний батч
-    if current_batch:
-        batches.append(_create_batch_image(current_batch, padding, target_width))
+    return [image for image, _ in pack_blocks(block_images, padding, max_height, target_width, packing)]
+
+
+def packing_report(
+    sizes: List[Tuple[int, int]],
+    padding: int = BLOCK_PADDING,
+    max_height: int = MAX_HEIGHT,
+    target_width: int = TARGET_WIDTH,
+    marker_flags: Optional[List[bool]] = None
+) -> dict:
+    """
+    Сравнение режимов упаковки для набора блоков (без рендеринга)
     
-    return batches
+    Returns:
+        {'blocks', 'stack_strips', 'shelf_strips', 'stack_fill', 'shelf_fill'} (fill - средняя доля, %)
+    """
+    report = {"blocks": len(sizes)}
+    for mode in PACKING_MODES:
+        layouts = plan_strips(sizes, padding, max_height, target_width, mode, marker_flags)
+        area = sum(l.width * l.height for l in layouts)
+        used = sum(l.fill_ratio * l.width * l.height for l in layouts)
+        report[f"{mode}_strips"] = len(layouts)
+        report[f"{mode}_fill"] = round(used / area * 100, 1) if area else 0.0
+    return report
 
 
-def _create_batch_image(images: List[Image.Image], padding: int, width: int) -> Image.Image:
-    """Создать одно изображение из списка блоков"""
-    total_height = sum(img.height for img in images) + padding * (len(images) - 1)
+def demux_strip_results(
+    strip_results: List[Optional[str]],
+    layouts: List[StripLayout],
+    marker_ids: List[Optional[str]]
+) -> Dict[int, str]:
+    """
+    Разобрать результаты лент по блокам
     
-    # Белый холст
-    canvas = Image.new('RGB', (width, total_height), (255, 255, 255))
+    Текст до первого маркера ленты относится к блоку, продолжение которого
+    открывает ленту (части высокого блока попадают в разные ленты).
     
-    y_offset = 0
-    for img in images:
-        # Конвертируем в RGB если нужно
-        if img.mode != 'RGB':
-            img = img.convert('RGB')
-        canvas.paste(img, (0, y_offset))
-        y_offset += img.height + padding
+    Args:
+        strip_results: markdown каждой ленты (None - лента не распознана)
+        layouts: планы лент (pack_blocks)
+        marker_ids: ID блока для каждого изображения или None (продолжение)
     
-    return canvas
+    Returns:
+        {индекс изображения с маркером: текст блока} - только для блоков,
+        текст которых удалось выделить целиком
+    """
+    owners: List[Optional[int]] = []
+    owner = None
+    for index, block_id in enumerate(marker_ids):
+        if block_id is not None:
+            owner = index
+        owners.append(owner)
+    
+    texts: Dict[int, List[str]] = {}
+    broken = set()  # блоки, часть которых в нераспознанной ленте
+    for markdown, layout in zip(strip_results, layouts):
+        order = layout.block_order()
+        if not markdown or not order:
+            broken.update(owners[i] for i in order)
+            continue
+        index_by_id = {marker_ids[i]: i for i in order if marker_ids[i] is not None}
+        leading, sections = split_markdown_by_markers(markdown, list(index_by_id))
+        
+        first_owner = owners[order[0]]
+        if leading and first_owner is not None:
+            texts.setdefault(first_owner, []).append(leading)
+        for block_id, text in sections.items():
+            texts.setdefault(index_by_id[block_id], []).append(text)
+    
+    return {index: "\n\n".join(p for p in parts if p)
+            for index, parts in texts.items() if index not in broken}
+
+
+def encode_for_upload(image: Image.Image, max_size_mb: int = MAX_FILE_SIZE_MB) -> EncodedImage:
+    """
+    Закодировать ленту для загрузки в Datalab (в памяти, без временных файлов)
+    
+    Returns:
+        EncodedImage не больше max_size_mb (см. app.image_encoding.encode_within)
+    """
+    return encode_within(image, max_size_mb * 1024 * 1024)
 
 
 def save_optimized_image(image: Image.Image, output_path: str, max_size_mb: int = MAX_FILE_SIZE_MB) -> str:
     """
     Сохранить изображение с оптимизацией размера
     
+    Кодирование выполняется в памяти (encode_within), на диск файл пишется
+    один раз: PNG в наименьшем режиме, а если он больше лимита - JPEG
+    (расширение .jpg).
+    
     Returns:
         Путь к сохраненному файлу
     """
-    path = Path(output_path)
-    
-    # Сначала пробуем PNG
-    image.save(output_path, format='PNG', optimize=True)
-    
-    size_mb = os.path.getsize(output_path) / (1024 * 1024)
-    
-    if size_mb > max_size_mb:
-        # Переключаемся на JPEG с понижением качества
-        jpeg_path = path.with_suffix('.jpg')
-        quality = 95
-        
-        while quality >= 60:
-            image.save(str(jpeg_path), format='JPEG', quality=quality, optimize=True)
-            size_mb = os.path.getsize(str(jpeg_path)) / (1024 * 1024)
-            
-            if size_mb <= max_size_mb:
-                # Удаляем PNG если был создан
-                if path.exists() and path.suffix == '.png':
-                    path.unlink()
-                return str(jpeg_path)
-            
-            quality -= 10
-        
-        raise ValueError(f"Не удалось уменьшить файл до {max_size_mb}MB")
-    
-    return output_path
+    encoded = encode_within(image, max_size_mb * 1024 * 1024, record=False)
+    path = Path(output_path).with_suffix(encoded.extension)
+    path.write_bytes(encoded.data)
+    return str(path)
 
 
 def process_blocks_with_datalab(
     block_images: List[Image.Image],
     api_key: str,
-    temp_dir: str,
-    progress_callback=None
+    temp_dir: Optional[str] = None,
+    progress_callback=None,
+    result_cache=None
 ) -> List[str]:
     """
     Обработать блоки через Datalab API с оптимизацией
@@ -406,69 +1186,98 @@ def process_blocks_with_datalab(
     Args:
         block_images: список PIL изображений блоков
         api_key: ключ API Datalab
-        temp_dir: директория для временных файлов
+        temp_dir: не используется (ленты загружаются из памяти), оставлен для совместимости
         progress_callback: функция обратного вызова (current, total, message)
+        result_cache: OCRResultCache - ленты, распознанные ранее, не отправляются в API
     
     Returns:
         Список markdown строк для каждого батча
     """
+    results, _ = _recognize_strips(block_images, api_key, progress_callback, result_cache)
+    return results
+
+
+def _recognize_strips(
+    block_images: List[Image.Image],
+    api_key: str,
+    progress_callback=None,
+    result_cache=None,
+    marker_ids: Optional[List[Optional[str]]] = None
+) -> Tuple[List[str], List[StripLayout]]:
+    """
+    Склеить блоки в ленты и распознать их (см. process_blocks_with_datalab)
+    
+    Returns:
+        (markdown каждой ленты, планы лент)
+    """
     if not block_images:
-        return []
+        return [], []
     
     client = DatalabOCRClient(api_key)
-    temp_path = Path(temp_dir)
-    temp_path.mkdir(parents=True, exist_ok=True)
     
     # Склеиваем блоки в батчи
     if progress_callback:
         progress_callback(0, 100, "Склейка блоков...")
     
-    batches = concatenate_blocks(block_images)
+    packing = get_packing_mode()
+    marker_flags = [m is not None for m in marker_ids] if marker_ids else None
+    report = packing_report([img.size for img in block_images], marker_flags=marker_flags)
+    batches, layouts = [], []
+    for batch_image, layout in pack_blocks(block_images, packing=packing, marker_ids=marker_ids):
+        batches.append(batch_image)
+        layouts.append(layout)
     total_batches = len(batches)
     
-    logger.info(f"Datalab: {len(block_images)} блоков → {total_batches} батчей")
+    logger.info(f"Datalab: {len(block_images)} блоков → {total_batches} батчей "
+                f"(упаковка {packing}; stack: {report['stack_strips']} лент, {report['stack_fill']}% заполнения, "
+                f"shelf: {report['shelf_strips']} лент, {report['shelf_fill']}%)")
     
-    results = []
+    results: List[Optional[str]] = [None] * total_batches
+    cache_keys = {}
+    to_send = []  # (индекс батча, EncodedImage)
     
     for i, batch_image in enumerate(batches):
-        if progress_callback:
-            progress_callback(
-                int((i / total_batches) * 100),
-                100,
-                f"Обработка батча {i + 1}/{total_batches}..."
-            )
+        if result_cache is not None:
+            cache_keys[i] = result_cache.make_key(batch_image, None, DatalabOCRBackend.CACHE_IDENTITY)
+            cached = result_cache.get(cache_keys[i])
+            if cached is not None:
+                results[i] = cached
+                continue
         
-        # Сохраняем батч
-        batch_path = temp_path / f"batch_{i}.png"
-        saved_path = save_optimized_image(batch_image, str(batch_path))
-        
-        try:
-            # Отправляем на распознавание
-            markdown = client.recognize(saved_path)
-            results.append(markdown)
-            
-        except Exception as e:
-            logger.error(f"Ошибка обработки батча {i}: {e}")
-            results.append(f"[Ошибка распознавания батча {i + 1}: {e}]")
-        
-        finally:
-            # Удаляем временный файл
-            for p in [batch_path, batch_path.with_suffix('.jpg')]:
-                if p.exists():
-                    p.unlink()
+        # Кодируем батч в памяти
+        to_send.append((i, encode_for_upload(batch_image)))
+    
+    def on_progress(done, total):
+        if progress_callback:
+            progress_callback(int(done / max(total, 1) * 100), 100, f"Распознано батчей: {done}/{total}")
+    
+    try:
+        # Все батчи отправляются сразу, результаты опрашиваются параллельно
+        outcomes = client.recognize_many([encoded for _, encoded in to_send], progress_callback=on_progress)
+        for (i, _), outcome in zip(to_send, outcomes):
+            if isinstance(outcome, Exception) or outcome is None:
+                logger.error(f"Ошибка обработки батча {i}: {outcome}")
+                results[i] = f"[Ошибка распознавания батча {i + 1}: {outcome}]"
+                continue
+            results[i] = outcome
+            if i in cache_keys:
+                result_cache.put(cache_keys[i], outcome)
+    finally:
+        client.close()
     
     if progress_callback:
         progress_callback(100, 100, "Готово")
     
-    return results
+    return results, layouts
 
 
 def run_datalab_ocr_for_blocks(
     blocks,
     page_images: Dict[int, Image.Image],
     api_key: str,
-    temp_dir: str,
-    progress_callback=None
+    temp_dir: Optional[str] = None,
+    progress_callback=None,
+    result_cache=None
 ) -> str:
     """
     Запустить Datalab OCR для списка блоков
@@ -477,23 +1286,26 @@ def run_datalab_ocr_for_blocks(
         blocks: список Block объектов
         page_images: словарь {page_num: PIL.Image}
         api_key: ключ API Datalab
-        temp_dir: временная директория
+        temp_dir: не используется (ленты загружаются из памяти), оставлен для совместимости
         progress_callback: callback прогресса
+        result_cache: OCRResultCache (опционально)
     
     Returns:
-        Объединенный markdown результат
+        Объединенный markdown результат; текст каждого распознанного блока
+        также записывается в block.ocr_text
     """
     # Извлекаем изображения блоков
     block_images = []
     block_info = []  # Для сопоставления результатов
+    marker_ids = []  # Маркер над первой частью каждого блока
     
     for block in blocks:
         page_num = block.page_number if hasattr(block, 'page_number') else 0
         
-        if page_num not in page_images:
+        page_img = page_images.get(page_num)
+        if page_img is None:
             continue
         
-        page_img = page_images[page_num]
         x1, y1, x2, y2 = block.coords_px
         
         if x1 >= x2 or y1 >= y2:
@@ -509,53 +1321,70 @@ def run_datalab_ocr_for_blocks(
                 crop = page_img.crop((x1, y_start, x2, y_end))
                 block_images.append(crop)
                 block_info.append(block)
+                marker_ids.append(block.id if y_start == y1 else None)
                 y_start = y_end
         else:
             crop = page_img.crop((x1, y1, x2, y2))
             block_images.append(crop)
             block_info.append(block)
+            marker_ids.append(block.id)
     
     if not block_images:
         return ""
     
     # Обрабатываем через Datalab
-    results = process_blocks_with_datalab(
+    results, layouts = _recognize_strips(
         block_images,
         api_key,
-        temp_dir,
-        progress_callback
+        progress_callback,
+        result_cache=result_cache,
+        marker_ids=marker_ids
     )
     
+    # Разбираем ленты по блокам
+    from app.models import is_cacheable
+    block_texts = demux_strip_results(
+        [r if is_cacheable(r) else None for r in results], layouts, marker_ids
+    )
+    for index, text in block_texts.items():
+        block_info[index].ocr_text = text
+    logger.info(f"Datalab: текст выделен для {len(block_texts)}/{sum(1 for m in marker_ids if m)} блоков")
+    
     # Объединяем результаты
-    return "\n\n---\n\n".join(results)
+    return "\n\n---\n\n".join(strip_block_markers(r) for r in results)
 
 
 class DatalabOCRBackend:
     """Backend для интеграции с существующей системой OCR"""
     
-    def __init__(self, api_key: str):
+    # Идентификатор для ключа кеша результатов (параметры Marker фиксированы в клиенте)
+    CACHE_IDENTITY = "DatalabMarker:accurate+llm"
+    
+    def __init__(self, api_key: str, result_cache=None):
+        """
+        Args:
+            api_key: ключ API Datalab
+            result_cache: OCRResultCache - изображения, распознанные ранее, не отправляются в API
+        """
         self.client = DatalabOCRClient(api_key)
-        self._temp_counter = 0
+        self.result_cache = result_cache
     
     def recognize(self, image: Image.Image, prompt: Optional[dict] = None) -> str:
         """
         Распознать одиночное изображение через Datalab
         Примечание: неэффективно для одиночных блоков, лучше использовать batch
         """
-        import tempfile
-        
-        self._temp_counter += 1
-        temp_path = Path(tempfile.gettempdir()) / f"datalab_single_{self._temp_counter}.png"
+        if self.result_cache is None:
+            return self._recognize(image)
         
-        try:
-            # Ресайзим если нужно
-            resized = resize_to_width(image, TARGET_WIDTH)
-            saved_path = save_optimized_image(resized, str(temp_path))
-            
-            return self.client.recognize(saved_path)
-            
-        finally:
-            for p in [temp_path, temp_path.with_suffix('.jpg')]:
-                if p.exists():
-                    p.unlink()
-
+        key = self.result_cache.make_key(image, None, self.CACHE_IDENTITY)
+        text = self.result_cache.get(key)
+        if text is None:
+            text = self._recognize(image)
+            self.result_cache.put(key, text)
+        return text
+    
+    def _recognize(self, image: Image.Image) -> str:
+        # Ресайзим если нужно, кодируем в памяти
+        resized = resize_to_width(image, TARGET_WIDTH)
+        return self.client.recognize(encode_for_upload(resized))
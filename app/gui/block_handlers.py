@@ -20,8 +20,8 @@ class BlockHandlersMixin:
             new_page_num = len(self.annotation_document.pages)
             
             # Приоритет: реальное изображение > get_page_dimensions > fallback
-            if new_page_num in self.page_images:
-                img = self.page_images[new_page_num]
+            img = self.page_images.get(new_page_num)
+            if img is not None:
                 page = Page(page_number=new_page_num, width=img.width, height=img.height)
             elif self.pdf_document:
                 dims = self.pdf_document.get_page_dimensions(new_page_num)
@@ -7,6 +7,7 @@ from pathlib import Path
 from PySide6.QtWidgets import QFileDialog, QMessageBox, QInputDialog
 from app.models import Document, Page
 from app.pdf_utils import PDFDocument
+from app.page_cache import get_page_cache
 from app.annotation_io import AnnotationIO
 
 logger = logging.getLogger(__name__)
@@ -20,8 +21,8 @@ class FileOperationsMixin:
         doc = Document(pdf_path=pdf_path)
         for page_num in range(self.pdf_document.page_count):
             # Приоритет: реальное изображение > get_page_dimensions
-            if page_num in self.page_images:
-                img = self.page_images[page_num]
+            img = self.page_images.get(page_num)
+            if img is not None:
                 page = Page(page_number=page_num, width=img.width, height=img.height)
             else:
                 dims = self.pdf_document.get_page_dimensions(page_num)
@@ -75,13 +76,15 @@ class FileOperationsMixin:
         if self.pdf_document:
             self.pdf_document.close()
         
-        self.page_images.clear()
-        
         self.pdf_document = PDFDocument(project_file.pdf_path)
         if not self.pdf_document.open():
+            self.page_images = get_page_cache().view(None)
             QMessageBox.critical(self, "Ошибка", "Не удалось открыть PDF")
             return
         
+        # Страницы документа берутся из общего кеша (переживают переключение файлов)
+        self.page_images = get_page_cache().view(project_file.pdf_path)
+        
         self._current_project_id = project_id
         self._current_file_index = file_index
         
@@ -103,13 +106,14 @@ class FileOperationsMixin:
         if self.pdf_document:
             self.pdf_document.close()
         
-        self.page_images.clear()
-        
         self.pdf_document = PDFDocument(file_path)
         if not self.pdf_document.open():
+            self.page_images = get_page_cache().view(None)
             QMessageBox.critical(self, "Ошибка", "Не удалось открыть PDF")
             return
         
+        self.page_images = get_page_cache().view(file_path)
+        
         if not keep_annotation:
             self.annotation_document = self._create_empty_annotation(file_path)
         
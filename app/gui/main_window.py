@@ -7,6 +7,7 @@ from typing import Optional
 from PySide6.QtWidgets import QMainWindow
 from app.models import Document, BlockType
 from app.pdf_utils import PDFDocument
+from app.page_cache import get_page_cache, PageImageView
 from app.gui.ocr_manager import OCRManager
 from app.gui.blocks_tree_manager import BlocksTreeManager
 from app.gui.category_manager import CategoryManager
@@ -15,6 +16,7 @@ from app.gui.project_manager import ProjectManager
 from app.gui.task_manager import TaskManager
 from app.gui.navigation_manager import NavigationManager
 from app.gui.marker_manager import MarkerManager
+from app.gui.page_prefetcher import PagePrefetcher
 from app.gui.menu_setup import MenuSetupMixin
 from app.gui.panels_setup import PanelsSetupMixin
 from app.gui.file_operations import FileOperationsMixin
@@ -33,7 +35,8 @@ class MainWindow(MenuSetupMixin, PanelsSetupMixin, FileOperationsMixin,
         self.pdf_document: Optional[PDFDocument] = None
         self.annotation_document: Optional[Document] = None
         self.current_page: int = 0
-        self.page_images: dict = {}
+        # Представление общего LRU кеша страниц для текущего PDF
+        self.page_images: PageImageView = get_page_cache().view(None)
         self.categories: list = []
         self.active_category: str = ""
         self.page_zoom_states: dict = {}
@@ -71,6 +74,7 @@ class MainWindow(MenuSetupMixin, PanelsSetupMixin, FileOperationsMixin,
         self.category_manager = CategoryManager(self, self.categories_list)
         self.navigation_manager = NavigationManager(self)
         self.marker_manager = MarkerManager(self)
+        self.page_prefetcher = PagePrefetcher(self)
         
         # Инициализация промптов и стандартных категорий
         self.prompt_manager.ensure_default_prompts()  # Проверяем наличие промптов в R2
@@ -87,10 +91,10 @@ class MainWindow(MenuSetupMixin, PanelsSetupMixin, FileOperationsMixin,
         if not self.pdf_document:
             return
         
-        self.navigation_manager.load_page_image(self.current_page)
-        
-        if self.current_page in self.page_images:
+        if self.navigation_manager.load_page_image(self.current_page):
             self.navigation_manager.restore_zoom()
+            # Соседние страницы рендерятся в фоне, пока пользователь смотрит текущую
+            self.page_prefetcher.prefetch_around(self.current_page)
             
             current_page_data = self._get_or_create_page(self.current_page)
             self.page_viewer.set_blocks(current_page_data.blocks if current_page_data else [])
@@ -299,7 +303,8 @@ class MainWindow(MenuSetupMixin, PanelsSetupMixin, FileOperationsMixin,
             self.annotation_document = None
             self._current_project_id = project_id
             self._current_file_index = -1
-            self.page_images.clear()
+            self.page_prefetcher.stop()
+            self.page_images = get_page_cache().view(None)
             self.page_viewer.set_page_image(None, 0)
             self._update_ui()
     
@@ -344,7 +349,8 @@ class MainWindow(MenuSetupMixin, PanelsSetupMixin, FileOperationsMixin,
         self.pdf_document = None
         self.annotation_document = None
         self._current_file_index = -1
-        self.page_images.clear()
+        self.page_prefetcher.stop()
+        self.page_images = get_page_cache().view(None)
         self.page_viewer.set_page_image(None, 0)
         self._update_ui()
     
@@ -381,4 +387,5 @@ class MainWindow(MenuSetupMixin, PanelsSetupMixin, FileOperationsMixin,
     def closeEvent(self, event):
         """Обработка закрытия окна"""
         self._save_settings()
+        self.page_prefetcher.shutdown()
         event.accept()
\ No newline at end of file
@@ -62,9 +62,9 @@ class MarkerManager:
             self.parent.annotation_document.pdf_path
         )
         
-        # Глубокая копия для thread-safety
+        # Глубокая копия для thread-safety (кеш страниц потокобезопасен, не копируем)
         pages_copy = copy.deepcopy(self.parent.annotation_document.pages)
-        page_images_copy = dict(self.parent.page_images)
+        page_images_view = self.parent.page_images
         
         # Сохраняем контекст файла
         task_project_id = self.parent._current_project_id
@@ -115,7 +115,7 @@ class MarkerManager:
             task_id,
             self.parent.pdf_document.pdf_path,
             pages_copy,
-            page_images_copy,
+            page_images_view,
             page_range,
             self.parent.active_category,
             engine
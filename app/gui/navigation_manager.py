@@ -81,25 +81,32 @@ class NavigationManager:
                 self.parent.page_viewer.resetTransform()
                 self.parent.page_viewer.zoom_factor = 1.0
     
-    def load_page_image(self, page_num: int, reset_zoom: bool = False):
-        """Загрузить изображение страницы"""
-        if page_num not in self.parent.page_images:
-            img = self.parent.pdf_document.render_page(page_num)
-            if img:
-                self.parent.page_images[page_num] = img
+    def load_page_image(self, page_num: int, reset_zoom: bool = False) -> bool:
+        """
+        Показать страницу в viewer (тайловый рендеринг по требованию)
         
-        if page_num in self.parent.page_images:
-            img = self.parent.page_images[page_num]
-            
-            # Синхронизируем размеры Page с реальным изображением
-            if self.parent.annotation_document and page_num < len(self.parent.annotation_document.pages):
-                page = self.parent.annotation_document.pages[page_num]
-                if page.width != img.width or page.height != img.height:
-                    logger.debug(f"Обновление размеров Page {page_num}: {page.width}x{page.height} -> {img.width}x{img.height}")
-                    page.width = img.width
-                    page.height = img.height
-            
-            self.parent.page_viewer.set_page_image(img, page_num, reset_zoom=reset_zoom)
+        Returns:
+            True если страница установлена в viewer
+        """
+        dims = self.parent.pdf_document.get_page_dimensions(page_num)
+        if not dims:
+            return False
+        
+        width, height = dims
+        
+        # Синхронизируем размеры Page с пиксельным пространством рендеринга
+        if self.parent.annotation_document and page_num < len(self.parent.annotation_document.pages):
+            page = self.parent.annotation_document.pages[page_num]
+            if page.width != width or page.height != height:
+                logger.debug(f"Обновление размеров Page {page_num}: {page.width}x{page.height} -> {width}x{height}")
+                page.width = width
+                page.height = height
+        
+        self.parent.page_viewer.set_page_source(
+            self.parent.pdf_document, page_num, width, height,
+            reset_zoom=reset_zoom, page_images=self.parent.page_images
+        )
+        return True
     
     def zoom_in(self):
         """Увеличить масштаб"""
@@ -7,7 +7,8 @@ import os
 import re
 from PySide6.QtWidgets import (QDialog, QVBoxLayout, QHBoxLayout, QLabel, 
                                QPushButton, QRadioButton, QLineEdit, QFileDialog,
-                               QGroupBox, QDialogButtonBox, QComboBox, QButtonGroup)
+                               QGroupBox, QDialogButtonBox, QComboBox, QButtonGroup,
+                               QCheckBox)
 from pathlib import Path
 from dotenv import load_dotenv
 
@@ -95,6 +96,9 @@ class OCRDialog(QDialog):
         self.use_datalab = False
         self.datalab_image_backend = "local"  # "local" или "openrouter" для IMAGE блоков
         
+        # Инкрементальный OCR: блоки без изменений не распознаются повторно
+        self.incremental_ocr = True
+        
         self._setup_ui()
     
     def _setup_ui(self):
@@ -198,6 +202,18 @@ class OCRDialog(QDialog):
         self.openrouter_radio.toggled.connect(self._on_backend_changed)
         self.local_radio.toggled.connect(self._on_backend_changed)
         
+        # Инкрементальный режим
+        self.incremental_checkbox = QCheckBox("Только изменённые блоки")
+        self.incremental_checkbox.setChecked(self.incremental_ocr)
+        layout.addWidget(self.incremental_checkbox)
+        
+        incremental_info = QLabel(
+            "💡 Блоки, у которых не менялись координаты, тип, категория, промпт и модель,\n"
+            "   берут результат прошлого прогона"
+        )
+        incremental_info.setStyleSheet("color: #888; font-size: 10px; margin-left: 20px;")
+        layout.addWidget(incremental_info)
+        
         # Папка для результатов
         output_group = QGroupBox("Папка для результатов")
         output_layout = QVBoxLayout(output_group)
@@ -317,6 +333,7 @@ class OCRDialog(QDialog):
         # Сохраняем настройки
         self.mode = "blocks"  # Всегда по блокам
         self.use_batch_ocr = True  # Всегда с batch-оптимизацией
+        self.incremental_ocr = self.incremental_checkbox.isChecked()
         
         # Определяем backend
         if self.datalab_radio.isChecked():
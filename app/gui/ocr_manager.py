@@ -10,12 +10,13 @@ from pathlib import Path
 from PySide6.QtWidgets import QProgressDialog, QMessageBox, QDialog
 from PySide6.QtCore import Qt
 from dotenv import load_dotenv
-from app.ocr import create_ocr_engine, generate_structured_markdown, run_local_vlm_full_document
+from app.ocr import create_ocr_engine, close_ocr_engines, generate_structured_markdown, run_local_vlm_full_document
 from app.annotation_io import AnnotationIO
 from app.models import BlockType
 from app.gui.task_manager import TaskManager, TaskType
 from app.r2_storage import upload_ocr_to_r2
-from app.datalab_ocr import MAX_BLOCK_HEIGHT
+from app.prompt_resolver import resolve_prompts
+from app.render_pool import iter_page_crops
 
 load_dotenv()
 logger = logging.getLogger(__name__)
@@ -128,15 +129,16 @@ class OCRManager:
             'image_model': dialog.image_model,
             'prompt_loader': self.parent.prompt_manager.load_prompt if hasattr(self.parent, 'prompt_manager') else None,
             'use_batch_ocr': getattr(dialog, 'use_batch_ocr', True),
+            'incremental_ocr': getattr(dialog, 'incremental_ocr', True),
             # Datalab настройки
             'use_datalab': getattr(dialog, 'use_datalab', False),
             'datalab_image_backend': getattr(dialog, 'datalab_image_backend', 'local'),
             'datalab_api_key': os.getenv('DATALAB_API_KEY', ''),
         }
         
-        # Глубокая копия документа для потока
+        # Глубокая копия документа для потока (кеш страниц потокобезопасен, не копируем)
         annotation_copy = copy.deepcopy(self.parent.annotation_document)
-        page_images_copy = dict(self.parent.page_images)
+        page_images_view = self.parent.page_images
         
         # Сохраняем контекст файла при запуске задачи
         task_project_id = self.parent._current_project_id
@@ -189,7 +191,7 @@ class OCRManager:
             task_id,
             annotation_copy,
             self.parent.pdf_document,
-            page_images_copy,
+            page_images_view,
             config
         )
     
@@ -206,43 +208,33 @@ class OCRManager:
 
         processed_count = 0
         
-        for page in self.parent.annotation_document.pages:
-            if progress.wasCanceled():
-                break
-                
+        # Рендерится только область каждого блока (clip), а не страница целиком
+        pages_with_blocks = [p for p in self.parent.annotation_document.pages if p.blocks]
+        # Промпты всех блоков разрешаются один раз (категория -> тип блока)
+        prompts = resolve_prompts((b for p in pages_with_blocks for b in p.blocks),
+                                  self.parent.prompt_manager.load_prompt)
+        for page, crops in iter_page_crops(self.parent.pdf_document, pages_with_blocks,
+                                           self.parent.page_images, is_cancelled=progress.wasCanceled):
             page_num = page.page_number
-            if page_num not in self.parent.page_images:
-                img = self.parent.pdf_document.render_page(page_num)
-                if img:
-                    self.parent.page_images[page_num] = img
-            
-            page_img = self.parent.page_images.get(page_num)
-            if not page_img:
-                continue
             
             for block in page.blocks:
                 if progress.wasCanceled():
                     break
                 
-                x1, y1, x2, y2 = block.coords_px
-                if x1 >= x2 or y1 >= y2:
+                parts = crops.get(block.id, [])
+                if not parts:
                     processed_count += 1
                     progress.setValue(processed_count)
                     continue
                 
                 try:
                     engine = engines.get(block.block_type.value, engines.get('default'))
-                    prompt = self._get_prompt_for_block(block)
+                    prompt = prompts.prompt(block)
                     
-                    # Ограничиваем высоту блока
-                    block_height = y2 - y1
-                    if block_height > MAX_BLOCK_HEIGHT:
+                    # Высокие блоки поделены на части по MAX_BLOCK_HEIGHT
+                    if len(parts) > 1:
                         ocr_parts = []
-                        y_start = y1
-                        part_idx = 0
-                        while y_start < y2:
-                            y_end = min(y_start + MAX_BLOCK_HEIGHT, y2)
-                            crop = page_img.crop((x1, y_start, x2, y_end))
+                        for part_idx, crop in enumerate(parts):
                             
                             if block.block_type == BlockType.IMAGE and part_idx == 0:
                                 crop_filename = f"page{page_num}_block{block.id}.png"
@@ -252,12 +244,10 @@ class OCRManager:
                             
                             part_text = engine.recognize(crop, prompt=prompt) if prompt else engine.recognize(crop)
                             ocr_parts.append(part_text)
-                            y_start = y_end
-                            part_idx += 1
                         
                         block.ocr_text = "\n".join(ocr_parts)
                     else:
-                        crop = page_img.crop((x1, y1, x2, y2))
+                        crop = parts[0]
                         
                         if block.block_type == BlockType.IMAGE:
                             crop_filename = f"page{page_num}_block{block.id}.png"
@@ -277,23 +267,6 @@ class OCRManager:
         progress.close()
         self._save_ocr_results(output_dir)
     
-    def _get_prompt_for_block(self, block):
-        """Получить промт для блока из R2 (приоритет: категория -> тип блока)"""
-        # Приоритет 1: Промпт категории
-        if block.category and block.category.strip():
-            category_prompt = self.parent.prompt_manager.load_prompt(f"category_{block.category.strip()}")
-            if category_prompt:
-                return category_prompt
-        
-        # Приоритет 2: Промпт типа блока
-        prompt_map = {
-            BlockType.IMAGE: "image",
-            BlockType.TABLE: "table",
-            BlockType.TEXT: "text",
-        }
-        key = prompt_map.get(block.block_type, "text")
-        return self.parent.prompt_manager.load_prompt(key)
-    
     def _save_ocr_results(self, output_dir: Path):
         """Сохранить результаты OCR"""
         json_path = output_dir / "annotation.json"
@@ -323,7 +296,10 @@ class OCRManager:
         except Exception as e:
             QMessageBox.critical(self.parent, "Ошибка LocalVLM OCR", f"Не удалось инициализировать:\n{e}")
             return
-        self._run_ocr_blocks_sync(engines, output_dir, crops_dir, model_name)
+        try:
+            self._run_ocr_blocks_sync(engines, output_dir, crops_dir, model_name)
+        finally:
+            close_ocr_engines(*engines.values())
     
     def run_openrouter_ocr_blocks_with_output(self, output_dir, crops_dir, text_model, table_model, image_model):
         """Запустить OpenRouter OCR для блоков"""
@@ -346,34 +322,41 @@ class OCRManager:
         except Exception as e:
             QMessageBox.critical(self.parent, "Ошибка OpenRouter OCR", f"Не удалось инициализировать:\n{e}")
             return
-        self._run_ocr_blocks_sync(engines, output_dir, crops_dir, "OpenRouter")
+        try:
+            self._run_ocr_blocks_sync(engines, output_dir, crops_dir, "OpenRouter")
+        finally:
+            close_ocr_engines(*engines.values())
     
-    def _prepare_page_images(self):
-        """Подготовить изображения всех страниц"""
-        progress = QProgressDialog("Подготовка страниц...", None, 0, len(self.parent.annotation_document.pages), self.parent)
-        progress.setWindowModality(Qt.WindowModal)
-        progress.show()
+    def _iter_page_images(self):
+        """
+        Страницы документа для полностраничного OCR по одной
+        
+        Страница берётся из кеша (ограничен по памяти) или рендерится и
+        кладётся в него; весь документ в памяти не собирается.
         
-        for i, page in enumerate(self.parent.annotation_document.pages):
+        Yields:
+            (page_num, PIL.Image) в порядке страниц
+        """
+        for page in self.parent.annotation_document.pages:
             page_num = page.page_number
-            if page_num not in self.parent.page_images:
+            img = self.parent.page_images.get(page_num)
+            if img is None:
                 img = self.parent.pdf_document.render_page(page_num)
-                if img:
-                    self.parent.page_images[page_num] = img
-            progress.setValue(i + 1)
-        progress.close()
+                if img is None:
+                    logger.warning(f"Страница {page_num + 1} не отрендерена, пропущена")
+                    continue
+                self.parent.page_images[page_num] = img
+            yield page_num, img
     
     def run_local_vlm_ocr_with_output(self, api_base, model_name, output_dir):
         """Запустить LocalVLM OCR для всего документа"""
-        self._prepare_page_images()
-        
         progress = QProgressDialog(f"Распознавание с {model_name}...", None, 0, 0, self.parent)
         progress.setWindowModality(Qt.WindowModal)
         progress.show()
         
         try:
             md_path = output_dir / "document.md"
-            run_local_vlm_full_document(self.parent.page_images, str(md_path), api_base=api_base, model_name=model_name)
+            run_local_vlm_full_document(self._iter_page_images(), str(md_path), api_base=api_base, model_name=model_name)
             
             json_path = output_dir / "annotation.json"
             AnnotationIO.save_annotation(self.parent.annotation_document, str(json_path))
@@ -397,17 +380,17 @@ class OCRManager:
             QMessageBox.critical(self.parent, "Ошибка", "OPENROUTER_API_KEY не найден в .env файле")
             return
         
-        self._prepare_page_images()
-        
         progress = QProgressDialog(f"Распознавание с {model_name}...", None, 0, 0, self.parent)
         progress.setWindowModality(Qt.WindowModal)
         progress.show()
         
         try:
             ocr_engine = create_ocr_engine("openrouter", api_key=api_key, model_name=model_name)
-            
-            md_parts = [f"# Страница {pn + 1}\n\n{ocr_engine.recognize(img)}\n\n---\n" 
-                        for pn, img in sorted(self.parent.page_images.items())]
+            try:
+                md_parts = [f"# Страница {pn + 1}\n\n{ocr_engine.recognize(img)}\n\n---\n" 
+                            for pn, img in self._iter_page_images()]
+            finally:
+                close_ocr_engines(ocr_engine)
             
             md_path = output_dir / "document.md"
             md_path.write_text("\n".join(md_parts), encoding="utf-8")
@@ -0,0 +1,188 @@
+"""
+Фоновая предзагрузка соседних страниц
+Рендерит страницы вокруг текущей в общий кеш страниц, пока пользователь
+просматривает документ, чтобы перелистывание не блокировало UI
+"""
+
+import logging
+import os
+import threading
+from typing import List, Optional, TYPE_CHECKING
+from PySide6.QtCore import QObject, QThread, Signal
+from app.pdf_utils import open_pdf, render_page_to_image, get_page_size_px, PDF_RENDER_ZOOM
+from app.page_cache import PageImageCache, get_page_cache
+
+if TYPE_CHECKING:
+    from app.gui.main_window import MainWindow
+
+logger = logging.getLogger(__name__)
+
+# Сколько страниц вперёд/назад от текущей предзагружать
+DEFAULT_PREFETCH_PAGES = 2
+
+
+class PagePrefetchWorker(QThread):
+    """
+    Фоновый поток рендеринга страниц одного PDF в кеш
+
+    Открывает собственный экземпляр fitz.Document (документ GUI не трогает).
+    Очередь страниц заменяется целиком при каждом schedule(), поэтому
+    переход на другую страницу отменяет ещё не начатый рендеринг.
+    """
+    page_ready = Signal(int)  # page_num
+
+    def __init__(self, pdf_path: str, cache: PageImageCache, zoom: float = PDF_RENDER_ZOOM):
+        super().__init__()
+        self.pdf_path = pdf_path
+        self.cache = cache
+        self.zoom = zoom
+        self._queue: List[int] = []
+        self._stopped = False
+        self._condition = threading.Condition()
+
+    def schedule(self, pages: List[int]):
+        """Заменить очередь предзагрузки (порядок = приоритет)"""
+        with self._condition:
+            self._queue = list(pages)
+            self._condition.notify()
+
+    def cancel(self):
+        """Отменить ожидающие страницы"""
+        self.schedule([])
+
+    def stop(self):
+        """Остановить поток (текущая страница дорендерится)"""
+        with self._condition:
+            self._stopped = True
+            self._queue = []
+            self._condition.notify()
+
+    def _next_page(self) -> Optional[int]:
+        """Дождаться следующей страницы из очереди (None - остановка)"""
+        with self._condition:
+            while not self._queue and not self._stopped:
+                self._condition.wait()
+            if self._stopped:
+                return None
+            return self._queue.pop(0)
+
+    def run(self):
+        try:
+            doc = open_pdf(self.pdf_path)
+        except Exception as e:
+            logger.error(f"Предзагрузка: не удалось открыть PDF {self.pdf_path}: {e}")
+            return
+
+        # Страница больше четверти бюджета вытеснит полезные данные - не предзагружаем
+        max_page_bytes = self.cache.max_bytes // 4
+
+        try:
+            while True:
+                page_num = self._next_page()
+                if page_num is None:
+                    break
+                if page_num < 0 or page_num >= len(doc):
+                    continue
+
+                key = self.cache.make_key(self.pdf_path, page_num, self.zoom)
+                if self.cache.contains(key):
+                    continue
+
+                width, height = get_page_size_px(doc[page_num], self.zoom)
+                if width * height * 3 > max_page_bytes:
+                    logger.debug(f"Предзагрузка: страница {page_num} слишком большая ({width}x{height}), пропуск")
+                    continue
+
+                try:
+                    img = render_page_to_image(doc, page_num, self.zoom)
+                except Exception as e:
+                    logger.warning(f"Предзагрузка: ошибка рендеринга страницы {page_num}: {e}")
+                    continue
+
+                # Результат полезен даже при смене очереди - кладём в кеш в любом случае
+                self.cache.put(key, img)
+                logger.debug(f"Предзагрузка: страница {page_num} готова")
+                self.page_ready.emit(page_num)
+        finally:
+            doc.close()
+
+
+class PagePrefetcher(QObject):
+    """
+    Управление предзагрузкой страниц для MainWindow
+
+    При каждом показе страницы пересчитывает очередь: сначала страницы
+    с блоками, затем ближайшие к текущей. При смене документа поток
+    предыдущего документа останавливается.
+    """
+
+    def __init__(self, parent: 'MainWindow', pages_around: Optional[int] = None):
+        super().__init__()
+        self.parent = parent
+        if pages_around is None:
+            pages_around = int(os.getenv("PREFETCH_PAGES", DEFAULT_PREFETCH_PAGES))
+        self.pages_around = pages_around
+        self._worker: Optional[PagePrefetchWorker] = None
+        self._retired: List[PagePrefetchWorker] = []
+
+    def prefetch_around(self, page_num: int):
+        """Запланировать предзагрузку страниц вокруг page_num"""
+        pdf_document = self.parent.pdf_document
+        if self.pages_around <= 0 or not pdf_document or not pdf_document.doc:
+            return
+
+        worker = self._ensure_worker(pdf_document.pdf_path)
+        worker.schedule(self._build_queue(page_num, pdf_document.page_count))
+
+    def stop(self):
+        """Остановить предзагрузку (закрытие документа)"""
+        if self._worker:
+            self._retire(self._worker)
+            self._worker = None
+
+    def shutdown(self, timeout_ms: int = 2000):
+        """Остановить все потоки и дождаться их завершения (закрытие окна)"""
+        self.stop()
+        for worker in list(self._retired):
+            worker.wait(timeout_ms)
+
+    def _build_queue(self, page_num: int, page_count: int) -> List[int]:
+        """Страницы окна вокруг текущей: с блоками первыми, затем по удалённости"""
+        first = max(0, page_num - self.pages_around)
+        last = min(page_count - 1, page_num + self.pages_around)
+        candidates = [p for p in range(first, last + 1) if p != page_num]
+
+        block_pages = set()
+        annotation_document = self.parent.annotation_document
+        if annotation_document:
+            block_pages = {p.page_number for p in annotation_document.pages if p.blocks}
+
+        # Вперёд чуть приоритетнее, чем назад (обычное направление листания)
+        candidates.sort(key=lambda p: (p not in block_pages, abs(p - page_num), p < page_num))
+        return candidates
+
+    def _ensure_worker(self, pdf_path: str) -> PagePrefetchWorker:
+        if self._worker and self._worker.pdf_path == pdf_path:
+            return self._worker
+
+        if self._worker:
+            self._retire(self._worker)
+
+        worker = PagePrefetchWorker(pdf_path, get_page_cache())
+        worker.start()
+        self._worker = worker
+        logger.debug(f"Предзагрузка запущена для {pdf_path}")
+        return worker
+
+    def _retire(self, worker: PagePrefetchWorker):
+        """Остановить поток, не блокируя GUI; ссылку держим до завершения"""
+        self._retired.append(worker)
+        worker.finished.connect(lambda w=worker: self._on_worker_finished(w))
+        worker.stop()
+        if worker.isFinished():
+            self._on_worker_finished(worker)
+
+    def _on_worker_finished(self, worker: PagePrefetchWorker):
+        if worker in self._retired:
+            self._retired.remove(worker)
+        worker.deleteLater()
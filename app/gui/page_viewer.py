@@ -9,6 +9,7 @@ from PySide6.QtGui import QPixmap, QPainter, QPen, QImage, QColor, QWheelEvent,
 from PIL import Image
 from typing import Optional, List, Dict
 from app.models import Block, BlockType, BlockSource
+from app.gui.tiled_page_item import TiledPageItem
 
 
 class PageViewer(QGraphicsView):
@@ -42,7 +43,7 @@ class PageViewer(QGraphicsView):
         
         # Изображение страницы
         self.page_image: Optional[QPixmap] = None
-        self.image_item: Optional[QGraphicsPixmapItem] = None
+        self.image_item: Optional[QGraphicsPixmapItem | TiledPageItem] = None
         self.current_blocks: List[Block] = []
         self.block_items: Dict[str, QGraphicsRectItem] = {}  # id блока -> QGraphicsRectItem
         self.block_labels: Dict[str, QGraphicsTextItem] = {}  # id блока -> QGraphicsTextItem
@@ -111,6 +112,8 @@ class PageViewer(QGraphicsView):
             self.current_page = page_number
             self.selected_block_idx = None
             self.block_items.clear()
+            self.block_labels.clear()
+            self.resize_handles.clear()
             return
         
         # Конвертация PIL в QPixmap
@@ -135,6 +138,41 @@ class PageViewer(QGraphicsView):
             self.resetTransform()
             self.zoom_factor = 1.0
     
+    def set_page_source(self, pdf_document, page_number: int, width: int, height: int,
+                        reset_zoom: bool = True, page_images=None):
+        """
+        Установить страницу для тайлового отображения
+        
+        Страница не рендерится целиком: тайлы рендерятся по требованию
+        только для видимой области. Координаты сцены - пиксели при 300 DPI.
+        
+        Args:
+            pdf_document: открытый PDFDocument
+            page_number: номер страницы
+            width: ширина страницы в пикселях
+            height: высота страницы в пикселях
+            reset_zoom: сбрасывать ли масштаб (по умолчанию True)
+            page_images: кеш страниц {page_num: PIL.Image} - если страница
+                         уже отрендерена (предзагрузка), тайлы вырезаются из неё
+        """
+        self.page_image = None
+        self.current_page = page_number
+        
+        self.scene.clear()
+        self.image_item = TiledPageItem(pdf_document, page_number, width, height, page_images)
+        self.scene.addItem(self.image_item)
+        self.scene.setSceneRect(QRectF(0, 0, width, height))
+        
+        # Сбрасываем выбранный блок при смене страницы
+        self.selected_block_idx = None
+        self.block_items.clear()
+        self.block_labels.clear()
+        self.resize_handles.clear()
+        
+        if reset_zoom:
+            self.resetTransform()
+            self.zoom_factor = 1.0
+    
     def set_blocks(self, blocks: List[Block]):
         """
         Установить список блоков для отображения
@@ -820,7 +858,7 @@ class PageViewer(QGraphicsView):
     
     def fit_to_view(self):
         """Подогнать страницу под размер view"""
-        if self.page_image:
+        if self.image_item:
             self.fitInView(self.scene.sceneRect(), Qt.KeepAspectRatio)
             self.zoom_factor = self.transform().m11()
     
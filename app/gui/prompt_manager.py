@@ -9,6 +9,7 @@ import logging
 from typing import Optional
 from PySide6.QtWidgets import QMessageBox, QDialog
 from app.r2_storage import R2Storage
+from app.prompt_cache import PromptCache
 from app.gui.prompt_editor_dialog import PromptEditorDialog
 
 logger = logging.getLogger(__name__)
@@ -26,6 +27,10 @@ class PromptManager:
         self.parent = parent
         self.r2_storage: Optional[R2Storage] = None
         self._init_r2()
+        # Промпты читаются через локальный кеш (OCR запрашивает их на каждую группу блоков)
+        self.prompt_cache = PromptCache(self.r2_storage, prefix=self.PROMPTS_PREFIX)
+        # Листинг R2 в фоне: без сети он может занять минуты (повторы boto3)
+        self.prompt_cache.prefetch_async()
     
     def _init_r2(self):
         """Инициализация R2 Storage"""
@@ -42,7 +47,7 @@ class PromptManager:
     
     def load_prompt(self, name: str) -> Optional[dict]:
         """
-        Загрузить промт из R2
+        Загрузить промт из R2 (через локальный кеш, без сети - сохранённая версия)
         
         Args:
             name: Имя промта (например 'text', 'table', 'image' или 'category_XXX')
@@ -50,33 +55,10 @@ class PromptManager:
         Returns:
             Dict с ключами 'system' и 'user' или None
         """
-        if not self.r2_storage:
-            logger.warning("R2 недоступен, промт не загружен")
-            return None
-        
-        key = self.get_prompt_key(name)
-        content = self.r2_storage.download_text(key)
-        
-        if content:
-            try:
-                data = json.loads(content)
-                return {
-                    "system": data.get("system", ""),
-                    "user": data.get("user", "")
-                }
-            except json.JSONDecodeError:
-                # Старый формат - простой текст, конвертируем
-                logger.info(f"Конвертация старого формата промта: {name}")
-                return {"system": "", "user": content}
-        
-        # Пробуем загрузить старый .txt формат для миграции
-        old_key = f"{self.PROMPTS_PREFIX}/{name}.txt"
-        old_content = self.r2_storage.download_text(old_key)
-        if old_content:
-            logger.info(f"Миграция промта из .txt: {name}")
-            return {"system": "", "user": old_content}
-        
-        return None
+        prompt = self.prompt_cache.load_prompt(name)
+        if prompt is None and not self.r2_storage:
+            logger.warning(f"R2 недоступен, промт не загружен: {name}")
+        return prompt
     
     def save_prompt(self, name: str, content: dict) -> bool:
         """
@@ -102,6 +84,7 @@ class PromptManager:
         result = self.r2_storage.upload_text(json_content, key)
         
         if result:
+            self.prompt_cache.put(key, json_content)
             logger.info(f"✅ Промт сохранен в R2: {name}")
         else:
             logger.error(f"❌ Ошибка сохранения промта: {name}")
@@ -175,8 +158,8 @@ class PromptManager:
             logger.warning("R2 недоступен, категории не загружены")
             return []
         
-        # Сканируем все файлы в prompts/
-        keys = self.r2_storage.list_by_prefix(f"{self.PROMPTS_PREFIX}/")
+        # Сканируем файлы prompts/category_* (все страницы листинга)
+        keys = self.r2_storage.list_by_prefix(f"{self.PROMPTS_PREFIX}/category_")
         
         categories = []
         for key in keys:
@@ -220,6 +203,7 @@ class PromptManager:
         result = self.r2_storage.delete_object(key)
         
         if result:
+            self.prompt_cache.put(key, None)
             logger.info(f"✅ Промт удален из R2: {name}")
         else:
             logger.error(f"❌ Ошибка удаления промта: {name}")
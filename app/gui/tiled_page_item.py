@@ -0,0 +1,167 @@
+"""
+Тайловое отображение страницы PDF
+Страница рисуется тайлами 512×512, которые рендерятся по требованию
+через fitz clip только для видимой области и текущего уровня масштаба
+"""
+
+import logging
+import math
+from collections import OrderedDict
+from typing import Mapping, Optional, Tuple
+from PIL import Image
+from PySide6.QtWidgets import QGraphicsItem, QStyleOptionGraphicsItem
+from PySide6.QtCore import QRectF
+from PySide6.QtGui import QPixmap, QImage, QPainter, QColor
+from app.pdf_utils import PDFDocument
+
+logger = logging.getLogger(__name__)
+
+
+class TiledPageItem(QGraphicsItem):
+    """
+    Элемент сцены, отображающий страницу PDF тайлами
+
+    Координаты элемента - пиксели страницы при PDF_RENDER_ZOOM (300 DPI),
+    т.е. то же пространство, что и Block.coords_px. Тайлы рендерятся
+    с уровнем детализации, соответствующим текущему масштабу view.
+    """
+
+    TILE_SIZE = 512                      # Размер тайла в пикселях экрана
+    LEVELS = (1.0, 0.5, 0.25, 0.125)     # Уровни детализации относительно 300 DPI
+    MAX_CACHED_TILES = 256               # ~256 МБ в худшем случае (512*512*4)
+
+    def __init__(self, pdf_document: PDFDocument, page_number: int, width: int, height: int,
+                 page_images: Optional[Mapping[int, Image.Image]] = None):
+        """
+        Args:
+            pdf_document: открытый PDF документ
+            page_number: номер страницы
+            width: ширина страницы в пикселях (300 DPI)
+            height: высота страницы в пикселях (300 DPI)
+            page_images: кеш отрендеренных страниц (опционально)
+        """
+        super().__init__()
+        self.pdf_document = pdf_document
+        self.page_number = page_number
+        self.width = width
+        self.height = height
+        self.page_images = page_images
+        self._tiles: "OrderedDict[Tuple[float, int, int], QPixmap]" = OrderedDict()
+
+        # exposedRect в paint() - только реально видимая часть
+        self.setFlag(QGraphicsItem.ItemUsesExtendedStyleOption, True)
+        self.setZValue(-1)
+
+    def boundingRect(self) -> QRectF:
+        return QRectF(0, 0, self.width, self.height)
+
+    def clear_tiles(self):
+        """Очистить кеш тайлов"""
+        self._tiles.clear()
+
+    def _select_level(self, level_of_detail: float) -> float:
+        """Минимальный уровень, детализация которого не хуже экранной"""
+        for level in reversed(self.LEVELS):
+            if level >= level_of_detail:
+                return level
+        return self.LEVELS[0]
+
+    def paint(self, painter: QPainter, option: QStyleOptionGraphicsItem, widget=None):
+        lod = QStyleOptionGraphicsItem.levelOfDetailFromTransform(painter.worldTransform())
+        level = self._select_level(lod)
+
+        exposed = option.exposedRect.intersected(self.boundingRect())
+        if exposed.isEmpty():
+            return
+
+        # Размер тайла в координатах сцены
+        tile_scene = self.TILE_SIZE / level
+        col_start = int(exposed.left() // tile_scene)
+        col_end = int(math.ceil(exposed.right() / tile_scene))
+        row_start = int(exposed.top() // tile_scene)
+        row_end = int(math.ceil(exposed.bottom() / tile_scene))
+
+        for row in range(row_start, row_end):
+            for col in range(col_start, col_end):
+                target = QRectF(
+                    col * tile_scene,
+                    row * tile_scene,
+                    tile_scene,
+                    tile_scene
+                ).intersected(self.boundingRect())
+                if target.isEmpty():
+                    continue
+
+                pixmap = self._get_tile(level, col, row, target)
+                if pixmap is None:
+                    painter.fillRect(target, QColor(255, 255, 255))
+                    continue
+                painter.drawPixmap(target, pixmap, QRectF(pixmap.rect()))
+
+    def _get_tile(self, level: float, col: int, row: int, target: QRectF) -> Optional[QPixmap]:
+        """Получить тайл из кеша или отрендерить его"""
+        key = (level, col, row)
+        pixmap = self._tiles.get(key)
+        if pixmap is not None:
+            self._tiles.move_to_end(key)
+            return pixmap
+
+        pixmap = self._render_tile(level, target)
+        if pixmap is None:
+            return None
+
+        self._tiles[key] = pixmap
+        while len(self._tiles) > self.MAX_CACHED_TILES:
+            self._tiles.popitem(last=False)
+        return pixmap
+
+    def _crop_from_cache(self, level: float, clip_px: Tuple[float, float, float, float]) -> Optional[Image.Image]:
+        """Вырезать тайл из уже отрендеренной страницы (предзагрузка), без обращения к fitz"""
+        if self.page_images is None:
+            return None
+        full_image = self.page_images.get(self.page_number)
+        if full_image is None or full_image.size != (self.width, self.height):
+            return None
+
+        box = tuple(int(round(v)) for v in clip_px)
+        tile = full_image.crop(box)
+        factor = int(round(1 / level))
+        if factor > 1:
+            tile = tile.reduce(factor)
+        return tile
+
+    def _render_tile(self, level: float, target: QRectF) -> Optional[QPixmap]:
+        """Отрендерить область страницы в QPixmap"""
+        clip_px = (target.left(), target.top(), target.right(), target.bottom())
+        pil_image = self._crop_from_cache(level, clip_px)
+        if pil_image is not None:
+            return pil_to_qpixmap(pil_image)
+
+        pix = self.pdf_document.render_region_pixmap(self.page_number, clip_px, scale=level)
+        if pix is None:
+            return None
+        return fitz_pixmap_to_qpixmap(pix)
+
+
+def fitz_pixmap_to_qpixmap(pix) -> Optional[QPixmap]:
+    """QImage напрямую над буфером fitz.Pixmap (без PNG и без PIL)"""
+    formats = {3: QImage.Format_RGB888, 4: QImage.Format_RGBA8888, 1: QImage.Format_Grayscale8}
+    image_format = formats.get(pix.n)
+    if image_format is None:
+        logger.warning(f"Неподдерживаемый формат pixmap для отображения: n={pix.n}")
+        return None
+
+    samples = pix.samples
+    qimage = QImage(samples, pix.width, pix.height, pix.stride, image_format)
+    # fromImage копирует данные, samples нужен только до этого момента
+    return QPixmap.fromImage(qimage)
+
+
+def pil_to_qpixmap(pil_image: Image.Image) -> QPixmap:
+    """Конвертация PIL Image в QPixmap"""
+    if pil_image.mode != "RGB":
+        pil_image = pil_image.convert("RGB")
+    img_bytes = pil_image.tobytes("raw", "RGB")
+    qimage = QImage(img_bytes, pil_image.width, pil_image.height,
+                    pil_image.width * 3, QImage.Format_RGB888)
+    return QPixmap.fromImage(qimage)
@@ -0,0 +1,420 @@
+"""
+Кодирование изображений для отправки в OCR/VLM API
+Один кодировщик для всех движков: формат выбирается по типу блока и
+содержимому кропа (grayscale/RGB PNG без потерь для текста и таблиц,
+JPEG или WebP для фото), кодирование выполняется в памяти один раз и
+переиспользуется при повторных запросах с тем же кропом, объём
+отправленных данных собирается в статистику по блокам.
+"""
+
+import base64
+import io
+import logging
+import os
+import threading
+import weakref
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+from PIL import Image, ImageChops, features
+
+logger = logging.getLogger(__name__)
+
+# Максимальная сторона изображения по умолчанию
+DEFAULT_MAX_SIDE = 1500
+
+# Качество lossy форматов
+JPEG_QUALITY = 85
+WEBP_QUALITY = 80
+
+# Диапазон качества JPEG при подгонке под лимит размера (encode_within)
+MIN_JPEG_QUALITY = 60
+MAX_JPEG_QUALITY = 95
+
+# Анализ содержимого выполняется на уменьшенной копии
+ANALYSIS_SIDE = 512
+# Разница каналов, начиная с которой пиксель считается цветным
+CHROMA_THRESHOLD = 24
+# Доля цветных пикселей, начиная с которой изображение цветное
+COLOR_PIXEL_RATIO = 0.005
+# Доля почти чёрных/белых пикселей для 1-bit PNG (OCR_IMAGE_FORMAT=png-reduced)
+BILEVEL_RATIO = 0.98
+
+# Лимит памяти под переиспользуемые кодировки
+ENCODING_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# Форматы, принудительно задаваемые через OCR_IMAGE_FORMAT
+_FORCED_FORMATS = {"png": "PNG", "jpeg": "JPEG", "jpg": "JPEG", "webp": "WEBP"}
+
+# OCR_IMAGE_FORMAT=png-reduced: выбор формата как в auto, но PNG уменьшается
+# до 1-bit (чёрное на белом) или палитры (цвет). Это потери: тонкие
+# сглаженные штрихи мелкого текста пропадают, поэтому режим включается только
+# явно, после сравнения точности OCR на своих документах.
+_REDUCED_PNG = "png-reduced"
+
+
+@dataclass(frozen=True)
+class EncodedImage:
+    """Закодированное изображение, готовое к отправке"""
+    data: bytes
+    format: str               # 'PNG' | 'JPEG' | 'WEBP'
+    mode: str                 # режим после преобразования ('1', 'L', 'P', 'RGB', 'RGBA')
+    size: Tuple[int, int]
+
+    @property
+    def mime(self) -> str:
+        return f"image/{self.format.lower()}"
+
+    @property
+    def extension(self) -> str:
+        return ".jpg" if self.format == "JPEG" else f".{self.format.lower()}"
+
+    @property
+    def base64(self) -> str:
+        return base64.b64encode(self.data).decode("ascii")
+
+    @property
+    def data_url(self) -> str:
+        return f"data:{self.mime};base64,{self.base64}"
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+
+def analyze_content(image: Image.Image) -> str:
+    """
+    Характер содержимого кропа
+
+    Args:
+        image: PIL изображение
+
+    Returns:
+        'bilevel' (чёрное на белом), 'gray' (без цвета) или 'color'
+    """
+    if image.mode == "1":
+        return "bilevel"
+
+    factor = max(1, max(image.size) // ANALYSIS_SIDE)
+    thumb = image.reduce(factor) if factor > 1 else image
+
+    if thumb.mode in ("L", "LA", "I", "I;16"):
+        gray = thumb.convert("L")
+    else:
+        rgb = thumb.convert("RGB")
+        r, g, b = rgb.split()
+        chroma = ImageChops.lighter(
+            ImageChops.lighter(ImageChops.difference(r, g), ImageChops.difference(g, b)),
+            ImageChops.difference(r, b)
+        )
+        colored = sum(chroma.histogram()[CHROMA_THRESHOLD:])
+        if colored > chroma.width * chroma.height * COLOR_PIXEL_RATIO:
+            return "color"
+        gray = rgb.convert("L")
+
+    hist = gray.histogram()
+    extreme = sum(hist[:48]) + sum(hist[208:])
+    return "bilevel" if extreme >= gray.width * gray.height * BILEVEL_RATIO else "gray"
+
+
+def _lossy_format() -> str:
+    """Lossy формат для фото: JPEG или WebP (OCR_IMAGE_LOSSY=webp, если Pillow его поддерживает)"""
+    if os.getenv("OCR_IMAGE_LOSSY", "jpeg").lower() == "webp" and features.check("webp"):
+        return "WEBP"
+    return "JPEG"
+
+
+def _reduced_png() -> bool:
+    return os.getenv("OCR_IMAGE_FORMAT", "auto").lower() == _REDUCED_PNG
+
+
+def _choose_format(block_type: Optional[str], content: str) -> str:
+    forced = _FORCED_FORMATS.get(os.getenv("OCR_IMAGE_FORMAT", "auto").lower())
+    if forced == "WEBP" and not features.check("webp"):
+        forced = "JPEG"
+    if forced:
+        return forced
+    # Фото и иллюстрации - lossy; текст, таблицы и чертежи - без потерь
+    if block_type == "image" and content != "bilevel":
+        return _lossy_format()
+    return "PNG"
+
+
+def _to_png_mode(image: Image.Image, content: str) -> Image.Image:
+    """Режим PNG: L для содержимого без цвета, иначе RGB(A); 1-bit и палитра - только png-reduced"""
+    reduced = _reduced_png()
+    if content == "bilevel" and reduced:
+        return image.convert("L").point(lambda v: 255 if v >= 128 else 0, mode="1")
+    if content in ("bilevel", "gray"):
+        return image.convert("L")
+    if image.mode in ("RGBA", "LA") or "transparency" in image.info:
+        return image.convert("RGBA")
+    if reduced:
+        # Сканы с цветными штампами и подписями: адаптивная палитра в 4 раза меньше RGB
+        return image.convert("RGB").quantize(colors=256)
+    return image.convert("RGB")
+
+
+def _resize(image: Image.Image, max_side: Optional[int]) -> Image.Image:
+    if max_side and (image.width > max_side or image.height > max_side):
+        ratio = min(max_side / image.width, max_side / image.height)
+        new_size = (max(1, int(image.width * ratio)), max(1, int(image.height * ratio)))
+        image = image.resize(new_size, Image.LANCZOS)
+    return image
+
+
+def _save(image: Image.Image, fmt: str, content: str, quality: Optional[int]) -> EncodedImage:
+    buffer = io.BytesIO()
+    if fmt == "PNG":
+        converted = _to_png_mode(image, content)
+        converted.save(buffer, format="PNG", optimize=True)
+    else:
+        converted = image.convert("L" if content != "color" else "RGB")
+        default_quality = WEBP_QUALITY if fmt == "WEBP" else JPEG_QUALITY
+        converted.save(buffer, format=fmt, quality=quality or default_quality, optimize=True)
+
+    return EncodedImage(buffer.getvalue(), fmt, converted.mode, converted.size)
+
+
+def _encode(image: Image.Image, block_type: Optional[str], max_side: Optional[int],
+            fmt: Optional[str], quality: Optional[int]) -> EncodedImage:
+    image = _resize(image, max_side)
+    content = analyze_content(image)
+    return _save(image, fmt or _choose_format(block_type, content), content, quality)
+
+
+def _encode_within(image: Image.Image, max_bytes: int, block_type: Optional[str], max_side: Optional[int],
+                   min_quality: int, max_quality: int) -> EncodedImage:
+    image = _resize(image, max_side)
+    content = analyze_content(image)
+    encoded = _save(image, _choose_format(block_type, content), content, None)
+    if len(encoded) <= max_bytes:
+        return encoded
+
+    # Бинарный поиск наибольшего качества JPEG, при котором файл укладывается в лимит
+    best = None
+    probes = 1
+    low, high = min_quality, max_quality
+    while low <= high:
+        quality = (low + high) // 2
+        candidate = _save(image, "JPEG", content, quality)
+        probes += 1
+        if len(candidate) <= max_bytes:
+            best, low = candidate, quality + 1
+        else:
+            high = quality - 1
+
+    if best is None:
+        raise ValueError(f"Не удалось уменьшить изображение до {max_bytes / (1024 * 1024):.0f}MB")
+    logger.debug(f"Изображение {image.width}x{image.height}: JPEG q{low - 1}, "
+                 f"{len(best) / (1024 * 1024):.1f} MB за {probes} кодирований")
+    return best
+
+
+class _EncodingCache:
+    """
+    Кодировки живых кропов (LRU по объёму)
+
+    Ключ - объект изображения: запись удаляется, когда кроп собран сборщиком
+    мусора, поэтому повтор с тем же кропом не кодирует его заново, а
+    освобождённый id не может вернуть чужую кодировку.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[int, Tuple[weakref.ref, Dict[tuple, EncodedImage]]]" = OrderedDict()
+        self._bytes = 0
+        # RLock: callback weakref может сработать при сборке мусора под блокировкой
+        self._lock = threading.RLock()
+
+    def get(self, image: Image.Image, key: tuple) -> Optional[EncodedImage]:
+        with self._lock:
+            entry = self._entries.get(id(image))
+            if entry is None or entry[0]() is not image:
+                return None
+            self._entries.move_to_end(id(image))
+            return entry[1].get(key)
+
+    def put(self, image: Image.Image, key: tuple, encoded: EncodedImage):
+        image_id = id(image)
+        with self._lock:
+            entry = self._entries.get(image_id)
+            if entry is None or entry[0]() is not image:
+                if entry is not None:
+                    self._drop_locked(image_id)
+                try:
+                    ref = weakref.ref(image, lambda _ref, image_id=image_id: self._discard(image_id, _ref))
+                except TypeError:
+                    return
+                entry = (ref, {})
+                self._entries[image_id] = entry
+            old = entry[1].get(key)
+            entry[1][key] = encoded
+            self._bytes += len(encoded) - (len(old) if old else 0)
+            self._entries.move_to_end(image_id)
+            while self._bytes > self.max_bytes and len(self._entries) > 1:
+                self._drop_locked(next(iter(self._entries)))
+
+    def _discard(self, image_id: int, ref: weakref.ref):
+        with self._lock:
+            entry = self._entries.get(image_id)
+            if entry is not None and entry[0] is ref:
+                self._drop_locked(image_id)
+
+    def _drop_locked(self, image_id: int):
+        _, encodings = self._entries.pop(image_id)
+        self._bytes -= sum(len(e) for e in encodings.values())
+
+
+class EncodingStats:
+    """Статистика отправленных изображений: байты по типам блоков, форматам и блокам"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.images = 0
+            self.reused = 0
+            self.bytes_sent = 0
+            self.raw_bytes = 0
+            self.by_type: Dict[str, list] = {}
+            self.by_format: Dict[str, int] = {}
+            self.per_block: Dict[str, int] = {}
+
+    def record(self, encoded: EncodedImage, block_type: Optional[str], block_id: Optional[str], reused: bool):
+        size = len(encoded)
+        with self._lock:
+            self.images += 1
+            self.reused += int(reused)
+            self.bytes_sent += size
+            self.raw_bytes += encoded.size[0] * encoded.size[1] * 3
+            counters = self.by_type.setdefault(block_type or "other", [0, 0])
+            counters[0] += 1
+            counters[1] += size
+            self.by_format[encoded.format] = self.by_format.get(encoded.format, 0) + 1
+            if block_id:
+                self.per_block[block_id] = self.per_block.get(block_id, 0) + size
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "images": self.images,
+                "reused": self.reused,
+                "bytes_sent": self.bytes_sent,
+                "raw_bytes": self.raw_bytes,
+                "by_type": {t: {"count": c, "bytes": b} for t, (c, b) in self.by_type.items()},
+                "by_format": dict(self.by_format),
+                "per_block": dict(self.per_block),
+            }
+
+    def log_stats(self, top: int = 5):
+        """Записать итог в лог: объём, сжатие относительно RGB и самые тяжёлые блоки"""
+        stats = self.snapshot()
+        if not stats["images"]:
+            return
+        ratio = stats["raw_bytes"] / stats["bytes_sent"] if stats["bytes_sent"] else 0.0
+        by_type = ", ".join(
+            f"{t}: {v['count']} шт / {v['bytes'] / 1024:.0f} KB" for t, v in sorted(stats["by_type"].items())
+        )
+        formats = ", ".join(f"{f} {n}" for f, n in sorted(stats["by_format"].items()))
+        logger.info(
+            f"Изображения: отправлено {stats['images']} ({stats['reused']} без перекодирования), "
+            f"{stats['bytes_sent'] / (1024 * 1024):.2f} MB, сжатие x{ratio:.1f} к RGB; "
+            f"{by_type}; форматы: {formats}"
+        )
+        heaviest = sorted(stats["per_block"].items(), key=lambda item: item[1], reverse=True)[:top]
+        if heaviest:
+            logger.info("Самые тяжёлые блоки: " + ", ".join(f"{bid} {size / 1024:.0f} KB" for bid, size in heaviest))
+
+
+_cache = _EncodingCache(ENCODING_CACHE_MAX_BYTES)
+encoding_stats = EncodingStats()
+
+
+def _env_key() -> tuple:
+    """Настройки окружения, влияющие на кодировку (часть ключа кеша)"""
+    return os.getenv("OCR_IMAGE_FORMAT", ""), os.getenv("OCR_IMAGE_LOSSY", "")
+
+
+def encode_image(
+    image: Image.Image,
+    block_type: Optional[str] = None,
+    max_side: Optional[int] = DEFAULT_MAX_SIDE,
+    block_id: Optional[str] = None,
+    fmt: Optional[str] = None,
+    quality: Optional[int] = None,
+    record: bool = True,
+) -> EncodedImage:
+    """
+    Закодировать кроп для отправки в API
+
+    Каждый вызов считается отправкой и попадает в encoding_stats; повторный
+    вызов с тем же объектом изображения и параметрами возвращает готовую
+    кодировку.
+
+    Args:
+        image: PIL изображение
+        block_type: тип блока ('text', 'table', 'image') или None (без потерь)
+        max_side: максимальный размер стороны (None - без ресайза)
+        block_id: ID блока для статистики
+        fmt: принудительный формат ('PNG', 'JPEG', 'WEBP')
+        quality: качество lossy формата
+        record: учитывать вызов как отправку в encoding_stats
+
+    Returns:
+        EncodedImage
+    """
+    key = (block_type, max_side, fmt, quality) + _env_key()
+    encoded = _cache.get(image, key)
+    reused = encoded is not None
+    if encoded is None:
+        encoded = _encode(image, block_type, max_side, fmt, quality)
+        _cache.put(image, key, encoded)
+    if record:
+        encoding_stats.record(encoded, block_type, block_id, reused)
+    return encoded
+
+
+def encode_within(
+    image: Image.Image,
+    max_bytes: int,
+    block_type: Optional[str] = None,
+    max_side: Optional[int] = None,
+    block_id: Optional[str] = None,
+    min_quality: int = MIN_JPEG_QUALITY,
+    max_quality: int = MAX_JPEG_QUALITY,
+    record: bool = True,
+) -> EncodedImage:
+    """
+    Закодировать изображение с ограничением размера
+
+    Сначала формат по умолчанию (см. encode_image); если результат больше
+    max_bytes - JPEG с наибольшим качеством из [min_quality, max_quality],
+    укладывающимся в лимит (бинарный поиск, все пробы в памяти).
+
+    Args:
+        image: PIL изображение
+        max_bytes: лимит размера результата
+        block_type: тип блока ('text', 'table', 'image') или None (без потерь)
+        max_side: максимальный размер стороны (None - без ресайза)
+        block_id: ID блока для статистики
+        min_quality: наименьшее допустимое качество JPEG
+        max_quality: наибольшее качество JPEG
+        record: учитывать вызов как отправку в encoding_stats
+
+    Returns:
+        EncodedImage
+
+    Raises:
+        ValueError: изображение не укладывается в лимит даже при min_quality
+    """
+    key = ("within", max_bytes, block_type, max_side, min_quality, max_quality) + _env_key()
+    encoded = _cache.get(image, key)
+    reused = encoded is not None
+    if encoded is None:
+        encoded = _encode_within(image, max_bytes, block_type, max_side, min_quality, max_quality)
+        _cache.put(image, key, encoded)
+    if record:
+        encoding_stats.record(encoded, block_type, block_id, reused)
+    return encoded
@@ -5,6 +5,7 @@
 
 import sys
 import logging
+import multiprocessing
 from pathlib import Path
 from PySide6.QtWidgets import QApplication
 from app.gui.main_window import MainWindow
@@ -95,5 +96,7 @@ def main():
 
 
 if __name__ == "__main__":
+    # Нужно для процессов рендеринга (RenderPool) в собранном exe
+    multiprocessing.freeze_support()
     main()
 
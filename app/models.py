@@ -3,6 +3,8 @@
 Содержит классы для представления страниц PDF и блоков разметки
 """
 
+import hashlib
+import json
 import uuid
 from dataclasses import dataclass, field
 from typing import List, Tuple, Optional
@@ -10,6 +12,15 @@ from enum import Enum
 from PIL import Image
 
 
+# Тексты-ошибки OCR: такой результат не считается распознанным и не кешируется
+_ERROR_PREFIXES = ("[Error", "[Ошибка", "[Parsing error]")
+
+
+def is_cacheable(text: Optional[str]) -> bool:
+    """Можно ли сохранить результат OCR (не ошибка и не пустой)"""
+    return bool(text) and not text.lstrip().startswith(_ERROR_PREFIXES)
+
+
 class BlockType(Enum):
     """Типы блоков разметки (3 основных типа)"""
     TEXT = "text"
@@ -38,6 +49,8 @@ class Block:
         source: источник создания (USER/AUTO)
         image_file: путь к сохранённому кропу блока
         ocr_text: результат OCR распознавания
+        ocr_fingerprint: отпечаток входных данных, давших ocr_text
+            (координаты, тип, категория, промпт, модель) - см. compute_ocr_fingerprint
     """
     id: str
     page_index: int
@@ -48,6 +61,7 @@ class Block:
     source: BlockSource
     image_file: Optional[str] = None
     ocr_text: Optional[str] = None
+    ocr_fingerprint: Optional[str] = None
     
     @staticmethod
     def generate_id() -> str:
@@ -167,6 +181,31 @@ class Block:
         self.coords_px = new_coords_px
         self.coords_norm = self.px_to_norm(new_coords_px, page_width, page_height)
     
+    def compute_ocr_fingerprint(self, prompt=None, model: str = "") -> str:
+        """
+        Отпечаток входных данных OCR блока
+        
+        Args:
+            prompt: промпт, с которым распознаётся блок (dict или строка)
+            model: движок/модель распознавания
+        
+        Returns:
+            sha256 hex (меняется при сдвиге блока, смене типа, категории, промпта или модели)
+        """
+        data = {
+            "coords_norm": [round(c, 5) for c in self.coords_norm],
+            "block_type": self.block_type.value,
+            "category": (self.category or "").strip(),
+            "prompt": prompt,
+            "model": model,
+        }
+        payload = json.dumps(data, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+    
+    def is_ocr_current(self, fingerprint: str) -> bool:
+        """Есть ли у блока успешный результат OCR для этих входных данных"""
+        return is_cacheable(self.ocr_text) and self.ocr_fingerprint == fingerprint
+    
     def to_dict(self) -> dict:
         """Сериализация в словарь для JSON"""
         return {
@@ -178,7 +217,8 @@ class Block:
             "block_type": self.block_type.value,
             "source": self.source.value,
             "image_file": self.image_file,
-            "ocr_text": self.ocr_text
+            "ocr_text": self.ocr_text,
+            "ocr_fingerprint": self.ocr_fingerprint
         }
     
     @classmethod
@@ -199,7 +239,8 @@ class Block:
             block_type=block_type,
             source=BlockSource(data["source"]),
             image_file=data.get("image_file"),
-            ocr_text=data.get("ocr_text")
+            ocr_text=data.get("ocr_text"),
+            ocr_fingerprint=data.get("ocr_fingerprint")
         )
 
 
@@ -5,17 +5,36 @@ OCR обработка через API движки
 
 import logging
 import json
-import base64
-import io
+import importlib.util
+import os
+import threading
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from pathlib import Path
-from typing import Protocol, List, Optional
+from typing import Callable, Dict, List, Mapping, Protocol, Optional, Sequence, Tuple, Union
 from PIL import Image
 from app.models import Block, BlockType
+from app.ocr_cache import backend_identity
+from app.image_encoding import DEFAULT_MAX_SIDE, encode_image
 
 logger = logging.getLogger(__name__)
 
 
-def image_to_base64(image: Image.Image, max_size: int = 1500) -> str:
+# HTTP/2 доступен только при установленном пакете h2 (pip install httpx[http2])
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+# Период проверки отмены, пока запросы OCRDispatcher выполняются, с
+CANCEL_POLL_INTERVAL = 0.5
+
+
+def _env_int(name: str, default: int) -> int:
+    """Целое из окружения с fallback на значение по умолчанию"""
+    try:
+        return max(1, int(os.getenv(name, default)))
+    except ValueError:
+        return default
+
+
+def image_to_base64(image: Image.Image, max_size: int = DEFAULT_MAX_SIDE) -> str:
     """
     Конвертировать PIL Image в base64 с опциональным ресайзом
     
@@ -24,16 +43,9 @@ def image_to_base64(image: Image.Image, max_size: int = 1500) -> str:
         max_size: максимальный размер стороны
     
     Returns:
-        Base64 строка
+        Base64 строка (PNG, см. app.image_encoding.encode_image)
     """
-    if image.width > max_size or image.height > max_size:
-        ratio = min(max_size / image.width, max_size / image.height)
-        new_size = (int(image.width * ratio), int(image.height * ratio))
-        image = image.resize(new_size, Image.LANCZOS)
-    
-    buffer = io.BytesIO()
-    image.save(buffer, format='PNG', optimize=True)
-    return base64.b64encode(buffer.getvalue()).decode('utf-8')
+    return encode_image(image, max_side=max_size).base64
 
 
 
@@ -55,23 +67,67 @@ class OCRBackend(Protocol):
             Распознанный текст
         """
         ...
+    
+    def close(self) -> None:
+        """Освободить сетевые ресурсы движка (пул соединений)"""
+        ...
 
 
 class LocalVLMBackend:
     """OCR через ngrok endpoint (проксирует в LM Studio)"""
     
+    # Одновременных запросов к серверу (LM Studio / vLLM обрабатывают несколько)
+    MAX_IN_FLIGHT = _env_int("LOCAL_VLM_MAX_IN_FLIGHT", 4)
+    
     DEFAULT_SYSTEM = "You are an expert design engineer and automation specialist. Your task is to analyze technical drawings and extract data into structured JSON or Markdown formats with 100% accuracy. Do not omit details. Do not hallucinate values."
     DEFAULT_USER = "Распознай содержимое изображения."
     
-    def __init__(self, api_base: str = None, model_name: str = "qwen3-vl-32b-instruct"):
+    def __init__(self, api_base: str = None, model_name: str = "qwen3-vl-32b-instruct",
+                 api_url: Optional[str] = None):
+        """
+        Args:
+            api_base: не используется (запросы идут на ngrok endpoint)
+            model_name: имя модели
+            api_url: полный URL chat/completions (по умолчанию get_lm_base_url())
+        """
         self.model_name = model_name
+        self.api_url = api_url
         try:
             import httpx
             self.httpx = httpx
         except ImportError:
             raise ImportError("Требуется установить httpx: pip install httpx")
+        self._client = None
+        self._client_lock = threading.Lock()
         logger.info(f"LocalVLM инициализирован (модель: {self.model_name})")
     
+    def _get_client(self):
+        """Долгоживущий клиент с keep-alive (одно TCP/TLS соединение на поток запросов)"""
+        with self._client_lock:
+            if self._client is None:
+                self._client = self.httpx.Client(
+                    timeout=600.0,
+                    http2=HTTP2_AVAILABLE,
+                    limits=self.httpx.Limits(
+                        max_connections=self.MAX_IN_FLIGHT * 2,
+                        max_keepalive_connections=self.MAX_IN_FLIGHT
+                    )
+                )
+            return self._client
+    
+    def close(self):
+        """Закрыть пул соединений"""
+        with self._client_lock:
+            if self._client is not None:
+                self._client.close()
+                self._client = None
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+    
     def recognize(self, image: Image.Image, prompt: Optional[dict] = None) -> str:
         """Распознать текст через ngrok endpoint"""
         try:
@@ -85,8 +141,8 @@ class LocalVLMBackend:
                 system_prompt = self.DEFAULT_SYSTEM
                 user_prompt = self.DEFAULT_USER
             
-            img_base64 = image_to_base64(image)
-            url = get_lm_base_url()
+            encoded = encode_image(image)
+            url = self.api_url or get_lm_base_url()
             
             payload = {
                 "model": self.model_name,
@@ -99,7 +155,7 @@ class LocalVLMBackend:
                         "role": "user",
                         "content": [
                             {"type": "text", "text": user_prompt},
-                            {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{img_base64}"}}
+                            {"type": "image_url", "image_url": {"url": encoded.data_url}}
                         ]
                     }
                 ],
@@ -110,10 +166,9 @@ class LocalVLMBackend:
                 "presence_penalty": 0.0
             }
             
-            with self.httpx.Client(timeout=600.0) as client:
-                response = client.post(url, json=payload)
-                response.raise_for_status()
-                result = response.json()
+            response = self._get_client().post(url, json=payload)
+            response.raise_for_status()
+            result = response.json()
             
             text = result.get("choices", [{}])[0].get("message", {}).get("content", "")
             if not text:
@@ -139,29 +194,59 @@ class OpenRouterBackend:
     
     _providers_cache: dict = {}  # Кэш провайдеров по моделям
     
+    # Одновременных запросов к OpenRouter
+    MAX_IN_FLIGHT = _env_int("OPENROUTER_MAX_IN_FLIGHT", 8)
+    
     DEFAULT_SYSTEM = "You are an expert design engineer and automation specialist. Your task is to analyze technical drawings and extract data into structured JSON or Markdown formats with 100% accuracy. Do not omit details. Do not hallucinate values."
     DEFAULT_USER = "Распознай содержимое изображения."
     
-    def __init__(self, api_key: str, model_name: str = "qwen/qwen3-vl-30b-a3b-instruct"):
+    DEFAULT_API_URL = "https://openrouter.ai/api/v1/chat/completions"
+    
+    def __init__(self, api_key: str, model_name: str = "qwen/qwen3-vl-30b-a3b-instruct",
+                 api_url: Optional[str] = None):
+        """
+        Args:
+            api_key: ключ OpenRouter
+            model_name: имя модели
+            api_url: URL chat/completions (по умолчанию OpenRouter)
+        """
         self.api_key = api_key
         self.model_name = model_name
+        self.api_url = api_url or self.DEFAULT_API_URL
         self._provider_order: Optional[List[str]] = None
         try:
             import requests
+            from requests.adapters import HTTPAdapter
             self.requests = requests
         except ImportError:
             raise ImportError("Требуется установить requests: pip install requests")
+        
+        # Session держит keep-alive соединения между запросами
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.MAX_IN_FLIGHT)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({"Authorization": f"Bearer {self.api_key}"})
         logger.info(f"OpenRouter инициализирован (модель: {self.model_name})")
     
+    def close(self):
+        """Закрыть пул соединений"""
+        self.session.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+    
     def _fetch_cheapest_providers(self) -> Optional[List[str]]:
         """Получить список провайдеров отсортированных по цене (от дешевого к дорогому)"""
         if self.model_name in OpenRouterBackend._providers_cache:
             return OpenRouterBackend._providers_cache[self.model_name]
         
         try:
-            response = self.requests.get(
+            response = self.session.get(
                 "https://openrouter.ai/api/v1/models",
-                headers={"Authorization": f"Bearer {self.api_key}"},
                 timeout=30
             )
             if response.status_code != 200:
@@ -228,7 +313,7 @@ class OpenRouterBackend:
             if self._provider_order is None:
                 self._provider_order = self._fetch_cheapest_providers() or []
             
-            image_b64 = image_to_base64(image)
+            encoded = encode_image(image)
             
             # Извлекаем system и user из промта
             if prompt and isinstance(prompt, dict):
@@ -249,7 +334,7 @@ class OpenRouterBackend:
                         "role": "user",
                         "content": [
                             {"type": "text", "text": user_prompt},
-                            {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{image_b64}"}}
+                            {"type": "image_url", "image_url": {"url": encoded.data_url}}
                         ]
                     }
                 ],
@@ -262,9 +347,8 @@ class OpenRouterBackend:
             if self._provider_order:
                 payload["provider"] = {"order": self._provider_order}
             
-            response = self.requests.post(
-                "https://openrouter.ai/api/v1/chat/completions",
-                headers={"Authorization": f"Bearer {self.api_key}", "Content-Type": "application/json"},
+            response = self.session.post(
+                self.api_url,
                 json=payload,
                 timeout=120
             )
@@ -288,17 +372,171 @@ class OpenRouterBackend:
 
 class DummyOCRBackend:
     """Заглушка для OCR"""
+    MAX_IN_FLIGHT = 1
+    
     def recognize(self, image: Image.Image, prompt: Optional[dict] = None) -> str:
         return "[OCR placeholder - OCR engine not configured]"
+    
+    def close(self):
+        pass
+
+
+def close_ocr_engines(*engines):
+    """Закрыть движки (одинаковые экземпляры закрываются один раз)"""
+    seen = set()
+    for engine in engines:
+        if engine is None or id(engine) in seen:
+            continue
+        seen.add(id(engine))
+        close = getattr(engine, "close", None)
+        if close:
+            try:
+                close()
+            except Exception as e:
+                logger.warning(f"Ошибка закрытия OCR движка: {e}")
+
+
+# Задача распознавания: (движок, изображение, промпт)
+OCRTask = Tuple[OCRBackend, Image.Image, Optional[dict]]
+
+
+class OCRDispatcher:
+    """
+    Параллельная отправка запросов recognize() с ограничением на движок
+    
+    Для каждого движка создаётся свой пул потоков размером MAX_IN_FLIGHT
+    (атрибут движка, по умолчанию 1), поэтому медленный движок картинок
+    не занимает слоты текстового. Результаты возвращаются в порядке задач.
+    
+    С result_cache (OCRResultCache) задачи, уже распознанные ранее с тем же
+    кропом, промптом и моделью, берутся из кеша без запроса к API.
+    
+    Использование:
+        with OCRDispatcher() as dispatcher:
+            results = dispatcher.run(tasks, progress_callback=on_progress)
+    """
+    
+    def __init__(self, result_cache=None):
+        self._executors: Dict[int, ThreadPoolExecutor] = {}
+        self._lock = threading.Lock()
+        self._cancelled = False
+        self.result_cache = result_cache
+    
+    def _executor_for(self, backend: OCRBackend) -> ThreadPoolExecutor:
+        key = id(backend)
+        with self._lock:
+            executor = self._executors.get(key)
+            if executor is None:
+                max_in_flight = max(1, getattr(backend, "MAX_IN_FLIGHT", 1))
+                executor = ThreadPoolExecutor(
+                    max_workers=max_in_flight,
+                    thread_name_prefix=f"ocr-{type(backend).__name__}"
+                )
+                self._executors[key] = executor
+            return executor
+    
+    def submit(self, backend: OCRBackend, image: Image.Image, prompt: Optional[dict] = None) -> Future:
+        """Поставить запрос в очередь движка"""
+        return self._executor_for(backend).submit(backend.recognize, image, prompt=prompt)
+    
+    def run(
+        self,
+        tasks: Sequence[OCRTask],
+        progress_callback: Optional[Callable[[int, int], None]] = None,
+        is_cancelled: Optional[Callable[[], bool]] = None
+    ) -> List[Union[str, Exception, None]]:
+        """
+        Выполнить задачи параллельно
+        
+        Args:
+            tasks: [(backend, image, prompt), ...]
+            progress_callback: (выполнено, всего) - вызывается в потоке вызывающего
+            is_cancelled: функция проверки отмены (невыполненные задачи снимаются)
+        
+        Returns:
+            Результаты в порядке tasks: текст, исключение или None (отменено)
+        """
+        results: List[Union[str, Exception, None]] = [None] * len(tasks)
+        keys: Dict[int, str] = {}
+        index_by_future: Dict[Future, int] = {}
+        
+        completed = 0
+        for i, (backend, image, prompt) in enumerate(tasks):
+            if self.result_cache is not None:
+                keys[i] = self.result_cache.make_key(image, prompt, backend_identity(backend))
+                cached = self.result_cache.get(keys[i])
+                if cached is not None:
+                    results[i] = cached
+                    completed += 1
+                    continue
+            index_by_future[self.submit(backend, image, prompt)] = i
+        
+        if completed:
+            logger.info(f"OCR кеш: {completed}/{len(tasks)} задач без запроса к API")
+            if progress_callback:
+                progress_callback(completed, len(tasks))
+        
+        # Отмена проверяется каждые CANCEL_POLL_INTERVAL, а не только по завершении запроса
+        pending = set(index_by_future)
+        while pending:
+            if is_cancelled and is_cancelled():
+                for future in pending:
+                    future.cancel()
+                self._cancelled = True
+                break
+            
+            done, pending = wait(pending, timeout=CANCEL_POLL_INTERVAL, return_when=FIRST_COMPLETED)
+            for future in done:
+                i = index_by_future[future]
+                if future.cancelled():
+                    continue
+                try:
+                    results[i] = future.result()
+                    if self.result_cache is not None:
+                        self.result_cache.put(keys[i], results[i])
+                except Exception as e:
+                    logger.error(f"OCR запрос {i} завершился ошибкой: {e}")
+                    results[i] = e
+                
+                completed += 1
+                if progress_callback:
+                    progress_callback(completed, len(tasks))
+        
+        return results
+    
+    def close(self):
+        """
+        Остановить пулы (ожидающие запросы снимаются)
+        
+        После отмены уже отправленные запросы не ожидаются: их потоки
+        завершатся сами, результаты отбрасываются.
+        """
+        with self._lock:
+            for executor in self._executors.values():
+                executor.shutdown(wait=not self._cancelled, cancel_futures=True)
+            self._executors.clear()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
 
 
 def run_ocr_for_blocks(blocks: List[Block], ocr_backend: OCRBackend, base_dir: str = "", 
                        image_description_backend: Optional[OCRBackend] = None,
                        index_file: Optional[str] = None,
-                       prompt_loader=None) -> None:
+                       prompt_loader=None,
+                       progress_callback: Optional[Callable[[int, int], None]] = None,
+                       is_cancelled: Optional[Callable[[], bool]] = None,
+                       result_cache=None,
+                       prompts=None) -> None:
     """
     Запустить OCR для блоков с учетом типа и категории
     
+    Запросы отправляются параллельно (OCRDispatcher, не больше MAX_IN_FLIGHT
+    на движок), результаты записываются в блоки в исходном порядке.
+    
     Args:
         blocks: список блоков для обработки
         ocr_backend: движок OCR для текста и таблиц
@@ -306,20 +544,34 @@ def run_ocr_for_blocks(blocks: List[Block], ocr_backend: OCRBackend, base_dir: s
         image_description_backend: движок для описания изображений (если None, используется ocr_backend)
         index_file: путь к файлу индекса для IMAGE блоков (если указан, создается индекс)
         prompt_loader: функция для загрузки промптов из R2 (принимает имя промпта, возвращает dict с system/user)
+        progress_callback: функция прогресса (выполнено, всего)
+        is_cancelled: функция проверки отмены
+        result_cache: OCRResultCache - блоки, распознанные ранее, не отправляются в API
+        prompts: PromptTable прогона (None - разрешается по prompt_loader один раз для всех блоков)
     """
-    processed = 0
     skipped = 0
     
+    if prompts is None and prompt_loader:
+        from app.prompt_resolver import resolve_prompts
+        prompts = resolve_prompts(blocks, prompt_loader)
+    
     # Если не указан специальный движок для изображений, используем основной
     if image_description_backend is None:
         image_description_backend = ocr_backend
     
+    # Подготовка задач: изображения и промпты
+    task_blocks = []
+    tasks = []
     for block in blocks:
         # Пропускаем блоки без image_file
         if not block.image_file:
             skipped += 1
             continue
         
+        if block.block_type not in (BlockType.IMAGE, BlockType.TABLE, BlockType.TEXT):
+            skipped += 1
+            continue
+        
         try:
             # Определяем полный путь к изображению
             image_path = Path(block.image_file)
@@ -333,53 +585,43 @@ def run_ocr_for_blocks(blocks: List[Block], ocr_backend: OCRBackend, base_dir: s
                 continue
             
             # Загружаем изображение
-            image = Image.open(image_path)
-            
-            # Получаем промпт из R2 (dict с system/user)
-            prompt_data = None
-            if prompt_loader:
-                # Сначала пытаемся загрузить промпт категории
-                if block.category:
-                    prompt_data = prompt_loader(f"category_{block.category}")
-                
-                # Если нет промпта категории, используем промпт типа блока
-                if not prompt_data:
-                    if block.block_type == BlockType.IMAGE:
-                        prompt_data = prompt_loader("image")
-                    elif block.block_type == BlockType.TABLE:
-                        prompt_data = prompt_loader("table")
-                    elif block.block_type == BlockType.TEXT:
-                        prompt_data = prompt_loader("text")
+            with Image.open(image_path) as img:
+                img.load()
+                image = img.copy()
+            
+            # Промпт из таблицы прогона (dict с system/user): категория, затем тип блока
+            prompt_data = prompts.prompt(block) if prompts is not None else None
             
             # Обрабатываем в зависимости от типа блока
-            if block.block_type == BlockType.IMAGE:
-                ocr_text = image_description_backend.recognize(image, prompt=prompt_data)
-                block.ocr_text = ocr_text
-                
-                # Если указан index_file, обновляем индекс
-                if index_file:
-                    from app.report_md import update_smart_index
-                    image_name = Path(block.image_file).name if block.image_file else f"block_{block.id}"
-                    update_smart_index(ocr_text, image_name, index_file)
-                
-                processed += 1
-                
-            elif block.block_type == BlockType.TABLE:
-                ocr_text = ocr_backend.recognize(image, prompt=prompt_data)
-                block.ocr_text = ocr_text
-                processed += 1
-                
-            elif block.block_type == BlockType.TEXT:
-                ocr_text = ocr_backend.recognize(image, prompt=prompt_data)
-                block.ocr_text = ocr_text
-                processed += 1
-            else:
-                skipped += 1
+            backend = image_description_backend if block.block_type == BlockType.IMAGE else ocr_backend
+            task_blocks.append(block)
+            tasks.append((backend, image, prompt_data))
             
         except Exception as e:
-            logger.error(f"Ошибка OCR для блока {block.id}: {e}")
+            logger.error(f"Ошибка подготовки OCR для блока {block.id}: {e}")
             skipped += 1
     
+    with OCRDispatcher(result_cache=result_cache) as dispatcher:
+        results = dispatcher.run(tasks, progress_callback=progress_callback, is_cancelled=is_cancelled)
+    
+    # Результаты применяются в исходном порядке блоков (индекс обновляется последовательно)
+    processed = 0
+    for block, result in zip(task_blocks, results):
+        if result is None or isinstance(result, Exception):
+            if isinstance(result, Exception):
+                logger.error(f"Ошибка OCR для блока {block.id}: {result}")
+            skipped += 1
+            continue
+        
+        block.ocr_text = result
+        processed += 1
+        
+        # Если указан index_file, обновляем индекс
+        if block.block_type == BlockType.IMAGE and index_file:
+            from app.report_md import update_smart_index
+            image_name = Path(block.image_file).name if block.image_file else f"block_{block.id}"
+            update_smart_index(result, image_name, index_file)
+    
     logger.info(f"OCR завершён: {processed} блоков обработано, {skipped} пропущено")
 
 
@@ -482,12 +724,13 @@ def generate_structured_markdown(pages: List, output_path: str, images_dir: str
         raise
 
 
-def run_local_vlm_full_document(page_images: dict, output_path: str, api_base: str = None, model_name: str = "qwen3-vl-32b-instruct") -> str:
+def run_local_vlm_full_document(page_images, output_path: str, api_base: str = None, model_name: str = "qwen3-vl-32b-instruct") -> str:
     """
     Распознать весь документ через локальный VLM сервер
     
     Args:
-        page_images: словарь {page_num: PIL.Image}
+        page_images: словарь {page_num: PIL.Image} или итератор пар (page_num, PIL.Image)
+            (страницы по одной, без загрузки всего документа в память)
         output_path: путь для сохранения результата
         api_base: URL VLM сервера
         model_name: имя модели
@@ -496,24 +739,24 @@ def run_local_vlm_full_document(page_images: dict, output_path: str, api_base: s
         Путь к сохраненному файлу
     """
     try:
-        logger.info(f"Запуск LocalVLM OCR для {len(page_images)} страниц")
+        if isinstance(page_images, Mapping):
+            page_images = sorted(page_images.items())
+        logger.info("Запуск LocalVLM OCR для документа")
         
         output_file = Path(output_path)
         output_file.parent.mkdir(parents=True, exist_ok=True)
         
-        # Создаем движок
-        vlm = LocalVLMBackend(api_base=api_base, model_name=model_name)
-        
         # Обрабатываем страницы
         markdown_parts = []
         
-        for page_num in sorted(page_images.keys()):
-            logger.info(f"Обработка страницы {page_num + 1}/{len(page_images)}")
-            image = page_images[page_num]
-            
-            # Распознаем страницу
-            page_text = vlm.recognize(image)
-            markdown_parts.append(f"# Страница {page_num + 1}\n\n{page_text}\n\n---\n\n")
+        # Движок с пулом соединений на весь документ
+        with LocalVLMBackend(api_base=api_base, model_name=model_name) as vlm:
+            for page_num, image in page_images:
+                logger.info(f"Обработка страницы {page_num + 1}")
+                
+                # Распознаем страницу
+                page_text = vlm.recognize(image)
+                markdown_parts.append(f"# Страница {page_num + 1}\n\n{page_text}\n\n---\n\n")
         
         # Объединяем результаты
         full_markdown = "".join(markdown_parts)
@@ -2,17 +2,26 @@
 Оптимизированный Batch OCR с экономией токенов
 - Группировка блоков по промпту
 - Multi-image batching
+- Размер батча по бюджету токенов изображений и наблюдаемой задержке
 - Сохранение контекста между запросами
 """
 
 import logging
-import base64
-import io
-from typing import List, Dict, Optional, Tuple
+import json
+import math
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import Callable, Iterable, Iterator, List, Dict, Optional, Tuple
 from dataclasses import dataclass, field
 from collections import defaultdict
 from PIL import Image
 from app.models import Block, BlockType
+from app.image_encoding import encode_image
+from app.prompt_resolver import PromptTable, TYPE_PROMPTS
 
 logger = logging.getLogger(__name__)
 
@@ -33,21 +42,63 @@ class BatchGroup:
     items: List[BatchItem] = field(default_factory=list)
 
 
-def image_to_base64_optimized(image: Image.Image, max_size: int = 1200, quality: int = 85) -> str:
-    """Оптимизированная конвертация: меньший размер = меньше токенов на изображение"""
-    if image.width > max_size or image.height > max_size:
-        ratio = min(max_size / image.width, max_size / image.height)
-        new_size = (int(image.width * ratio), int(image.height * ratio))
-        image = image.resize(new_size, Image.LANCZOS)
-    
-    # JPEG меньше PNG для фото, PNG лучше для текста/схем
-    buffer = io.BytesIO()
-    if image.mode in ('RGBA', 'LA'):
-        image.save(buffer, format='PNG', optimize=True)
-    else:
-        image = image.convert('RGB')
-        image.save(buffer, format='JPEG', quality=quality, optimize=True)
-    return base64.b64encode(buffer.getvalue()).decode('utf-8')
+# Сторона патча vision-энкодера (Qwen2/3-VL: 14px патчи, слияние 2x2 → 28px на токен)
+IMAGE_PATCH_SIZE = 28
+
+# Служебные токены на изображение (vision start/end, подпись "[N] Страница")
+IMAGE_TOKEN_OVERHEAD = 16
+
+# Максимальная сторона изображения при отправке (encode_image)
+MAX_IMAGE_SIDE = 1200
+
+
+# Схема структурированного ответа батча (response_format: json_schema)
+BATCH_RESPONSE_SCHEMA = {
+    "name": "batch_ocr",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {
+            "results": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "index": {"type": "integer", "description": "номер изображения [n], с 1"},
+                        "text": {"type": "string", "description": "результат распознавания"}
+                    },
+                    "required": ["index", "text"],
+                    "additionalProperties": False
+                }
+            }
+        },
+        "required": ["results"],
+        "additionalProperties": False
+    }
+}
+
+
+class ResponseFormatRejected(Exception):
+    """Сервер не принял response_format (400/422) - запрос нужно повторить текстом"""
+
+
+def estimate_image_tokens(size: Tuple[int, int], max_size: int = MAX_IMAGE_SIDE) -> int:
+    """
+    Оценка числа токенов изображения после уменьшения до max_size
+    
+    Args:
+        size: (width, height) исходного кропа
+        max_size: максимальная сторона при отправке
+    
+    Returns:
+        Примерное число входных токенов (патчи 28x28 + служебные)
+    """
+    width, height = size
+    if width > max_size or height > max_size:
+        ratio = min(max_size / width, max_size / height)
+        width, height = int(width * ratio), int(height * ratio)
+    patches = math.ceil(max(width, 1) / IMAGE_PATCH_SIZE) * math.ceil(max(height, 1) / IMAGE_PATCH_SIZE)
+    return patches + IMAGE_TOKEN_OVERHEAD
 
 
 class BatchOCREngine:
@@ -58,22 +109,67 @@ class BatchOCREngine:
     1. Группировка по промпту → 1 system prompt на группу
     2. Multi-image в одном запросе → меньше overhead
     3. Контекст между группами → модель "помнит" предыдущее
+       (при параллельной обработке - по блокам до текущей волны)
+    4. Ответ батча по JSON схеме (response_format) → результаты по индексу
+       изображения; повторно отправляются только изображения без результата
+    
+    Размер батча: изображения добавляются, пока сумма их токенов
+    (estimate_image_tokens) не превысит token_budget, но не больше текущего
+    лимита. Лимит стартует с MAX_IMAGES_PER_REQUEST: ошибки разбора ответа
+    уменьшают его вдвое, медленные батчи (дольше target_latency) - на 1,
+    ADAPT_STREAK успешных батчей подряд увеличивают на 1 (до MAX_IMAGES_LIMIT).
     """
     
-    MAX_IMAGES_PER_REQUEST = 4  # Оптимально для большинства VLM
+    MAX_IMAGES_PER_REQUEST = 4  # Стартовый лимит изображений в запросе
+    MAX_IMAGES_LIMIT = 8        # Потолок адаптивного лимита
     MAX_CONTEXT_TOKENS = 8000   # Резерв под контекст предыдущих результатов
     
-    def __init__(self, api_client, model_name: str, use_context: bool = True):
+    DEFAULT_TOKEN_BUDGET = 12000     # Токенов изображений на запрос (BATCH_TOKEN_BUDGET)
+    DEFAULT_TARGET_LATENCY = 90.0    # Секунд на запрос (BATCH_TARGET_LATENCY)
+    MAX_OUTPUT_TOKENS = 16384        # Потолок max_tokens запроса
+    ADAPT_STREAK = 2                 # Успешных батчей подряд для увеличения лимита
+    DEFAULT_PARALLEL_GROUPS = 1      # Частей групп в волне (BATCH_PARALLEL_GROUPS)
+    
+    def __init__(
+        self,
+        api_client,
+        model_name: str,
+        use_context: bool = True,
+        result_cache=None,
+        token_budget: Optional[int] = None,
+        target_latency: Optional[float] = None,
+        structured_output: Optional[bool] = None,
+        parallel_groups: Optional[int] = None
+    ):
         """
         Args:
             api_client: HTTP клиент (httpx или requests)
             model_name: Имя модели
             use_context: Сохранять контекст между группами
+            result_cache: OCRResultCache - блоки, распознанные ранее, не отправляются в API
+            token_budget: токенов изображений на запрос (None - из BATCH_TOKEN_BUDGET)
+            target_latency: желаемое время запроса, с (None - из BATCH_TARGET_LATENCY)
+            structured_output: ответ батча по JSON схеме (None - из BATCH_STRUCTURED_OUTPUT, по умолчанию да)
+            parallel_groups: одновременных запросов в process_in_waves (None - из BATCH_PARALLEL_GROUPS)
         """
         self.api_client = api_client
         self.model_name = model_name
         self.use_context = use_context
+        self.result_cache = result_cache
+        self.token_budget = token_budget or int(os.getenv("BATCH_TOKEN_BUDGET", self.DEFAULT_TOKEN_BUDGET))
+        self.target_latency = target_latency or float(os.getenv("BATCH_TARGET_LATENCY", self.DEFAULT_TARGET_LATENCY))
+        if structured_output is None:
+            structured_output = os.getenv("BATCH_STRUCTURED_OUTPUT", "1").lower() not in ("0", "false", "no")
+        self.structured_output = structured_output
+        self.parallel_groups = max(1, parallel_groups or int(os.getenv("BATCH_PARALLEL_GROUPS", self.DEFAULT_PARALLEL_GROUPS)))
         self._context_summary = ""  # Краткое резюме предыдущих результатов
+        
+        # Адаптивный лимит и статистика прогона (общие для параллельных групп)
+        self._lock = threading.Lock()
+        self.batch_limit = self.MAX_IMAGES_PER_REQUEST
+        self._success_streak = 0
+        self.stats = {"batches": 0, "images": 0, "image_tokens": 0, "parse_failures": 0,
+                      "batch_errors": 0, "seconds": 0.0}
     
     def group_blocks_by_prompt(
         self, 
@@ -113,8 +209,57 @@ class BatchOCREngine:
         logger.info(f"Сгруппировано {len(blocks_with_crops)} блоков в {len(groups)} последовательных групп")
         return groups
     
+    def iter_group_batches(
+        self,
+        blocks_with_crops: Iterable[Tuple[Block, Image.Image, int]],
+        prompt_loader
+    ) -> Iterator[Tuple[BatchGroup, bool]]:
+        """
+        Потоковая группировка: то же, что group_blocks_by_prompt, но группа
+        отдаётся частями размером в батч, как только часть набрана.
+        В памяти - только кропы текущего батча.
+        
+        Yields:
+            (часть группы, последняя ли это часть группы)
+        """
+        current: Optional[BatchGroup] = None
+        groups = 0
+        blocks = 0
+        
+        for block, crop, page_num in blocks_with_crops:
+            blocks += 1
+            prompt_key, prompt_text = self._get_prompt_key(block, prompt_loader)
+            
+            if current is not None and current.prompt_key != prompt_key:
+                yield current, True
+                current = None
+            
+            if current is None:
+                current = BatchGroup(prompt_key=prompt_key, prompt_text=prompt_text)
+                groups += 1
+            elif self._batch_full(current.items):
+                # Группа продолжается - отдаём набранный батч
+                yield current, False
+                current = BatchGroup(prompt_key=prompt_key, prompt_text=prompt_text)
+            
+            current.items.append(BatchItem(block=block, crop=crop, page_num=page_num))
+        
+        if current is not None:
+            yield current, True
+        
+        logger.info(f"Сгруппировано {blocks} блоков в {groups} последовательных групп")
+    
     def _get_prompt_key(self, block: Block, prompt_loader) -> Tuple[str, str]:
-        """Получить ключ и текст промпта для блока"""
+        """
+        Получить ключ и текст промпта для блока
+        
+        prompt_loader - PromptTable прогона (см. app.prompt_resolver) или
+        функция загрузки промпта по имени
+        """
+        if isinstance(prompt_loader, PromptTable):
+            resolved = prompt_loader.for_block(block)
+            return resolved.key, resolved.prompt or self._default_prompt(block.block_type)
+        
         # Приоритет 1: категория
         if block.category and block.category.strip():
             cat_key = f"category_{block.category.strip()}"
@@ -123,12 +268,7 @@ class BatchOCREngine:
                 return cat_key, prompt_text
         
         # Приоритет 2: тип блока
-        type_map = {
-            BlockType.IMAGE: "image",
-            BlockType.TABLE: "table",
-            BlockType.TEXT: "text",
-        }
-        type_key = type_map.get(block.block_type, "text")
+        type_key = TYPE_PROMPTS.get(block.block_type, "text")
         prompt_text = prompt_loader(type_key) if prompt_loader else self._default_prompt(block.block_type)
         return f"type_{type_key}", prompt_text or self._default_prompt(block.block_type)
     
@@ -140,30 +280,63 @@ class BatchOCREngine:
         self, 
         group: BatchGroup, 
         api_url: str,
-        on_progress: callable = None
+        on_progress: callable = None,
+        update_context: bool = True,
+        context: Optional[str] = None
     ) -> Dict[str, str]:
         """
         Обработка группы с batching изображений
         
+        Args:
+            group: группа (или её часть из iter_group_batches)
+            api_url: адрес chat/completions
+            on_progress: (обработано, всего в группе)
+            update_context: обновить контекст документа (после последней части группы)
+            context: контекст документа для запросов (None - текущий; задаётся
+                явно при параллельной обработке, см. process_in_waves)
+        
         Returns:
             Dict[block_id -> ocr_text]
         """
         results = {}
         items = group.items
         
-        # Разбиваем на батчи
-        for batch_start in range(0, len(items), self.MAX_IMAGES_PER_REQUEST):
-            batch = items[batch_start:batch_start + self.MAX_IMAGES_PER_REQUEST]
+        # Кропы, уже распознанные с тем же промптом и моделью, берём из кеша
+        cache_keys = {}
+        if self.result_cache is not None:
+            pending = []
+            for item in items:
+                key = self._cache_key(item, group.prompt_text)
+                cached = self.result_cache.get(key)
+                if cached is not None:
+                    results[item.block.id] = cached
+                else:
+                    cache_keys[id(item)] = key
+                    pending.append(item)
+            if len(pending) < len(items):
+                logger.info(f"Batch OCR: {len(items) - len(pending)}/{len(items)} блоков группы из кеша")
+            items = pending
+        
+        cached_count = len(group.items) - len(items)
+        if cached_count and on_progress:
+            on_progress(cached_count, len(group.items))
+        
+        # Разбиваем на батчи по бюджету токенов и текущему лимиту
+        batch_start = 0
+        while batch_start < len(items):
+            batch = self._take_batch(items, batch_start)
+            started = time.monotonic()
             
             try:
-                batch_results = self._process_batch(batch, group.prompt_text, api_url)
+                batch_results, parse_failures = self._process_batch(
+                    batch, group.prompt_text, api_url, context=context
+                )
                 results.update(batch_results)
-                
-                if on_progress:
-                    on_progress(batch_start + len(batch), len(items))
+                self._adapt(batch, time.monotonic() - started, parse_failures, failed=False)
                     
             except Exception as e:
                 logger.error(f"Ошибка batch OCR: {e}")
+                self._adapt(batch, time.monotonic() - started, 0, failed=True)
                 # Fallback: обрабатываем по одному
                 for item in batch:
                     try:
@@ -171,33 +344,259 @@ class BatchOCREngine:
                         results[item.block.id] = single_result
                     except Exception as e2:
                         results[item.block.id] = f"[Error: {e2}]"
+            
+            batch_start += len(batch)
+            if on_progress:
+                on_progress(cached_count + batch_start, len(group.items))
+            
+            if self.result_cache is not None:
+                for item in batch:
+                    self.result_cache.put(cache_keys[id(item)], results.get(item.block.id))
         
         # Обновляем контекст для следующей группы
-        if self.use_context and results:
+        if self.use_context and update_context and results:
             self._update_context_summary(group.prompt_key, results)
         
         return results
     
+    def process_in_waves(
+        self,
+        group_batches: Iterable[Tuple[BatchGroup, bool]],
+        api_url: str,
+        parallel: Optional[int] = None,
+        on_items_done: Optional[Callable[[int], None]] = None,
+        is_cancelled: Optional[Callable[[], bool]] = None
+    ) -> Iterator[Tuple[BatchGroup, bool, Dict[str, str]]]:
+        """
+        Параллельная обработка групп волнами
+        
+        В волну берутся до parallel следующих частей групп (iter_group_batches);
+        все они получают контекст документа на начало волны, то есть только по
+        предшествующим блокам. После волны контекст обновляется в порядке
+        документа. parallel=1 - прежняя последовательная обработка.
+        
+        Args:
+            group_batches: (часть группы, последняя ли часть) в порядке документа
+            api_url: адрес chat/completions
+            parallel: частей групп в волне (None - parallel_groups)
+            on_items_done: число обработанных блоков (вызывается из потоков пула)
+            is_cancelled: функция проверки отмены (между волнами)
+        
+        Yields:
+            (часть группы, последняя ли часть, {block_id: текст}) в порядке документа
+        """
+        parallel = max(1, parallel or self.parallel_groups)
+        batches = iter(group_batches)
+        
+        with ThreadPoolExecutor(max_workers=parallel, thread_name_prefix="batch-ocr") as pool:
+            while True:
+                if is_cancelled and is_cancelled():
+                    return
+                wave = list(islice(batches, parallel))
+                if not wave:
+                    return
+                
+                context = self._context_summary
+                futures = []
+                for group, _ in wave:
+                    reported = [0]
+                    
+                    def on_progress(current, total, reported=reported):
+                        if on_items_done:
+                            on_items_done(current - reported[0])
+                        reported[0] = current
+                    
+                    futures.append(pool.submit(
+                        self.process_group_batched, group, api_url, on_progress,
+                        update_context=False, context=context
+                    ))
+                
+                for (group, group_end), future in zip(wave, futures):
+                    results = future.result()
+                    if self.use_context and group_end and results:
+                        self._update_context_summary(group.prompt_key, results)
+                    yield group, group_end, results
+    
+    def _item_tokens(self, item: BatchItem) -> int:
+        return estimate_image_tokens(item.crop.size)
+    
+    def _batch_full(self, items: List[BatchItem]) -> bool:
+        """Набран ли батч (лимит изображений или бюджет токенов)"""
+        return (len(items) >= self.batch_limit
+                or sum(self._item_tokens(item) for item in items) >= self.token_budget)
+    
+    def _take_batch(self, items: List[BatchItem], start: int) -> List[BatchItem]:
+        """Следующий батч: не больше batch_limit изображений и token_budget токенов (минимум 1)"""
+        batch = []
+        tokens = 0
+        for item in items[start:]:
+            item_tokens = self._item_tokens(item)
+            if batch and (len(batch) >= self.batch_limit or tokens + item_tokens > self.token_budget):
+                break
+            batch.append(item)
+            tokens += item_tokens
+        return batch
+    
+    def _adapt(self, batch: List[BatchItem], elapsed: float, parse_failures: int, failed: bool):
+        """Подстроить лимит изображений по результату батча"""
+        with self._lock:
+            self._adapt_locked(batch, elapsed, parse_failures, failed)
+    
+    def _adapt_locked(self, batch: List[BatchItem], elapsed: float, parse_failures: int, failed: bool):
+        self.stats["batches"] += 1
+        self.stats["images"] += len(batch)
+        self.stats["image_tokens"] += sum(self._item_tokens(item) for item in batch)
+        self.stats["parse_failures"] += parse_failures
+        self.stats["batch_errors"] += int(failed)
+        self.stats["seconds"] += elapsed
+        
+        previous = self.batch_limit
+        if len(batch) > 1 and (failed or parse_failures):
+            # Модель не справилась с несколькими изображениями - резко уменьшаем
+            self.batch_limit = max(1, len(batch) // 2)
+            self._success_streak = 0
+        elif elapsed > self.target_latency:
+            # Медленным был полный батч - уменьшаем; неполный (конец группы, бюджет
+            # токенов, одно тяжёлое изображение) о размере батча ничего не говорит
+            if len(batch) >= self.batch_limit:
+                self.batch_limit = max(1, self.batch_limit - 1)
+            self._success_streak = 0
+        elif not failed and not parse_failures:
+            self._success_streak += 1
+            # Растём, только если батч упёрся в лимит (а не в бюджет или конец группы)
+            if self._success_streak >= self.ADAPT_STREAK and len(batch) >= self.batch_limit:
+                self.batch_limit = min(self.MAX_IMAGES_LIMIT, self.batch_limit + 1)
+                self._success_streak = 0
+        
+        if self.batch_limit != previous:
+            logger.info(f"Batch OCR: лимит изображений {previous} → {self.batch_limit} "
+                        f"({elapsed:.1f} с, ошибок разбора {parse_failures}{', ошибка запроса' if failed else ''})")
+    
+    def log_stats(self):
+        """Записать статистику батчей прогона в лог"""
+        stats = self.stats
+        if not stats["batches"]:
+            return
+        logger.info(
+            f"Batch OCR: {stats['batches']} запросов, в среднем {stats['images'] / stats['batches']:.1f} изобр. "
+            f"и {stats['image_tokens'] // stats['batches']} токенов изображений, "
+            f"{stats['seconds'] / stats['batches']:.1f} с на запрос; ошибок разбора {stats['parse_failures']}, "
+            f"ошибок запросов {stats['batch_errors']}; итоговый лимит {self.batch_limit}"
+        )
+    
+    def _output_tokens(self, batch: List[BatchItem]) -> int:
+        """max_tokens ответа: по размеру изображений (текст ~ площади), не больше MAX_OUTPUT_TOKENS"""
+        per_image = [min(4096, max(1024, self._item_tokens(item))) for item in batch]
+        return min(self.MAX_OUTPUT_TOKENS, sum(per_image))
+    
+    def _cache_key(self, item: BatchItem, prompt_text: str) -> str:
+        """Ключ кеша результата: кроп + промпт группы + модель"""
+        return self.result_cache.make_key(item.crop, prompt_text, "BatchOCREngine", self.model_name)
+    
     def _process_batch(
         self, 
         batch: List[BatchItem], 
         prompt_text: str, 
-        api_url: str
-    ) -> Dict[str, str]:
-        """Обработка батча изображений одним запросом"""
+        api_url: str,
+        retry_missing: bool = True,
+        context: Optional[str] = None
+    ) -> Tuple[Dict[str, str], int]:
+        """
+        Обработка батча изображений одним запросом
+        
+        Ответ разбирается по индексам изображений (JSON или [n]); изображения,
+        для которых результата нет, повторяются одним меньшим запросом, а если
+        и он их не вернул - по одному (_process_single).
+        
+        Returns:
+            ({block_id: текст}, число изображений без результата в ответе)
+        """
+        if len(batch) == 1:
+            payload = self._build_payload(batch, prompt_text, False, context)
+            return {batch[0].block.id: self._request(payload, api_url, 1)}, 0
+        
+        parsed = None
+        response_text = None
+        if self.structured_output:
+            try:
+                response_text = self._request(self._build_payload(batch, prompt_text, True, context), api_url, len(batch))
+            except ResponseFormatRejected:
+                pass
+            else:
+                parsed = self._parse_structured_response(response_text, len(batch))
+                if parsed is None:
+                    logger.warning("Batch OCR: ответ не соответствует JSON схеме, разбор по [n]")
+        if parsed is None:
+            if response_text is None:
+                # Текстовый режим (или сервер отклонил response_format)
+                response_text = self._request(self._build_payload(batch, prompt_text, False, context), api_url, len(batch))
+            parsed = self._split_indexed_response(response_text, len(batch))
+        
+        results = {batch[i].block.id: text for i, text in parsed.items()}
+        missing = [item for i, item in enumerate(batch) if i not in parsed]
+        parse_failures = len(missing)
+        if not missing:
+            return results, 0
+        
+        logger.warning(f"Batch OCR: нет результата для {len(missing)}/{len(batch)} изображений, повтор только их")
+        if retry_missing and len(missing) > 1:
+            try:
+                retried, _ = self._process_batch(missing, prompt_text, api_url, retry_missing=False, context=context)
+                results.update(retried)
+            except Exception as e:
+                logger.error(f"Ошибка повторного batch OCR: {e}")
+            missing = [item for item in missing if item.block.id not in results]
+        
+        for item in missing:
+            try:
+                results[item.block.id] = self._process_single(item, prompt_text, api_url)
+            except Exception as e:
+                results[item.block.id] = f"[Error: {e}]"
+        
+        # В порядке батча (последний результат идёт в контекст документа)
+        return {item.block.id: results[item.block.id] for item in batch}, parse_failures
+
+    @staticmethod
+    def _encode(item: BatchItem):
+        """Кодировка кропа (повтор после сбоя батча переиспользует её)"""
+        return encode_image(
+            item.crop,
+            block_type=item.block.block_type.value,
+            max_side=MAX_IMAGE_SIDE,
+            block_id=item.block.id
+        )
+
+    def _build_payload(self, batch: List[BatchItem], prompt_text: str, structured: bool,
+                       context: Optional[str] = None) -> dict:
+        """
+        Запрос chat/completions для батча
+        
+        Args:
+            structured: ответ по JSON схеме
+            context: контекст документа (None - текущий _context_summary)
+        """
+        if context is None:
+            context = self._context_summary
         
         # Формируем контент с несколькими изображениями
         content_parts = []
         
         # Добавляем контекст если есть
-        if self.use_context and self._context_summary:
+        if self.use_context and context:
             content_parts.append({
                 "type": "text",
-                "text": f"[Контекст документа: {self._context_summary}]\n\n"
+                "text": f"[Контекст документа: {context}]\n\n"
             })
         
         # Инструкция
-        if len(batch) > 1:
+        if len(batch) > 1 and structured:
+            content_parts.append({
+                "type": "text",
+                "text": f"{prompt_text}\n\nОбработай {len(batch)} изображений. "
+                        f"Ответ - JSON: {{\"results\": [{{\"index\": 1, \"text\": \"результат первого\"}}, ...]}}, "
+                        f"по одному элементу на каждое изображение, index - номер изображения [n]."
+            })
+        elif len(batch) > 1:
             content_parts.append({
                 "type": "text",
                 "text": f"{prompt_text}\n\nОбработай {len(batch)} изображений. "
@@ -208,15 +607,14 @@ class BatchOCREngine:
         
         # Добавляем изображения
         for i, item in enumerate(batch):
-            img_b64 = image_to_base64_optimized(item.crop)
-            format_hint = "png" if item.crop.mode in ('RGBA', 'LA') else "jpeg"
+            encoded = self._encode(item)
             
             if len(batch) > 1:
                 content_parts.append({"type": "text", "text": f"\n[{i+1}] Страница {item.page_num + 1}:"})
             
             content_parts.append({
                 "type": "image_url",
-                "image_url": {"url": f"data:image/{format_hint};base64,{img_b64}"}
+                "image_url": {"url": encoded.data_url}
             })
         
         payload = {
@@ -231,32 +629,70 @@ class BatchOCREngine:
                     "content": content_parts
                 }
             ],
-            "max_tokens": 4096 * len(batch),  # Масштабируем под количество
+            "max_tokens": self._output_tokens(batch),  # По размеру изображений батча
             "temperature": 0.1,
         }
+        if len(batch) > 1 and structured:
+            payload["response_format"] = {"type": "json_schema", "json_schema": BATCH_RESPONSE_SCHEMA}
+        return payload
+    
+    def _request(self, payload: dict, api_url: str, count: int) -> str:
+        """
+        Отправить запрос и вернуть текст ответа
         
-        response = self.api_client.post(api_url, json=payload, timeout=120 * len(batch))
-        response.raise_for_status()
-        
-        result_text = response.json()["choices"][0]["message"]["content"].strip()
+        Сервер без поддержки response_format (400/422) переводит движок
+        в текстовый режим до конца прогона.
         
-        # Парсим результат
-        return self._parse_batch_response(batch, result_text)
+        Raises:
+            ResponseFormatRejected: response_format отклонён, запрос нужно повторить без схемы
+        """
+        response = self.api_client.post(api_url, json=payload, timeout=120 * count)
+        if "response_format" in payload and response.status_code in (400, 422):
+            logger.warning(f"Batch OCR: сервер не принял response_format ({response.status_code}), "
+                           f"переход на текстовый формат [n]")
+            self.structured_output = False
+            raise ResponseFormatRejected(f"HTTP {response.status_code}")
+        response.raise_for_status()
+        return response.json()["choices"][0]["message"]["content"].strip()
     
-    def _parse_batch_response(
-        self, 
-        batch: List[BatchItem], 
-        response_text: str
-    ) -> Dict[str, str]:
-        """Парсинг ответа с несколькими результатами"""
-        results = {}
+    @staticmethod
+    def _parse_structured_response(response_text: str, count: int) -> Optional[Dict[int, str]]:
+        """
+        Разбор JSON ответа {"results": [{"index": n, "text": "..."}]}
         
-        if len(batch) == 1:
-            results[batch[0].block.id] = response_text
-            return results
+        Returns:
+            {индекс изображения (с 0): текст} для валидных элементов
+            или None, если ответ не JSON нужной формы
+        """
+        text = response_text.strip()
+        # Модели иногда оборачивают JSON в ```json ... ```
+        fence = re.match(r"^```(?:json)?\s*(.*?)\s*```$", text, re.DOTALL)
+        if fence:
+            text = fence.group(1)
+        try:
+            data = json.loads(text)
+        except ValueError:
+            return None
         
-        # Разбиваем по маркерам [1], [2], ...
-        import re
+        entries = data.get("results") if isinstance(data, dict) else data
+        if not isinstance(entries, list):
+            return None
+        
+        parsed = {}
+        for entry in entries:
+            if not isinstance(entry, dict) or not isinstance(entry.get("text"), str):
+                continue
+            try:
+                idx = int(entry.get("index")) - 1
+            except (TypeError, ValueError):
+                continue
+            if 0 <= idx < count and idx not in parsed:
+                parsed[idx] = entry["text"].strip()
+        return parsed
+    
+    @staticmethod
+    def _split_indexed_response(response_text: str, count: int) -> Dict[int, str]:
+        """Разбор текстового ответа по маркерам [1], [2], ... → {индекс (с 0): текст}"""
         parts = re.split(r'\n?\[(\d+)\]\s*', response_text)
         
         # parts = ['', '1', 'text1', '2', 'text2', ...]
@@ -264,18 +700,9 @@ class BatchOCREngine:
         for i in range(1, len(parts) - 1, 2):
             idx = int(parts[i]) - 1
             text = parts[i + 1].strip()
-            if 0 <= idx < len(batch):
+            if 0 <= idx < count and idx not in parsed:
                 parsed[idx] = text
-        
-        # Присваиваем результаты
-        for i, item in enumerate(batch):
-            if i in parsed:
-                results[item.block.id] = parsed[i]
-            else:
-                # Если парсинг не удался, берем весь текст для первого
-                results[item.block.id] = response_text if i == 0 else "[Parsing error]"
-        
-        return results
+        return parsed
     
     def _process_single(
         self, 
@@ -284,8 +711,7 @@ class BatchOCREngine:
         api_url: str
     ) -> str:
         """Fallback: обработка одного изображения"""
-        img_b64 = image_to_base64_optimized(item.crop)
-        format_hint = "png" if item.crop.mode in ('RGBA', 'LA') else "jpeg"
+        encoded = self._encode(item)
         
         payload = {
             "model": self.model_name,
@@ -295,7 +721,7 @@ class BatchOCREngine:
                     "role": "user",
                     "content": [
                         {"type": "text", "text": prompt_text},
-                        {"type": "image_url", "image_url": {"url": f"data:image/{format_hint};base64,{img_b64}"}}
+                        {"type": "image_url", "image_url": {"url": encoded.data_url}}
                     ]
                 }
             ],
@@ -0,0 +1,249 @@
+"""
+Кеш результатов OCR (content-addressed)
+Ключ - хеш пикселей кропа + промпт + движок + модель, поэтому повторный
+прогон после правки одного блока отправляет в API только изменённые блоки.
+Хранилище - SQLite рядом с папками результатов, вытеснение по размеру (LRU).
+"""
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Optional
+from PIL import Image
+
+from app.models import is_cacheable
+
+logger = logging.getLogger(__name__)
+
+# Имя файла кеша (лежит в базовой папке результатов, общей для всех прогонов)
+CACHE_FILENAME = ".ocr_cache.sqlite"
+
+# Лимит размера кеша по умолчанию (переопределяется через OCR_CACHE_MAX_MB)
+DEFAULT_CACHE_MAX_MB = 256
+
+# Ожидание блокировки SQLite другим процессом (python -m app.cli -j N), секунд
+BUSY_TIMEOUT = 10.0
+
+
+def backend_identity(backend: Any) -> str:
+    """Идентификатор движка для ключа кеша: класс + модель"""
+    model_name = getattr(backend, "model_name", "") or ""
+    return f"{type(backend).__name__}:{model_name}"
+
+
+class OCRResultCache:
+    """
+    Персистентный кеш результатов OCR
+
+    Потокобезопасен: одно соединение SQLite под общей блокировкой
+    (запросы к кешу на порядки быстрее сетевых вызовов). Файл может быть
+    общим для нескольких процессов: журнал WAL и busy_timeout, а ошибка
+    SQLite в get/put считается промахом кеша и не прерывает OCR.
+
+    Использование:
+        cache = OCRResultCache("results/.ocr_cache.sqlite")
+        key = cache.make_key(crop, prompt, backend_identity(engine))
+        text = cache.get(key)
+        if text is None:
+            text = engine.recognize(crop, prompt=prompt)
+            cache.put(key, text)
+    """
+
+    def __init__(self, db_path: str, max_bytes: Optional[int] = None):
+        """
+        Args:
+            db_path: путь к файлу SQLite
+            max_bytes: лимит суммарного размера результатов (None - из OCR_CACHE_MAX_MB)
+        """
+        if max_bytes is None:
+            max_bytes = int(os.getenv("OCR_CACHE_MAX_MB", DEFAULT_CACHE_MAX_MB)) * 1024 * 1024
+        self.db_path = str(db_path)
+        self.max_bytes = max_bytes
+
+        Path(self.db_path).parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(self.db_path, timeout=BUSY_TIMEOUT, check_same_thread=False)
+        self._conn.execute(f"PRAGMA busy_timeout = {int(BUSY_TIMEOUT * 1000)}")
+        self._conn.execute("PRAGMA journal_mode = WAL")
+        self._conn.execute("PRAGMA synchronous = NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            " key TEXT PRIMARY KEY,"
+            " text TEXT NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " created REAL NOT NULL,"
+            " accessed REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_results_accessed ON results(accessed)")
+        self._conn.commit()
+        self._lock = threading.Lock()
+
+        row = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()
+        self._total_bytes = row[0]
+
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evicted = 0
+
+    @staticmethod
+    def make_key(image: Image.Image, prompt: Any, backend: str, model: str = "") -> str:
+        """
+        Ключ кеша
+
+        Args:
+            image: кроп блока (хешируются пиксели, режим и размер)
+            prompt: промпт (dict из prompt_loader или строка)
+            backend: идентификатор движка (см. backend_identity)
+            model: имя модели, если не входит в backend
+
+        Returns:
+            sha256 hex
+        """
+        h = hashlib.sha256()
+        h.update(f"{image.mode}:{image.width}x{image.height}".encode("utf-8"))
+        h.update(image.tobytes())
+        h.update(json.dumps(prompt, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8"))
+        h.update(f"\0{backend}\0{model}".encode("utf-8"))
+        return h.hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        """Результат по ключу или None (ошибка SQLite - промах)"""
+        with self._lock:
+            try:
+                row = self._conn.execute("SELECT text FROM results WHERE key = ?", (key,)).fetchone()
+            except sqlite3.Error as e:
+                logger.warning(f"OCR кеш: ошибка чтения: {e}")
+                self.misses += 1
+                return None
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            try:
+                self._conn.execute("UPDATE results SET accessed = ? WHERE key = ?", (time.time(), key))
+                self._conn.commit()
+            except sqlite3.Error as e:
+                # Время доступа нужно только для LRU - результат всё равно валиден
+                self._rollback()
+                logger.debug(f"OCR кеш: не удалось обновить время доступа: {e}")
+            return row[0]
+
+    def put(self, key: str, text: str):
+        """Сохранить результат (ошибки OCR не сохраняются, ошибка SQLite пропускается)"""
+        if not is_cacheable(text):
+            return
+        size = len(text.encode("utf-8"))
+        now = time.time()
+        with self._lock:
+            try:
+                old = self._conn.execute("SELECT size FROM results WHERE key = ?", (key,)).fetchone()
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO results (key, text, size, created, accessed) VALUES (?, ?, ?, ?, ?)",
+                    (key, text, size, now, now)
+                )
+                self._total_bytes += size - (old[0] if old else 0)
+                self.writes += 1
+                if self._total_bytes > self.max_bytes:
+                    self._evict()
+                self._conn.commit()
+            except sqlite3.Error as e:
+                self._rollback()
+                logger.warning(f"OCR кеш: ошибка записи: {e}")
+
+    def _rollback(self):
+        try:
+            self._conn.rollback()
+        except sqlite3.Error:
+            pass
+
+    def recognize(self, backend: Any, image: Image.Image, prompt: Any = None) -> str:
+        """recognize() движка через кеш"""
+        key = self.make_key(image, prompt, backend_identity(backend))
+        text = self.get(key)
+        if text is None:
+            text = backend.recognize(image, prompt=prompt)
+            self.put(key, text)
+        return text
+
+    def _evict(self):
+        """Удалить давно не использованные записи до 90% лимита (под блокировкой)"""
+        # Другие процессы тоже пишут в файл - счётчик этого процесса пересчитываем
+        self._total_bytes = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+        target = int(self.max_bytes * 0.9)
+        rows = self._conn.execute("SELECT key, size FROM results ORDER BY accessed").fetchall()
+        removed = []
+        for key, size in rows:
+            if self._total_bytes <= target:
+                break
+            removed.append((key,))
+            self._total_bytes -= size
+        self._conn.executemany("DELETE FROM results WHERE key = ?", removed)
+        self.evicted += len(removed)
+        logger.debug(f"OCR кеш: вытеснено {len(removed)} записей")
+
+    def clear(self):
+        """Очистить кеш"""
+        with self._lock:
+            self._conn.execute("DELETE FROM results")
+            self._conn.commit()
+            self._total_bytes = 0
+
+    def get_stats(self) -> dict:
+        """Статистика кеша"""
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+            lookups = self.hits + self.misses
+            return {
+                "entries": entries,
+                "size_mb": round(self._total_bytes / (1024 * 1024), 2),
+                "max_mb": round(self.max_bytes / (1024 * 1024), 2),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups * 100, 1) if lookups else 0.0,
+                "writes": self.writes,
+                "evicted": self.evicted,
+            }
+
+    def log_stats(self):
+        """Записать статистику прогона в лог"""
+        stats = self.get_stats()
+        logger.info(
+            f"OCR кеш: попаданий {stats['hits']}/{stats['hits'] + stats['misses']} "
+            f"({stats['hit_rate']}%), записей {stats['entries']}, "
+            f"{stats['size_mb']}/{stats['max_mb']} MB, вытеснено {stats['evicted']}"
+        )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def open_ocr_cache(output_dir: str) -> Optional[OCRResultCache]:
+    """
+    Открыть кеш для прогона OCR
+
+    Каждый прогон пишет в новую папку (имя с timestamp), поэтому кеш лежит
+    в родительской папке и переживает повторные запуски.
+
+    Args:
+        output_dir: папка результатов прогона
+
+    Returns:
+        OCRResultCache или None (OCR_CACHE=0 или ошибка открытия)
+    """
+    if os.getenv("OCR_CACHE", "1").lower() in ("0", "false", "no"):
+        return None
+
+    db_path = os.getenv("OCR_CACHE_PATH") or str(Path(output_dir).parent / CACHE_FILENAME)
+    try:
+        cache = OCRResultCache(db_path)
+        logger.info(f"OCR кеш: {db_path}")
+        return cache
+    except (sqlite3.Error, OSError) as e:
+        logger.warning(f"OCR кеш недоступен ({db_path}): {e}")
+        return None
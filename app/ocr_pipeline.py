@@ -0,0 +1,876 @@
+"""
+Конвейер OCR без зависимости от Qt
+Общий для фонового потока GUI (app.gui.task_manager.OCRWorker) и
+командной строки (app.cli)
+"""
+
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class OCRPipeline:
+    """
+    OCR документа без Qt: datalab, batch или legacy режим
+    
+    Используется фоновым потоком GUI (OCRWorker) и командной строкой (app.cli).
+    Прогресс и отмена передаются через функции обратного вызова.
+    
+    Использование:
+        pipeline = OCRPipeline(annotation_document, pdf_document, page_images, config)
+        result = pipeline.run()  # {'output_dir', 'updated_pages'} или None при отмене
+    """
+    
+    def __init__(
+        self,
+        annotation_document,
+        pdf_document,
+        page_images,
+        config: dict,
+        progress_callback: Optional[Callable[[int, int], None]] = None,
+        is_cancelled: Optional[Callable[[], bool]] = None
+    ):
+        """
+        Args:
+            annotation_document: Document с блоками (изменяется на месте)
+            pdf_document: открытый PDFDocument
+            page_images: кеш страниц {page_num: Image} (PageImageView или dict)
+            config: настройки прогона (output_dir, backend, модели, prompt_loader, ...)
+            progress_callback: функция (current, total)
+            is_cancelled: функция проверки отмены
+        """
+        self.annotation_document = annotation_document
+        self.pdf_document = pdf_document
+        self.page_images = page_images
+        self.config = config
+        self.result = None
+        self._progress_callback = progress_callback
+        self._is_cancelled = is_cancelled
+        self._cancel_requested = False
+        self._engines = []
+        self._result_cache = None
+        self._fingerprints = {}  # block.id -> отпечаток входных данных текущего прогона
+        self._prompts = None     # PromptTable прогона (resolve_prompts)
+    
+    def cancel(self):
+        self._cancel_requested = True
+    
+    @property
+    def _cancelled(self) -> bool:
+        return self._cancel_requested or bool(self._is_cancelled and self._is_cancelled())
+    
+    def _report_progress(self, current: int, total: int):
+        if self._progress_callback is not None:
+            self._progress_callback(current, total)
+    
+    def _create_engine(self, backend: str, **kwargs):
+        """Создать OCR движок; его пул соединений закрывается по завершении задачи"""
+        from app.ocr import create_ocr_engine
+        
+        engine = create_ocr_engine(backend, **kwargs)
+        self._engines.append(engine)
+        return engine
+    
+    def _iter_page_crops(self, pages_with_blocks: dict):
+        """
+        Кропы блоков по страницам (рендерится только область блока, см. iter_page_crops)
+        
+        Yields:
+            (page_num, page, {block.id: [кропы частей блока]})
+        """
+        from app.render_pool import iter_page_crops
+        
+        for page, crops in iter_page_crops(
+            self.pdf_document,
+            list(pages_with_blocks.values()),
+            self.page_images,
+            is_cancelled=lambda: self._cancelled
+        ):
+            yield page.page_number, page, crops
+    
+    def _block_prompt(self, block):
+        """Промпт блока из таблицы прогона (категории, затем типа блока)"""
+        return self._prompts.prompt(block)
+    
+    def _select_dirty_blocks(self, pages_with_blocks: dict, model_for_block, crops_dir: Path) -> dict:
+        """
+        Инкрементальный OCR: оставить только блоки, входные данные которых изменились
+        
+        Отпечатки считаются для всех блоков (следующий прогон сможет их сравнить)
+        и записываются в блок после успешного распознавания (_mark_recognized).
+        Кропы пропущенных IMAGE блоков копируются в папку нового прогона.
+        
+        Args:
+            pages_with_blocks: {page_num: Page}
+            model_for_block: функция block -> имя движка/модели
+            crops_dir: папка кропов текущего прогона
+        
+        Returns:
+            {page_num: Page} только с изменёнными блоками
+        """
+        from dataclasses import replace
+        
+        incremental = self.config.get('incremental_ocr', False)
+        
+        dirty_pages = {}
+        skipped = 0
+        for page_num, page in pages_with_blocks.items():
+            dirty = []
+            for block in page.blocks:
+                fingerprint = block.compute_ocr_fingerprint(
+                    self._block_prompt(block), model_for_block(block)
+                )
+                self._fingerprints[block.id] = fingerprint
+                if incremental and block.is_ocr_current(fingerprint) and self._reuse_crop(block, crops_dir):
+                    skipped += 1
+                    continue
+                dirty.append(block)
+            if dirty:
+                dirty_pages[page_num] = replace(page, blocks=dirty)
+        
+        if incremental:
+            logger.info(f"Инкрементальный OCR: {skipped} блоков без изменений пропущено, "
+                        f"{sum(len(p.blocks) for p in dirty_pages.values())} к распознаванию")
+        return dirty_pages
+    
+    @staticmethod
+    def _reuse_crop(block, crops_dir: Path) -> bool:
+        """Перенести кроп IMAGE блока из прошлого прогона (False - кропа нет, нужен OCR)"""
+        import shutil
+        from app.models import BlockType
+        
+        if block.block_type != BlockType.IMAGE:
+            return True
+        if not block.image_file or not Path(block.image_file).exists():
+            return False
+        
+        target = crops_dir / Path(block.image_file).name
+        if Path(block.image_file).resolve() != target.resolve():
+            shutil.copy2(block.image_file, target)
+        block.image_file = str(target)
+        return True
+    
+    def _mark_recognized(self, block):
+        """Записать отпечаток входных данных после распознавания (ошибка - сброс)"""
+        from app.models import is_cacheable
+        
+        if is_cacheable(block.ocr_text):
+            block.ocr_fingerprint = self._fingerprints.get(block.id)
+        else:
+            block.ocr_fingerprint = None
+    
+    def run(self) -> Optional[dict]:
+        """
+        Выполнить OCR и сохранить результаты в config['output_dir']
+        
+        Returns:
+            {'output_dir', 'updated_pages'} или None, если прогон отменён
+        
+        Raises:
+            Exception: ошибка OCR (исходное исключение движка/API)
+        """
+        # Выбираем режим: datalab, batch или legacy
+        use_datalab = self.config.get('use_datalab', False)
+        use_batch = self.config.get('use_batch_ocr', True)
+        
+        # Кеш результатов: неизменённые блоки не отправляются в API повторно
+        if self.config.get('use_ocr_cache', True) and self.config.get('output_dir'):
+            from app.ocr_cache import open_ocr_cache
+            self._result_cache = open_ocr_cache(self.config['output_dir'])
+        
+        from app.image_encoding import encoding_stats
+        encoding_stats.reset()
+        
+        # Промпты всех блоков разрешаются один раз на прогон
+        from app.prompt_resolver import resolve_prompts
+        self._prompts = resolve_prompts(
+            (b for p in self.annotation_document.pages for b in p.blocks),
+            self.config.get('prompt_loader')
+        )
+        
+        try:
+            if use_datalab:
+                self._run_datalab_ocr()
+            elif use_batch:
+                self._run_batch_ocr()
+            else:
+                self._run_legacy_ocr()
+        finally:
+            from app.ocr import close_ocr_engines
+            close_ocr_engines(*self._engines)
+            self._engines.clear()
+            encoding_stats.log_stats()
+            if self._result_cache is not None:
+                self._result_cache.log_stats()
+                self._result_cache.close()
+                self._result_cache = None
+        
+        return self.result
+    
+    def _run_datalab_ocr(self):
+        """
+        Datalab OCR: блоки в порядке документа делятся на сегменты.
+        TEXT/TABLE собираются в ленты до 9000px, IMAGE закрывает текущую ленту.
+        Страницы рендерятся по одной: картинки сразу уходят в VLM (свой пул,
+        MAX_IN_FLIGHT движка), готовые ленты - в Datalab (recognize_stream),
+        поэтому в памяти не держатся кропы всего документа.
+        Над каждым блоком в ленте рисуется маркер, по которому markdown ленты
+        разбирается в ocr_text блоков. Markdown собирается в порядке сегментов.
+        """
+        try:
+            from app.datalab_ocr import (
+                StripPacker, encode_for_upload, 
+                DatalabOCRClient, DatalabOCRBackend, get_packing_mode,
+                demux_strip_results, strip_block_markers
+            )
+            from app.render_pool import block_crop_boxes
+            from app.models import is_cacheable
+            from app.models import BlockType
+            
+            output_dir = Path(self.config['output_dir'])
+            crops_dir = output_dir / "crops"
+            crops_dir.mkdir(parents=True, exist_ok=True)
+            
+            datalab_api_key = self.config.get('datalab_api_key', '')
+            if not datalab_api_key:
+                raise ValueError("DATALAB_API_KEY не указан")
+            
+            client = DatalabOCRClient(datalab_api_key)
+            
+            # Движок для IMAGE блоков (VLM)
+            image_backend = self.config.get('datalab_image_backend', 'local')
+            if image_backend == 'openrouter':
+                from dotenv import load_dotenv
+                load_dotenv()
+                api_key = os.getenv("OPENROUTER_API_KEY")
+                image_engine = self._create_engine("openrouter", api_key=api_key, 
+                                                   model_name=self.config.get('image_model'))
+            else:
+                image_engine = self._create_engine("local_vlm", 
+                                                   model_name=self.config.get('vlm_model_name', 'qwen3-vl-32b-instruct'))
+            
+            pages_with_blocks = {}
+            for page in self.annotation_document.pages:
+                if page.blocks:
+                    pages_with_blocks[page.page_number] = page
+            
+            logger.info(f"Datalab OCR: страниц с блоками: {len(pages_with_blocks)}/{len(self.annotation_document.pages)}")
+            
+            if not pages_with_blocks:
+                # Документ без блоков: разметка и пустой markdown всё равно сохраняются
+                self._save_datalab_results(output_dir, "")
+                return
+            
+            image_model = getattr(image_engine, 'model_name', '')
+            dirty_pages = self._select_dirty_blocks(
+                pages_with_blocks,
+                lambda b: image_model if b.block_type == BlockType.IMAGE else DatalabOCRBackend.CACHE_IDENTITY,
+                crops_dir
+            )
+            dirty_ids = {b.id for p in dirty_pages.values() for b in p.blocks}
+            
+            packing = self.config.get('datalab_packing') or get_packing_mode()
+            
+            # Прогресс в частях блоков: число частей известно по координатам,
+            # кропы для этого не рендерятся (обновляется из разных потоков)
+            progress_lock = threading.Lock()
+            total_units = sum(len(block_crop_boxes(b)) for p in dirty_pages.values() for b in p.blocks)
+            done_units = 0
+            
+            def advance(count=1):
+                nonlocal done_units
+                if not count:
+                    return
+                with progress_lock:
+                    done_units += count
+                    self._report_progress(done_units, total_units)
+            
+            def finished_parts(layout):
+                """Части блоков, последняя область которых в этой ленте"""
+                return sum(1 for r in layout.regions if r.src[3] == r.size[1])
+            
+            def segment_markers(items):
+                """ID блока над первой частью, None - продолжение высокого блока"""
+                return [b.id if part_id == b.id or part_id.endswith("_part0") else None
+                        for b, part_id in items]
+            
+            # Получаем публичный URL R2
+            r2_public_url = os.getenv("R2_PUBLIC_URL", "https://rd1.svarovsky.ru")
+            project_name = output_dir.name
+            
+            def image_markdown(block, ocr_text):
+                """Markdown описания картинки со ссылкой на кроп в R2"""
+                md_result = f"\n\n**Изображение:**\n\n{ocr_text}\n\n"
+                
+                # Добавляем ссылку на кроп в R2
+                if block.image_file:
+                    crop_filename = Path(block.image_file).name
+                    r2_url = f"{r2_public_url}/ocr_results/{project_name}/crops/{crop_filename}"
+                    md_result += f"![Изображение]({r2_url})\n\n"
+                
+                return md_result
+            
+            # Описание одной картинки через VLM (выполняется в пуле, блок не меняет)
+            def describe_image(block, crop):
+                prompt_data = self._block_prompt(block)
+                if self._result_cache is not None:
+                    return self._result_cache.recognize(image_engine, crop, prompt_data)
+                return image_engine.recognize(crop, prompt=prompt_data)
+            
+            # Сегменты в порядке документа:
+            #   ('text', [(block, part_id)]) - TEXT/TABLE между картинками, склеиваются в ленты
+            #   ('image', (block, part_id, future)) - описание картинки через VLM
+            #   ('done', block) - блок без изменений с прошлого прогона
+            segments = []
+            strips = []         # (индекс сегмента, StripLayout) для каждой ленты
+            strip_results = []  # markdown каждой ленты
+            cache_keys = {}
+            sent = []           # индекс ленты для каждого отправленного изображения
+            
+            # Картинки уходят в VLM сразу (свой пул, MAX_IN_FLIGHT движка); ожидающих
+            # не больше двух на поток, чтобы кропы не копились в памяти
+            image_workers = max(1, getattr(image_engine, 'MAX_IN_FLIGHT', 1))
+            image_pool = ThreadPoolExecutor(max_workers=image_workers, thread_name_prefix="datalab-vlm")
+            image_slots = threading.Semaphore(image_workers * 2)
+            
+            def submit_image(block, crop):
+                image_slots.acquire()
+                future = image_pool.submit(describe_image, block, crop)
+                
+                def on_done(_):
+                    image_slots.release()
+                    advance()
+                
+                future.add_done_callback(on_done)
+                return future
+            
+            def emit_strip(seg_idx, items, strip_image, layout):
+                """Лента из кеша (None) или (EncodedImage, промпт) для отправки"""
+                strip_idx = len(strips)
+                strips.append((seg_idx, layout))
+                strip_results.append(None)
+                
+                # Промпт по блокам ленты (сегмент при потоковой склейке ещё не известен целиком)
+                strip_blocks = {items[i][0].id: items[i][0] for i in layout.block_order()}
+                strip_prompt = self._get_datalab_prompt(
+                    [(b, None, None) for b in strip_blocks.values()]
+                )
+                
+                if self._result_cache is not None:
+                    cache_keys[strip_idx] = self._result_cache.make_key(
+                        strip_image, strip_prompt, DatalabOCRBackend.CACHE_IDENTITY
+                    )
+                    cached = self._result_cache.get(cache_keys[strip_idx])
+                    if cached is not None:
+                        strip_results[strip_idx] = cached
+                        advance(finished_parts(layout))
+                        return None
+                
+                # Кодируется в памяти: повторная отправка по таймауту берёт те же байты
+                sent.append(strip_idx)
+                return encode_for_upload(strip_image), strip_prompt
+            
+            def iter_strips():
+                """
+                Страница рендерится → кропы картинок уходят в VLM, текстовые
+                добавляются в StripPacker → готовые ленты сразу отдаются на отправку
+                """
+                crop_pages = self._iter_page_crops(dirty_pages)
+                next_page = next(crop_pages, None)
+                packer = None  # StripPacker открытого текстового сегмента
+                text_items = None
+                text_seg_idx = None
+                
+                def close_text():
+                    nonlocal packer, text_items
+                    if packer is not None:
+                        for strip_image, layout in packer.flush():
+                            item = emit_strip(text_seg_idx, text_items, strip_image, layout)
+                            if item:
+                                yield item
+                    packer, text_items = None, None
+                
+                try:
+                    for page_num, page in sorted(pages_with_blocks.items()):
+                        if self._cancelled:
+                            return
+                        
+                        crops = {}
+                        if next_page is not None and next_page[0] == page_num:
+                            crops = next_page[2]
+                            next_page = next(crop_pages, None)
+                        
+                        # Блоки в порядке нумерации (индекс в списке)
+                        for block in page.blocks:
+                            if block.id not in dirty_ids:
+                                # Без изменений: текст берётся из прошлого прогона
+                                yield from close_text()
+                                segments.append(('done', block))
+                                continue
+                            
+                            parts = crops.get(block.id, [])
+                            if not parts:
+                                continue
+                            
+                            # Большой блок поделён на части
+                            if len(parts) > 1:
+                                part_ids = [f"{block.id}_part{i}" for i in range(len(parts))]
+                            else:
+                                part_ids = [block.id]
+                            
+                            if block.block_type == BlockType.IMAGE:
+                                # Картинка закрывает текущую ленту
+                                yield from close_text()
+                                for part_idx, (crop, part_id) in enumerate(zip(parts, part_ids)):
+                                    # Сохраняем crop картинки
+                                    crop_path = crops_dir / f"page{page_num}_block{part_id}.png"
+                                    crop.save(crop_path, "PNG")
+                                    if part_idx == 0:
+                                        block.image_file = str(crop_path)
+                                    segments.append(('image', (block, part_id, submit_image(block, crop))))
+                                continue
+                            
+                            if packer is None:
+                                packer = StripPacker(packing=packing)
+                                text_items = []
+                                text_seg_idx = len(segments)
+                                segments.append(('text', text_items))
+                            
+                            for part_idx, (crop, part_id) in enumerate(zip(parts, part_ids)):
+                                text_items.append((block, part_id))
+                                for strip_image, layout in packer.add(crop, block.id if part_idx == 0 else None):
+                                    item = emit_strip(text_seg_idx, text_items, strip_image, layout)
+                                    if item:
+                                        yield item
+                    
+                    yield from close_text()
+                finally:
+                    crop_pages.close()
+            
+            def on_strip_result(i, outcome):
+                strip_idx = sent[i]
+                if isinstance(outcome, Exception) or outcome is None:
+                    logger.error(f"Datalab batch error: {outcome}")
+                    strip_results[strip_idx] = f"[Ошибка Datalab: {outcome}]"
+                else:
+                    strip_results[strip_idx] = outcome
+                    if strip_idx in cache_keys:
+                        self._result_cache.put(cache_keys[strip_idx], outcome)
+                advance(finished_parts(strips[strip_idx][1]))
+            
+            try:
+                # Рендеринг, склейка и отправка идут потоком: первая лента уходит,
+                # как только собрана, в памяти - только незакрытые ленты и очередь отправки
+                client.recognize_stream(
+                    iter_strips(),
+                    on_result=on_strip_result,
+                    is_cancelled=lambda: self._cancelled
+                )
+                
+                if self._cancelled:
+                    return
+                
+                if strips:
+                    fill = sum(layout.fill_ratio for _, layout in strips) / len(strips) * 100
+                    logger.info(f"Datalab OCR: {len(strips)} лент ({packing}, заполнение {fill:.1f}%), "
+                                f"из кеша {len(strips) - len(sent)}")
+                
+                # Разбор лент по блокам: ocr_text TEXT/TABLE блоков
+                text_markdown = {}
+                for seg_idx, (kind, payload) in enumerate(segments):
+                    if kind != 'text':
+                        continue
+                    seg_strips = [(layout, markdown) for (s_idx, layout), markdown
+                                  in zip(strips, strip_results) if s_idx == seg_idx]
+                    markers = segment_markers(payload)
+                    block_texts = demux_strip_results(
+                        [markdown if is_cacheable(markdown) else None for _, markdown in seg_strips],
+                        [layout for layout, _ in seg_strips],
+                        markers
+                    )
+                    
+                    owners = [i for i, m in enumerate(markers) if m is not None]
+                    for index in owners:
+                        block = payload[index][0]
+                        # Текст не выделен (маркер не распознан, ошибка ленты) - блок
+                        # останется изменённым и будет распознан при следующем прогоне
+                        block.ocr_text = block_texts.get(index)
+                        self._mark_recognized(block)
+                    
+                    if len(block_texts) == len(owners):
+                        text_markdown[seg_idx] = "\n\n".join(block_texts[i] for i in owners if block_texts[i])
+                    else:
+                        logger.warning(f"Datalab: сегмент {seg_idx}: текст выделен для "
+                                       f"{len(block_texts)}/{len(owners)} блоков")
+                        text_markdown[seg_idx] = "\n\n".join(
+                            strip_block_markers(markdown) for _, markdown in seg_strips if markdown
+                        )
+                
+                # Сборка markdown и запись в блоки в порядке документа.
+                # Блок из нескольких частей отмечается распознанным только после
+                # последней части и только если все части успешны
+                image_parts_left = {}
+                for kind, payload in segments:
+                    if kind == 'image':
+                        image_parts_left[payload[0].id] = image_parts_left.get(payload[0].id, 0) + 1
+                failed_images = set()
+                final_markdown_parts = []
+                for seg_idx, (kind, payload) in enumerate(segments):
+                    if self._cancelled:
+                        return
+                    
+                    if kind == 'text':
+                        md = text_markdown.get(seg_idx, "")
+                        if md:
+                            final_markdown_parts.append(md)
+                        continue
+                    
+                    if kind == 'done':
+                        # Блок не изменился с прошлого прогона
+                        block = payload
+                        if block.block_type == BlockType.IMAGE:
+                            final_markdown_parts.append(image_markdown(block, block.ocr_text))
+                        elif block.ocr_text:
+                            final_markdown_parts.append(block.ocr_text)
+                        continue
+                    
+                    block, part_id, future = payload
+                    if part_id == block.id or part_id.endswith("_part0"):
+                        # Первая часть: текст прошлого прогона сбрасывается при любом исходе
+                        block.ocr_text = ""
+                        block.ocr_fingerprint = None
+                    image_parts_left[block.id] -= 1
+                    try:
+                        ocr_text = future.result()
+                    except Exception as e:
+                        logger.error(f"VLM IMAGE block {part_id} error: {e}")
+                        failed_images.add(block.id)
+                        final_markdown_parts.append(f"\n\n**Изображение (ошибка):**\n\n[Ошибка VLM: {e}]\n\n")
+                        continue
+                    
+                    # Сохраняем в блок (части высокого блока - по порядку)
+                    if block.ocr_text:
+                        block.ocr_text = block.ocr_text + "\n" + ocr_text
+                    else:
+                        block.ocr_text = ocr_text
+                    if block.id in failed_images:
+                        block.ocr_fingerprint = None
+                    elif image_parts_left[block.id] == 0:
+                        self._mark_recognized(block)
+                    
+                    final_markdown_parts.append(image_markdown(block, ocr_text))
+            finally:
+                client.close()
+                image_pool.shutdown(wait=True, cancel_futures=True)
+            
+            # Объединяем все части markdown
+            final_markdown = "\n\n---\n\n".join([p for p in final_markdown_parts if p.strip()])
+            
+            if not self._cancelled:
+                self._save_datalab_results(output_dir, final_markdown)
+                
+        except Exception as e:
+            logger.error(f"Datalab OCR error: {e}", exc_info=True)
+            raise
+    
+    def _save_datalab_results(self, output_dir: Path, markdown_content: str):
+        """Сохранение результатов Datalab OCR"""
+        from app.annotation_io import AnnotationIO
+        
+        # Сохраняем annotation.json
+        json_path = output_dir / "annotation.json"
+        AnnotationIO.save_annotation(self.annotation_document, str(json_path))
+        
+        # Сохраняем markdown напрямую (уже собранный с правильной последовательностью)
+        md_path = output_dir / "document.md"
+        md_path.write_text(markdown_content, encoding='utf-8')
+        logger.info(f"Markdown сохранен: {md_path}")
+        
+        self._upload_results(output_dir)
+        self.result = {'output_dir': str(output_dir), 'updated_pages': self.annotation_document.pages}
+    
+    def _get_datalab_prompt(self, blocks_data) -> str:
+        """Собрать промпт для Datalab на основе типов блоков и категорий (из таблицы прогона)"""
+        from app.models import BlockType
+        
+        # Собираем уникальные типы и категории
+        block_types = set()
+        categories = set()
+        
+        for block, _, _ in blocks_data:
+            block_types.add(block.block_type)
+            if block.category and block.category.strip():
+                categories.add(block.category.strip())
+        
+        # Пытаемся получить промпт категории (приоритет); порядок фиксирован -
+        # промпт входит в ключ кеша ленты
+        for cat in sorted(categories):
+            prompt_data = self._prompts.named(f"category_{cat}")
+            if prompt_data:
+                user_prompt = prompt_data.get('user', '') if isinstance(prompt_data, dict) else str(prompt_data)
+                if user_prompt:
+                    return user_prompt
+        
+        # Или промпт типа блока
+        type_prompts = []
+        for key in sorted({'table' if bt == BlockType.TABLE else 'text' for bt in block_types}):
+            prompt_data = self._prompts.named(key)
+            if prompt_data:
+                user_prompt = prompt_data.get('user', '') if isinstance(prompt_data, dict) else str(prompt_data)
+                if user_prompt:
+                    type_prompts.append(user_prompt)
+        
+        if type_prompts:
+            return "\n".join(type_prompts)
+        
+        return None
+    
+    def _run_batch_ocr(self):
+        """Оптимизированный batch OCR с экономией токенов"""
+        try:
+            from app.ocr_batch import BatchOCREngine, estimate_token_savings
+            from app.ocr import HTTP2_AVAILABLE
+            from app.render_pool import block_crop_boxes, iter_prefetched
+            from app.models import BlockType
+            import httpx
+            
+            output_dir = Path(self.config['output_dir'])
+            crops_dir = output_dir / "crops"
+            crops_dir.mkdir(parents=True, exist_ok=True)
+            
+            # Подготовка API клиента и URL
+            if self.config['backend'] == 'openrouter':
+                from dotenv import load_dotenv
+                load_dotenv()
+                api_key = os.getenv("OPENROUTER_API_KEY")
+                api_url = "https://openrouter.ai/api/v1/chat/completions"
+                headers = {"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"}
+                model_name = self.config.get('text_model', 'qwen/qwen3-vl-30b-a3b-instruct')
+            else:
+                from app.config import get_lm_base_url
+                api_url = get_lm_base_url()
+                headers = {"Content-Type": "application/json"}
+                model_name = self.config.get('vlm_model_name', 'qwen3-vl-32b-instruct')
+            
+            # Только страницы с блоками, чтобы не рендерить пустые
+            pages_with_blocks = {p.page_number: p for p in self.annotation_document.pages if p.blocks}
+            logger.info(f"Batch OCR: страниц с блоками: {len(pages_with_blocks)}/{len(self.annotation_document.pages)}")
+            dirty_pages = self._select_dirty_blocks(pages_with_blocks, lambda b: model_name, crops_dir)
+            
+            if not dirty_pages:
+                # Все блоки без изменений (или блоков нет): результаты прошлого прогона
+                # сохраняются в новую папку, для пустой разметки - пустой document.md
+                self._save_results(output_dir)
+                return
+            
+            # Число частей известно по координатам - прогресс без рендеринга всех кропов
+            total_blocks = sum(len(block_crop_boxes(b)) for p in dirty_pages.values() for b in p.blocks)
+            
+            def iter_blocks_with_crops():
+                """(block, crop, page_num) в порядке документа; кропы рендерятся по страницам"""
+                for page_num, page, crops in self._iter_page_crops(dirty_pages):
+                    # Блоки в порядке нумерации (индекс в списке)
+                    for block in page.blocks:
+                        # Высокие блоки поделены на части по MAX_BLOCK_HEIGHT
+                        parts = crops.get(block.id, [])
+                        for part_idx, crop in enumerate(parts):
+                            if block.block_type == BlockType.IMAGE:
+                                if len(parts) > 1:
+                                    crop_filename = f"page{page_num}_block{block.id}_part{part_idx}.png"
+                                else:
+                                    crop_filename = f"page{page_num}_block{block.id}.png"
+                                crop_path = crops_dir / crop_filename
+                                crop.save(crop_path, "PNG")
+                                block.image_file = str(crop_path)
+                            yield block, crop, page_num
+            
+            # Рендеринг → группировка → запрос идут потоком: рендеринг опережает
+            # отправку не больше чем на очередь iter_prefetched, в памяти - текущий батч
+            stream = iter_prefetched(
+                iter_blocks_with_crops(),
+                max_pending=BatchOCREngine.MAX_IMAGES_LIMIT * 2,
+                is_cancelled=lambda: self._cancelled
+            )
+            
+            # Один пул соединений (keep-alive, HTTP/2 если доступен) на весь прогон
+            with httpx.Client(timeout=600.0, headers=headers, http2=HTTP2_AVAILABLE) as client:
+                batch_engine = BatchOCREngine(client, model_name, use_context=True,
+                                              result_cache=self._result_cache,
+                                              parallel_groups=self.config.get('batch_parallel_groups'))
+                # Счётчик обновляется из потоков пула (параллельные группы)
+                progress_lock = threading.Lock()
+                processed_count = 0
+                groups_count = 0
+                
+                def on_items_done(count):
+                    nonlocal processed_count
+                    if not count:
+                        return
+                    with progress_lock:
+                        processed_count += count
+                        self._report_progress(processed_count, total_blocks)
+                
+                if batch_engine.parallel_groups > 1:
+                    logger.info(f"Batch OCR: до {batch_engine.parallel_groups} групп одновременно")
+                
+                try:
+                    # Части групп обрабатываются волнами; результаты - в порядке документа
+                    for group, group_end, results in batch_engine.process_in_waves(
+                        batch_engine.iter_group_batches(stream, self._prompts),
+                        api_url,
+                        on_items_done=on_items_done,
+                        is_cancelled=lambda: self._cancelled
+                    ):
+                        # Применяем результаты к блокам
+                        for item in group.items:
+                            if item.block.id in results:
+                                item.block.ocr_text = results[item.block.id]
+                                self._mark_recognized(item.block)
+                        groups_count += group_end
+                finally:
+                    stream.close()
+                
+                if self._cancelled:
+                    return
+                
+                # Экономия по фактическому числу групп и размеру батчей
+                batch_engine.log_stats()
+                if processed_count:
+                    stats = batch_engine.stats
+                    avg_batch = stats['images'] / stats['batches'] if stats['batches'] else 1.0
+                    avg_batch = min(avg_batch, processed_count / max(groups_count, 1))
+                    savings = estimate_token_savings(processed_count, max(groups_count, 1), avg_batch)
+                    logger.info(f"Batch OCR: {savings['baseline_requests']} → {savings['optimized_requests']} запросов "
+                               f"(экономия ~{savings['savings_percent']}% токенов)")
+            
+            if not self._cancelled:
+                self._save_results(output_dir)
+                
+        except Exception as e:
+            logger.error(f"Batch OCR error: {e}", exc_info=True)
+            raise
+    
+    def _run_legacy_ocr(self):
+        """Legacy режим: один блок = один запрос (запросы идут параллельно через OCRDispatcher)"""
+        try:
+            from app.ocr import OCRDispatcher
+            from app.models import BlockType
+            
+            output_dir = Path(self.config['output_dir'])
+            crops_dir = output_dir / "crops"
+            crops_dir.mkdir(parents=True, exist_ok=True)
+            
+            # OCR Engine
+            if self.config['backend'] == 'openrouter':
+                from dotenv import load_dotenv
+                load_dotenv()
+                api_key = os.getenv("OPENROUTER_API_KEY")
+                
+                text_engine = self._create_engine("openrouter", api_key=api_key, model_name=self.config.get('text_model'))
+                table_engine = self._create_engine("openrouter", api_key=api_key, model_name=self.config.get('table_model'))
+                image_engine = self._create_engine("openrouter", api_key=api_key, model_name=self.config.get('image_model'))
+            else:
+                api_base = self.config['vlm_server_url']
+                model_name = self.config['vlm_model_name']
+                text_engine = table_engine = image_engine = self._create_engine("local_vlm", api_base=api_base, model_name=model_name)
+            
+            engines = {
+                BlockType.IMAGE: image_engine,
+                BlockType.TABLE: table_engine,
+                BlockType.TEXT: text_engine,
+            }
+            # Только страницы с блоками
+            pages_with_blocks = {p.page_number: p for p in self.annotation_document.pages if p.blocks}
+            logger.info(f"Legacy OCR: страниц с блоками: {len(pages_with_blocks)}/{len(self.annotation_document.pages)}")
+            dirty_pages = self._select_dirty_blocks(
+                pages_with_blocks,
+                lambda b: getattr(engines.get(b.block_type), 'model_name', ''),
+                crops_dir
+            )
+            
+            # Собираем запросы: высокие блоки поделены на части, каждая часть - отдельный запрос
+            tasks = []        # (engine, crop, prompt)
+            block_parts = []  # (block, число частей) в порядке tasks
+            for page_num, page, crops in self._iter_page_crops(dirty_pages):
+                for block in page.blocks:
+                    parts = crops.get(block.id, [])
+                    engine = engines.get(block.block_type)
+                    if not parts or engine is None:
+                        continue
+                    
+                    prompt_text = self._block_prompt(block)
+                    
+                    if block.block_type == BlockType.IMAGE:
+                        crop_filename = f"page{page_num}_block{block.id}.png"
+                        crop_path = crops_dir / crop_filename
+                        parts[0].save(crop_path, "PNG")
+                        block.image_file = str(crop_path)
+                    
+                    for crop in parts:
+                        tasks.append((engine, crop, prompt_text))
+                    block_parts.append((block, len(parts)))
+            
+            if self._cancelled:
+                return
+            
+            with OCRDispatcher(result_cache=self._result_cache) as dispatcher:
+                results = dispatcher.run(
+                    tasks,
+                    progress_callback=self._report_progress,
+                    is_cancelled=lambda: self._cancelled
+                )
+            
+            if self._cancelled:
+                return
+            
+            # Собираем результаты частей обратно в блоки (в исходном порядке)
+            offset = 0
+            for block, part_count in block_parts:
+                block_results = results[offset:offset + part_count]
+                offset += part_count
+                
+                error = next((r for r in block_results if isinstance(r, Exception)), None)
+                if error is not None:
+                    logger.error(f"Error OCR block {block.id}: {error}")
+                    block.ocr_text = f"[Error: {error}]"
+                else:
+                    block.ocr_text = "\n".join(r or "" for r in block_results)
+                self._mark_recognized(block)
+            
+            self._save_results(output_dir)
+            
+        except Exception as e:
+            logger.error(f"OCR error: {e}", exc_info=True)
+            raise
+    
+    def _save_results(self, output_dir: Path):
+        """Сохранение результатов OCR"""
+        from app.ocr import generate_structured_markdown
+        from app.annotation_io import AnnotationIO
+        
+        json_path = output_dir / "annotation.json"
+        AnnotationIO.save_annotation(self.annotation_document, str(json_path))
+        
+        md_path = output_dir / "document.md"
+        project_name = output_dir.name
+        generate_structured_markdown(self.annotation_document.pages, str(md_path), project_name=project_name)
+        
+        self._upload_results(output_dir)
+        self.result = {'output_dir': str(output_dir), 'updated_pages': self.annotation_document.pages}
+    
+    def _upload_results(self, output_dir: Path):
+        """Загрузка результатов в R2 (config['upload_r2'], по умолчанию включена)"""
+        if not self.config.get('upload_r2', True):
+            return
+        try:
+            from app.r2_storage import upload_ocr_to_r2
+            project_name = output_dir.name
+            logger.info(f"OCR: Загрузка результатов в R2 (проект: {project_name})")
+            upload_ocr_to_r2(str(output_dir), project_name)
+        except Exception as e:
+            logger.error(f"OCR: Ошибка загрузки в R2: {e}", exc_info=True)
@@ -0,0 +1,417 @@
+"""
+Общий кеш изображений страниц PDF
+LRU с ограничением по памяти и опциональным сжатым дисковым уровнем
+"""
+
+import atexit
+import hashlib
+import logging
+import os
+import shutil
+import threading
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from pathlib import Path
+from typing import Dict, Iterator, Optional, Tuple
+from PIL import Image
+from app.pdf_utils import PDF_RENDER_ZOOM
+
+logger = logging.getLogger(__name__)
+
+# Лимиты по умолчанию (переопределяются через .env)
+DEFAULT_MAX_MEMORY_MB = 1024
+DEFAULT_MAX_DISK_MB = 4096
+
+# Ключ кеша: (путь к PDF, mtime файла, номер страницы, zoom)
+PageCacheKey = Tuple[str, float, int, float]
+
+
+def _image_nbytes(image: Image.Image) -> int:
+    """Размер несжатого изображения в байтах"""
+    return image.width * image.height * len(image.getbands())
+
+
+class PageImageCache:
+    """
+    Потокобезопасный LRU кеш изображений страниц
+
+    - Ключ включает mtime файла, поэтому изменённый PDF не получит старые страницы
+    - При превышении бюджета памяти вытесняются давно неиспользуемые страницы
+    - Если задан disk_dir, вытесненные страницы сохраняются в PNG (быстрое сжатие)
+      и при повторном обращении загружаются с диска вместо рендеринга.
+      Кодирование и декодирование PNG идут вне общей блокировки: страница до
+      записи на диск остаётся доступной из _spilling, а чтение одной страницы
+      выполняет один поток (_loading). Каждый процесс пишет в свою
+      подпапку disk_dir/<pid>, удаляемую при завершении
+    """
+
+    def __init__(
+        self,
+        max_bytes: int = DEFAULT_MAX_MEMORY_MB * 1024 * 1024,
+        disk_dir: Optional[str] = None,
+        disk_max_bytes: int = DEFAULT_MAX_DISK_MB * 1024 * 1024
+    ):
+        """
+        Args:
+            max_bytes: бюджет памяти (несжатые пиксели)
+            disk_dir: директория дискового уровня (None - без диска);
+                файлы процесса лежат в подпапке <pid>
+            disk_max_bytes: бюджет дискового уровня
+        """
+        self.max_bytes = max_bytes
+        self.disk_dir = Path(disk_dir) / str(os.getpid()) if disk_dir else None
+        self.disk_max_bytes = disk_max_bytes
+
+        self._items: "OrderedDict[PageCacheKey, Image.Image]" = OrderedDict()
+        self._sizes: Dict[PageCacheKey, int] = {}
+        self._current_bytes = 0
+        self._disk_items: "OrderedDict[PageCacheKey, int]" = OrderedDict()
+        self._disk_bytes = 0
+        # Вытесненные страницы, которые сейчас записываются на диск
+        self._spilling: Dict[PageCacheKey, Image.Image] = {}
+        # Страницы, которые сейчас читаются с диска: событие завершения чтения
+        self._loading: Dict[PageCacheKey, threading.Event] = {}
+        self._lock = threading.RLock()
+
+        # Счётчики
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        if self.disk_dir:
+            # Подпапка только этого процесса: другие процессы (GUI, python -m app.cli -j N)
+            # продолжают пользоваться своими файлами. Остатки процесса с тем же pid удаляем
+            shutil.rmtree(self.disk_dir, ignore_errors=True)
+            self.disk_dir.mkdir(parents=True, exist_ok=True)
+            atexit.register(shutil.rmtree, self.disk_dir, ignore_errors=True)
+
+        logger.info(
+            f"PageImageCache: память {max_bytes // (1024 * 1024)} МБ, "
+            f"диск {'выключен' if not self.disk_dir else f'{self.disk_dir} ({disk_max_bytes // (1024 * 1024)} МБ)'}"
+        )
+
+    @staticmethod
+    def make_key(pdf_path: str, page_num: int, zoom: float = PDF_RENDER_ZOOM) -> PageCacheKey:
+        """Сформировать ключ кеша для страницы"""
+        path = os.path.abspath(pdf_path)
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            mtime = 0.0
+        return (path, mtime, page_num, round(zoom, 4))
+
+    def get(self, key: PageCacheKey) -> Optional[Image.Image]:
+        """Получить изображение (память → диск) или None"""
+        while True:
+            with self._lock:
+                image = self._items.get(key)
+                if image is not None:
+                    self._items.move_to_end(key)
+                    self.hits += 1
+                    return image
+
+                image = self._spilling.get(key)
+                if image is not None:
+                    self.hits += 1
+                    victims = self._store(key, image)
+                    break
+
+                loading = self._loading.get(key)
+                if loading is None:
+                    if key not in self._disk_items:
+                        self.misses += 1
+                        return None
+                    loading = self._loading[key] = threading.Event()
+                    path = self._disk_path(key)
+                    reader = True
+                else:
+                    reader = False
+
+            if not reader:
+                # Страницу уже читает другой поток - ждём и проверяем снова
+                loading.wait()
+                continue
+
+            # Декодирование PNG целой страницы - вне блокировки
+            try:
+                image = self._read_disk_file(path)
+            except BaseException:
+                with self._lock:
+                    if self._loading.get(key) is loading:
+                        del self._loading[key]
+                    loading.set()
+                raise
+
+            with self._lock:
+                # Ожидающие потоки проверят память только после освобождения блокировки
+                current = self._loading.get(key) is loading
+                if current:
+                    del self._loading[key]
+                loading.set()
+                if image is None or not current:
+                    # Файл повреждён, либо страница удалена (discard/invalidate/clear) во время чтения
+                    if image is None and current and key in self._disk_items:
+                        logger.warning(f"PageImageCache: повреждён файл {path}")
+                        self._discard_disk(key)
+                    self.misses += 1
+                    return None
+                self.disk_hits += 1
+                if key in self._disk_items:
+                    self._disk_items.move_to_end(key)
+                victims = self._store(key, image)
+            break
+
+        self._spill_to_disk(victims)
+        return image
+
+    def put(self, key: PageCacheKey, image: Image.Image):
+        """Положить изображение в кеш"""
+        with self._lock:
+            if key in self._items:
+                self._remove(key)
+            victims = self._store(key, image)
+        self._spill_to_disk(victims)
+
+    def contains(self, key: PageCacheKey) -> bool:
+        """Есть ли страница в кеше (без влияния на счётчики и LRU)"""
+        with self._lock:
+            return key in self._items or key in self._spilling or key in self._disk_items
+
+    def discard(self, key: PageCacheKey):
+        """Удалить страницу из памяти и с диска"""
+        with self._lock:
+            if key in self._items:
+                self._remove(key)
+            self._spilling.pop(key, None)
+            self._loading.pop(key, None)
+            self._discard_disk(key)
+
+    def invalidate(self, pdf_path: str):
+        """Удалить все страницы документа"""
+        path = os.path.abspath(pdf_path)
+        with self._lock:
+            for key in [k for k in self._items if k[0] == path]:
+                self._remove(key)
+            for key in [k for k in self._spilling if k[0] == path]:
+                del self._spilling[key]
+            for key in [k for k in self._loading if k[0] == path]:
+                del self._loading[key]
+            for key in [k for k in self._disk_items if k[0] == path]:
+                self._discard_disk(key)
+
+    def clear(self):
+        """Очистить кеш полностью"""
+        with self._lock:
+            self._items.clear()
+            self._sizes.clear()
+            self._current_bytes = 0
+            self._spilling.clear()
+            self._loading.clear()
+            for key in list(self._disk_items):
+                self._discard_disk(key)
+
+    def keys_for(self, pdf_path: str, zoom: float = PDF_RENDER_ZOOM) -> list:
+        """Номера страниц документа в кеше (память и диск), как их видит contains()"""
+        path, mtime, _, zoom = self.make_key(pdf_path, 0, zoom)
+        with self._lock:
+            pages = set()
+            for keys in (self._items, self._spilling, self._disk_items):
+                pages.update(k[2] for k in keys if k[0] == path and k[1] == mtime and k[3] == zoom)
+            return sorted(pages)
+
+    def get_stats(self) -> dict:
+        """Статистика кеша"""
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": round((self.hits + self.disk_hits) / lookups, 3) if lookups else 0.0,
+                "evictions": self.evictions,
+                "items": len(self._items),
+                "memory_bytes": self._current_bytes,
+                "disk_items": len(self._disk_items),
+                "disk_bytes": self._disk_bytes,
+            }
+
+    def view(self, pdf_path: Optional[str], zoom: float = PDF_RENDER_ZOOM) -> "PageImageView":
+        """Словарь-представление {page_num: image} для одного документа"""
+        return PageImageView(self, pdf_path, zoom)
+
+    # ========== ВНУТРЕННИЕ МЕТОДЫ ==========
+
+    def _store(self, key: PageCacheKey, image: Image.Image) -> list:
+        """
+        Добавить страницу (под блокировкой)
+
+        Returns:
+            [(key, image), ...] - вытесненные страницы для _spill_to_disk
+        """
+        size = _image_nbytes(image)
+        self._items[key] = image
+        self._sizes[key] = size
+        self._current_bytes += size
+
+        victims = []
+        # Последний добавленный элемент не вытесняем, даже если он больше бюджета
+        while self._current_bytes > self.max_bytes and len(self._items) > 1:
+            old_key, old_image = self._items.popitem(last=False)
+            self._current_bytes -= self._sizes.pop(old_key)
+            self.evictions += 1
+            if self.disk_dir and old_key not in self._disk_items and old_key not in self._spilling:
+                self._spilling[old_key] = old_image
+                victims.append((old_key, old_image))
+        return victims
+
+    def _remove(self, key: PageCacheKey):
+        self._items.pop(key)
+        self._current_bytes -= self._sizes.pop(key)
+
+    def _disk_path(self, key: PageCacheKey) -> Optional[Path]:
+        if not self.disk_dir:
+            return None
+        digest = hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
+        return self.disk_dir / f"{digest}.png"
+
+    def _spill_to_disk(self, victims: list):
+        """Записать вытесненные страницы на диск (вне блокировки: PNG крупной страницы - секунды)"""
+        for key, image in victims:
+            path = self._disk_path(key)
+            tmp_path = path.with_name(f"{path.stem}.{threading.get_ident()}.tmp")
+            try:
+                image.save(tmp_path, format="PNG", compress_level=1)
+                size = tmp_path.stat().st_size
+            except Exception as e:
+                logger.warning(f"PageImageCache: не удалось сохранить страницу на диск: {e}")
+                with self._lock:
+                    if self._spilling.get(key) is image:
+                        del self._spilling[key]
+                self._unlink(tmp_path)
+                continue
+
+            with self._lock:
+                # Страница удалена (discard/invalidate/clear), пока шла запись
+                if self._spilling.get(key) is not image:
+                    self._unlink(tmp_path)
+                    continue
+                del self._spilling[key]
+                os.replace(tmp_path, path)
+                self._disk_items[key] = size
+                self._disk_bytes += size
+
+                while self._disk_bytes > self.disk_max_bytes and self._disk_items:
+                    old_key = next(iter(self._disk_items))
+                    self._discard_disk(old_key)
+
+    @staticmethod
+    def _unlink(path: Path):
+        try:
+            path.unlink()
+        except OSError:
+            pass
+
+    @staticmethod
+    def _read_disk_file(path: Path) -> Optional[Image.Image]:
+        """Прочитать страницу с диска (без блокировки) или None"""
+        try:
+            with Image.open(path) as img:
+                img.load()
+                return img.copy()
+        except Exception as e:
+            logger.debug(f"PageImageCache: не удалось прочитать {path}: {e}")
+            return None
+
+    def _discard_disk(self, key: PageCacheKey):
+        size = self._disk_items.pop(key, None)
+        if size is not None:
+            self._disk_bytes -= size
+        path = self._disk_path(key)
+        if path is not None and path.exists():
+            try:
+                path.unlink()
+            except OSError:
+                pass
+
+
+class PageImageView(MutableMapping):
+    """
+    Представление кеша в виде словаря {page_num: PIL.Image} для одного PDF
+
+    Совместимо с прежним словарём page_images: поддерживает in, [], get, keys.
+    Представление без документа (pdf_path=None) всегда пустое.
+    """
+
+    def __init__(self, cache: PageImageCache, pdf_path: Optional[str], zoom: float = PDF_RENDER_ZOOM):
+        self.cache = cache
+        self.pdf_path = pdf_path
+        self.zoom = zoom
+
+    def _key(self, page_num: int) -> PageCacheKey:
+        return self.cache.make_key(self.pdf_path, page_num, self.zoom)
+
+    def __getitem__(self, page_num: int) -> Image.Image:
+        if self.pdf_path is None:
+            raise KeyError(page_num)
+        image = self.cache.get(self._key(page_num))
+        if image is None:
+            raise KeyError(page_num)
+        return image
+
+    def __setitem__(self, page_num: int, image: Image.Image):
+        if self.pdf_path is None:
+            return
+        self.cache.put(self._key(page_num), image)
+
+    def __delitem__(self, page_num: int):
+        if self.pdf_path is None:
+            raise KeyError(page_num)
+        self.cache.discard(self._key(page_num))
+
+    def __contains__(self, page_num) -> bool:
+        if self.pdf_path is None:
+            return False
+        return self.cache.contains(self._key(page_num))
+
+    def __iter__(self) -> Iterator[int]:
+        if self.pdf_path is None:
+            return iter([])
+        return iter(self.cache.keys_for(self.pdf_path, self.zoom))
+
+    def __len__(self) -> int:
+        if self.pdf_path is None:
+            return 0
+        return len(self.cache.keys_for(self.pdf_path, self.zoom))
+
+    def clear(self):
+        """Удалить все страницы документа из кеша"""
+        if self.pdf_path is not None:
+            self.cache.invalidate(self.pdf_path)
+
+
+_page_cache: Optional[PageImageCache] = None
+_page_cache_lock = threading.Lock()
+
+
+def get_page_cache() -> PageImageCache:
+    """
+    Общий экземпляр кеша страниц
+
+    Настройки из окружения:
+        PAGE_CACHE_MAX_MB: бюджет памяти (по умолчанию 1024)
+        PAGE_CACHE_DISK_DIR: директория дискового уровня (по умолчанию выключен)
+        PAGE_CACHE_DISK_MAX_MB: бюджет диска (по умолчанию 4096)
+    """
+    global _page_cache
+    with _page_cache_lock:
+        if _page_cache is None:
+            max_mb = int(os.getenv("PAGE_CACHE_MAX_MB", DEFAULT_MAX_MEMORY_MB))
+            disk_dir = os.getenv("PAGE_CACHE_DISK_DIR") or None
+            disk_max_mb = int(os.getenv("PAGE_CACHE_DISK_MAX_MB", DEFAULT_MAX_DISK_MB))
+            _page_cache = PageImageCache(
+                max_bytes=max_mb * 1024 * 1024,
+                disk_dir=disk_dir,
+                disk_max_bytes=disk_max_mb * 1024 * 1024
+            )
+        return _page_cache
@@ -5,9 +5,10 @@
 
 import fitz  # PyMuPDF
 import logging
-from typing import List, Optional
+import os
+from typing import List, Optional, Tuple
 from PIL import Image
-import io
+import threading
 from pathlib import Path
 
 
@@ -22,6 +23,32 @@ Image.MAX_IMAGE_PIXELS = 500_000_000
 PDF_RENDER_DPI = 300
 PDF_RENDER_ZOOM = PDF_RENDER_DPI / 72.0  # ≈ 4.167
 
+# Лимит пикселей на страницу: при превышении zoom снижается адаптивно
+MAX_RENDER_PIXELS = 400_000_000
+
+
+def get_crop_dpi(block_type: str) -> int:
+    """
+    DPI рендеринга кропа для типа блока
+    
+    Переопределяется через .env: OCR_CROP_DPI_TEXT, OCR_CROP_DPI_TABLE, OCR_CROP_DPI_IMAGE.
+    По умолчанию PDF_RENDER_DPI (кроп совпадает с вырезанным из страницы).
+    
+    Args:
+        block_type: тип блока ("text", "table", "image")
+    
+    Returns:
+        DPI для кропа
+    """
+    value = os.getenv(f"OCR_CROP_DPI_{block_type.upper()}")
+    if not value:
+        return PDF_RENDER_DPI
+    try:
+        return int(value)
+    except ValueError:
+        logger.warning(f"Некорректное значение OCR_CROP_DPI_{block_type.upper()}={value}")
+        return PDF_RENDER_DPI
+
 
 def open_pdf(path: str) -> fitz.Document:
     """
@@ -61,6 +88,69 @@ def open_pdf(path: str) -> fitz.Document:
         raise
 
 
+def pixmap_to_image(pix: fitz.Pixmap) -> Image.Image:
+    """
+    Конвертация fitz.Pixmap в PIL Image без промежуточного PNG
+    
+    Изображение строится напрямую по сырым сэмплам pixmap
+    (без zlib-сжатия и повторного декодирования).
+    
+    Args:
+        pix: отрендеренный pixmap (Gray, RGB или RGBA)
+    
+    Returns:
+        PIL.Image.Image в режиме L, RGB или RGBA
+    
+    Raises:
+        ValueError: для неподдерживаемого числа каналов (например CMYK)
+    """
+    modes = {1: "L", 3: "RGB", 4: "RGBA"}
+    mode = modes.get(pix.n)
+    if mode is None or (pix.alpha and pix.n != 4):
+        raise ValueError(f"Неподдерживаемый формат pixmap: n={pix.n}, alpha={pix.alpha}")
+    
+    # pix.samples - копия буфера pixmap, frombuffer использует её без повторного копирования
+    return Image.frombuffer(mode, (pix.width, pix.height), pix.samples, "raw", mode, pix.stride, 1)
+
+
+def get_effective_zoom(page: fitz.Page, zoom: float = PDF_RENDER_ZOOM) -> float:
+    """
+    Zoom, с которым страница реально рендерится
+    
+    Для очень больших страниц (A0 и больше) zoom снижается так, чтобы
+    изображение не превышало MAX_RENDER_PIXELS. Координаты блоков (coords_px)
+    всегда выражены в пикселях именно этого масштаба.
+    
+    Args:
+        page: страница PDF
+        zoom: запрошенный коэффициент масштабирования
+    
+    Returns:
+        Фактический коэффициент масштабирования
+    """
+    rect = page.rect
+    estimated_pixels = (rect.width * zoom) * (rect.height * zoom)
+    if estimated_pixels > MAX_RENDER_PIXELS:
+        return (MAX_RENDER_PIXELS / (rect.width * rect.height)) ** 0.5
+    return zoom
+
+
+def get_page_size_px(page: fitz.Page, zoom: float = PDF_RENDER_ZOOM) -> Tuple[int, int]:
+    """
+    Размер страницы в пикселях (совпадает с размером pixmap из render_page_to_image)
+    
+    Args:
+        page: страница PDF
+        zoom: запрошенный коэффициент масштабирования
+    
+    Returns:
+        (width, height) в пикселях
+    """
+    effective_zoom = get_effective_zoom(page, zoom)
+    irect = (page.rect * fitz.Matrix(effective_zoom, effective_zoom)).irect
+    return (irect.width, irect.height)
+
+
 def render_page_to_image(
     doc: fitz.Document, 
     page_index: int, 
@@ -99,12 +189,8 @@ def render_page_to_image(
         page = doc[page_index]
         
         # Адаптивный zoom для больших страниц (лимит ~400 млн пикселей)
-        rect = page.rect
-        max_pixels = 400_000_000
-        estimated_pixels = (rect.width * zoom) * (rect.height * zoom)
-        effective_zoom = zoom
-        if estimated_pixels > max_pixels:
-            effective_zoom = (max_pixels / (rect.width * rect.height)) ** 0.5
+        effective_zoom = get_effective_zoom(page, zoom)
+        if effective_zoom != zoom:
             logger.warning(f"Страница {page_index} слишком большая, zoom снижен: {zoom:.2f} -> {effective_zoom:.2f}")
         
         # Создаём матрицу масштабирования (одинаковый zoom по X и Y для сохранения пропорций)
@@ -115,12 +201,8 @@ def render_page_to_image(
         
         logger.debug(f"Страница {page_index} отрендерена: {pix.width}x{pix.height}px, zoom={effective_zoom}")
         
-        # Конвертация в PIL Image
-        # Используем tobytes() для получения сырых данных изображения
-        img_data = pix.tobytes("png")
-        img = Image.open(io.BytesIO(img_data))
-        
-        return img
+        # Конвертация в PIL Image напрямую из сэмплов pixmap
+        return pixmap_to_image(pix)
         
     except IndexError:
         # Перебрасываем IndexError дальше
@@ -130,9 +212,159 @@ def render_page_to_image(
         raise Exception(f"Не удалось отрендерить страницу {page_index}") from e
 
 
+def render_page_region_pixmap(
+    doc: fitz.Document,
+    page_index: int,
+    clip_px: Tuple[float, float, float, float],
+    zoom: float = PDF_RENDER_ZOOM,
+    scale: float = 1.0
+) -> fitz.Pixmap:
+    """
+    Рендеринг прямоугольной области страницы в fitz.Pixmap (без рендеринга всей страницы)
+    
+    Координаты области задаются в пиксельном пространстве страницы,
+    отрендеренной с zoom (то же пространство, что и Block.coords_px).
+    
+    Args:
+        doc: открытый PDF документ
+        page_index: индекс страницы (начиная с 0)
+        clip_px: область (x1, y1, x2, y2) в пикселях страницы при zoom
+        zoom: коэффициент масштабирования пиксельного пространства
+        scale: дополнительный масштаб результата (0.5 = вдвое меньше пикселей)
+    
+    Returns:
+        fitz.Pixmap - отрендеренная область (RGB)
+    
+    Raises:
+        IndexError: если page_index выходит за пределы документа
+        ValueError: если zoom/scale <= 0 или область пустая
+    """
+    if zoom <= 0 or scale <= 0:
+        raise ValueError(f"Zoom и scale должны быть положительными, получено: zoom={zoom}, scale={scale}")
+    
+    page_count = len(doc)
+    if page_index < 0 or page_index >= page_count:
+        raise IndexError(f"Индекс страницы {page_index} выходит за пределы (доступно: 0-{page_count-1})")
+    
+    x1, y1, x2, y2 = clip_px
+    if x2 <= x1 or y2 <= y1:
+        raise ValueError(f"Пустая область рендеринга: {clip_px}")
+    
+    page = doc[page_index]
+    effective_zoom = get_effective_zoom(page, zoom)
+    
+    # Пиксели -> PDF points (с учётом смещения mediabox)
+    origin = page.rect.tl
+    clip = fitz.Rect(
+        origin.x + x1 / effective_zoom,
+        origin.y + y1 / effective_zoom,
+        origin.x + x2 / effective_zoom,
+        origin.y + y2 / effective_zoom
+    )
+    
+    render_zoom = effective_zoom * scale
+    return page.get_pixmap(matrix=fitz.Matrix(render_zoom, render_zoom), clip=clip)
+
+
+def render_page_region(
+    doc: fitz.Document,
+    page_index: int,
+    clip_px: Tuple[float, float, float, float],
+    zoom: float = PDF_RENDER_ZOOM,
+    scale: float = 1.0
+) -> Image.Image:
+    """
+    Рендеринг прямоугольной области страницы в изображение PIL
+    
+    Args:
+        doc: открытый PDF документ
+        page_index: индекс страницы (начиная с 0)
+        clip_px: область (x1, y1, x2, y2) в пикселях страницы при zoom
+        zoom: коэффициент масштабирования пиксельного пространства
+        scale: дополнительный масштаб результата
+    
+    Returns:
+        PIL.Image.Image - отрендеренная область
+    
+    Raises:
+        IndexError: если page_index выходит за пределы документа
+        ValueError: если zoom/scale <= 0 или область пустая
+    """
+    return pixmap_to_image(render_page_region_pixmap(doc, page_index, clip_px, zoom, scale))
+
+
+def norm_to_page_rect(page: fitz.Page, coords_norm: Tuple[float, float, float, float]) -> fitz.Rect:
+    """
+    Нормализованные координаты блока (0..1) -> прямоугольник в PDF points
+    
+    Нормализация выполнена относительно отрендеренной страницы,
+    т.е. относительно page.rect (с учётом поворота и смещения mediabox).
+    """
+    x1, y1, x2, y2 = coords_norm
+    rect = page.rect
+    return fitz.Rect(
+        rect.x0 + x1 * rect.width,
+        rect.y0 + y1 * rect.height,
+        rect.x0 + x2 * rect.width,
+        rect.y0 + y2 * rect.height
+    )
+
+
+def get_crop_zoom(page: fitz.Page, dpi: int = PDF_RENDER_DPI) -> float:
+    """
+    Zoom рендеринга кропа при заданном DPI
+    
+    При DPI по умолчанию совпадает с get_effective_zoom, поэтому кроп
+    пиксель в пиксель равен вырезанному из отрендеренной страницы.
+    """
+    return get_effective_zoom(page, PDF_RENDER_ZOOM) * dpi / PDF_RENDER_DPI
+
+
+def render_block_region(
+    doc: fitz.Document,
+    page_index: int,
+    coords_norm: Tuple[float, float, float, float],
+    dpi: int = PDF_RENDER_DPI
+) -> Image.Image:
+    """
+    Рендеринг только области блока (clip), без рендеринга всей страницы
+    
+    Память и время пропорциональны площади блока, а не страницы.
+    
+    Args:
+        doc: открытый PDF документ
+        page_index: индекс страницы (начиная с 0)
+        coords_norm: нормализованные координаты блока (x1, y1, x2, y2)
+        dpi: разрешение кропа
+    
+    Returns:
+        PIL.Image.Image - кроп блока
+    
+    Raises:
+        IndexError: если page_index выходит за пределы документа
+        ValueError: если dpi <= 0 или область пустая
+    """
+    if dpi <= 0:
+        raise ValueError(f"DPI должен быть положительным, получено: {dpi}")
+    
+    page_count = len(doc)
+    if page_index < 0 or page_index >= page_count:
+        raise IndexError(f"Индекс страницы {page_index} выходит за пределы (доступно: 0-{page_count-1})")
+    
+    page = doc[page_index]
+    clip = norm_to_page_rect(page, coords_norm)
+    if clip.is_empty:
+        raise ValueError(f"Пустая область блока: {coords_norm}")
+    
+    zoom = get_crop_zoom(page, dpi)
+    pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), clip=clip)
+    return pixmap_to_image(pix)
+
+
 def render_all_pages(
     doc: fitz.Document, 
-    zoom: float = PDF_RENDER_ZOOM
+    zoom: float = PDF_RENDER_ZOOM,
+    workers: int = 1
 ) -> List[Image.Image]:
     """
     Рендеринг всех страниц PDF в изображения PIL
@@ -141,6 +373,8 @@ def render_all_pages(
         doc: открытый PDF документ
         zoom: коэффициент масштабирования (2.0 = 200% = 144 DPI)
               Применяется одинаково ко всем страницам
+        workers: число процессов рендеринга (>1 - параллельно через RenderPool,
+                 требуется документ, открытый из файла)
     
     Returns:
         List[PIL.Image.Image] - список отрендеренных страниц
@@ -161,6 +395,13 @@ def render_all_pages(
     
     logger.info(f"Начало рендеринга {page_count} страниц с zoom={zoom}")
     
+    if workers > 1 and page_count > 1 and doc.name:
+        from app.render_pool import RenderPool
+        with RenderPool(doc.name, workers=workers) as pool:
+            images = [img for _, img in pool.render_pages(range(page_count), dpi=zoom * 72) if img is not None]
+        logger.info(f"Рендеринг завершён: {len(images)}/{page_count} страниц ({workers} процессов)")
+        return images
+    
     images = []
     failed_pages = []
     
@@ -195,6 +436,9 @@ class PDFDocument:
     """
     Обёртка над PyMuPDF для работы с PDF-документами
     Использует функции выше для реализации
+    
+    fitz.Document не потокобезопасен: viewer (GUI) и фоновые задачи
+    обращаются к документу через общий lock.
     """
     
     def __init__(self, pdf_path: str):
@@ -207,6 +451,7 @@ class PDFDocument:
         self.pdf_path = pdf_path
         self.doc: Optional[fitz.Document] = None
         self.page_count = 0
+        self._lock = threading.RLock()
         
     def open(self) -> bool:
         """
@@ -225,7 +470,9 @@ class PDFDocument:
     
     def close(self):
         """Закрыть PDF-документ"""
-        if self.doc:
+        with self._lock:
+            if not self.doc:
+                return
             self.doc.close()
             self.doc = None
             logger.debug(f"PDF документ закрыт: {self.pdf_path}")
@@ -246,17 +493,107 @@ class PDFDocument:
             return None
         
         try:
-            return render_page_to_image(self.doc, page_number, zoom)
+            with self._lock:
+                return render_page_to_image(self.doc, page_number, zoom)
         except Exception as e:
             logger.error(f"Ошибка рендеринга страницы {page_number}: {e}")
             return None
     
-    def render_all(self, zoom: float = PDF_RENDER_ZOOM) -> List[Image.Image]:
+    def render_region(
+        self,
+        page_number: int,
+        clip_px: Tuple[float, float, float, float],
+        zoom: float = PDF_RENDER_ZOOM,
+        scale: float = 1.0
+    ) -> Optional[Image.Image]:
+        """
+        Рендеринг области страницы в изображение PIL
+        
+        Args:
+            page_number: номер страницы (начиная с 0)
+            clip_px: область (x1, y1, x2, y2) в пикселях страницы при zoom
+            zoom: коэффициент масштабирования пиксельного пространства
+            scale: дополнительный масштаб результата
+        
+        Returns:
+            PIL.Image или None в случае ошибки
+        """
+        if not self.doc or page_number < 0 or page_number >= self.page_count:
+            logger.warning(f"Некорректный запрос рендеринга области: page={page_number}, doc_opened={self.doc is not None}")
+            return None
+        
+        try:
+            with self._lock:
+                return render_page_region(self.doc, page_number, clip_px, zoom, scale)
+        except Exception as e:
+            logger.error(f"Ошибка рендеринга области {clip_px} страницы {page_number}: {e}")
+            return None
+    
+    def render_block_crop(
+        self,
+        page_number: int,
+        coords_norm: Tuple[float, float, float, float],
+        dpi: Optional[int] = None
+    ) -> Optional[Image.Image]:
+        """
+        Рендеринг кропа блока через clip (без рендеринга всей страницы)
+        
+        Args:
+            page_number: номер страницы (начиная с 0)
+            coords_norm: нормализованные координаты блока (x1, y1, x2, y2)
+            dpi: разрешение кропа (None - PDF_RENDER_DPI)
+        
+        Returns:
+            PIL.Image или None в случае ошибки
+        """
+        if not self.doc or page_number < 0 or page_number >= self.page_count:
+            logger.warning(f"Некорректный запрос кропа: page={page_number}, doc_opened={self.doc is not None}")
+            return None
+        
+        try:
+            with self._lock:
+                return render_block_region(self.doc, page_number, coords_norm, dpi or PDF_RENDER_DPI)
+        except Exception as e:
+            logger.error(f"Ошибка рендеринга кропа {coords_norm} страницы {page_number}: {e}")
+            return None
+    
+    def render_region_pixmap(
+        self,
+        page_number: int,
+        clip_px: Tuple[float, float, float, float],
+        zoom: float = PDF_RENDER_ZOOM,
+        scale: float = 1.0
+    ) -> Optional[fitz.Pixmap]:
+        """
+        Рендеринг области страницы в fitz.Pixmap (для прямой передачи буфера в QImage)
+        
+        Args:
+            page_number: номер страницы (начиная с 0)
+            clip_px: область (x1, y1, x2, y2) в пикселях страницы при zoom
+            zoom: коэффициент масштабирования пиксельного пространства
+            scale: дополнительный масштаб результата
+        
+        Returns:
+            fitz.Pixmap или None в случае ошибки
+        """
+        if not self.doc or page_number < 0 or page_number >= self.page_count:
+            logger.warning(f"Некорректный запрос рендеринга области: page={page_number}, doc_opened={self.doc is not None}")
+            return None
+        
+        try:
+            with self._lock:
+                return render_page_region_pixmap(self.doc, page_number, clip_px, zoom, scale)
+        except Exception as e:
+            logger.error(f"Ошибка рендеринга области {clip_px} страницы {page_number}: {e}")
+            return None
+    
+    def render_all(self, zoom: float = PDF_RENDER_ZOOM, workers: int = 1) -> List[Image.Image]:
         """
         Рендеринг всех страниц документа
         
         Args:
             zoom: коэффициент масштабирования
+            workers: число процессов рендеринга
         
         Returns:
             Список изображений страниц
@@ -266,7 +603,8 @@ class PDFDocument:
             return []
         
         try:
-            return render_all_pages(self.doc, zoom)
+            with self._lock:
+                return render_all_pages(self.doc, zoom, workers)
         except Exception as e:
             logger.error(f"Ошибка рендеринга всех страниц: {e}")
             return []
@@ -286,11 +624,8 @@ class PDFDocument:
             return None
         
         try:
-            page = self.doc[page_number]
-            rect = page.rect
-            width = int(rect.width * zoom)
-            height = int(rect.height * zoom)
-            return (width, height)
+            with self._lock:
+                return get_page_size_px(self.doc[page_number], zoom)
         except Exception as e:
             logger.error(f"Ошибка получения размеров страницы {page_number}: {e}")
             return None
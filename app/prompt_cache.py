@@ -0,0 +1,320 @@
+"""
+Локальный кеш промптов из R2 (prompts/*.json)
+- В памяти и на диске: повторные запросы промпта не обращаются к R2,
+  после перезапуска и без сети используются сохранённые версии
+- По истечении TTL промпт ревалидируется условным GET (If-None-Match → 304)
+- prefetch() загружает все промпты одним листингом префикса
+"""
+
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# Время, в течение которого промпт отдаётся без обращения к R2 (PROMPT_CACHE_TTL)
+DEFAULT_TTL = 300
+
+# Пауза перед новой попыткой связаться с R2 после сетевой ошибки
+OFFLINE_RETRY = 60
+
+# Файл кеша на диске (переопределяется через PROMPT_CACHE_PATH)
+DEFAULT_CACHE_PATH = Path.home() / ".cache" / "rd" / "prompts.json"
+
+# Параллельных загрузок при prefetch
+PREFETCH_WORKERS = 8
+
+
+@dataclass
+class _Entry:
+    """Промпт в кеше: текст (None - объекта нет в R2), ETag и время проверки"""
+    content: Optional[str]
+    etag: Optional[str]
+    checked: float = 0.0  # time.monotonic() последней проверки в R2 (0 - не проверялся)
+
+
+class PromptCache:
+    """
+    Кеш текстов промптов по ключам R2
+
+    Потокобезопасен: промпты запрашиваются из потоков OCR.
+
+    Использование:
+        cache = PromptCache(r2_storage)
+        cache.prefetch()
+        text = cache.get_text("prompts/text.json")
+        prompt = cache.load_prompt("text")  # {"system": ..., "user": ...}
+    """
+
+    def __init__(
+        self,
+        r2_storage=None,
+        prefix: str = "prompts",
+        cache_path: Optional[str] = None,
+        ttl: Optional[float] = None
+    ):
+        """
+        Args:
+            r2_storage: R2Storage или None (только сохранённые на диске промпты)
+            prefix: префикс промптов в bucket
+            cache_path: файл кеша (по умолчанию PROMPT_CACHE_PATH или DEFAULT_CACHE_PATH)
+            ttl: время без ревалидации в секундах (по умолчанию PROMPT_CACHE_TTL)
+        """
+        self.r2_storage = r2_storage
+        self.prefix = prefix.rstrip("/") + "/"
+        self.cache_path = Path(cache_path or os.getenv("PROMPT_CACHE_PATH") or DEFAULT_CACHE_PATH)
+        self.ttl = float(os.getenv("PROMPT_CACHE_TTL", DEFAULT_TTL)) if ttl is None else ttl
+
+        self._entries: Dict[str, _Entry] = {}
+        self._lock = threading.RLock()
+        self._offline_until = 0.0
+        self._listed_at = 0.0  # последний полный листинг префикса (prefetch)
+
+        self.hits = 0
+        self.revalidated = 0
+        self.downloads = 0
+
+        self._load_disk()
+
+    def get_text(self, key: str) -> Optional[str]:
+        """
+        Текст объекта R2
+
+        Свежая запись (моложе TTL) отдаётся из памяти; устаревшая проверяется
+        условным GET; без связи с R2 отдаётся последняя сохранённая версия.
+
+        Returns:
+            Текст или None, если объекта нет
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            now = time.monotonic()
+            if entry is not None and entry.checked and now - entry.checked < self.ttl:
+                self.hits += 1
+                return entry.content
+            # Недавний листинг префикса не содержал ключ - объекта нет
+            if entry is None and key.startswith(self.prefix) and self._listed_at and now - self._listed_at < self.ttl:
+                self.hits += 1
+                return None
+            if self.r2_storage is None or self._is_offline():
+                return entry.content if entry is not None else None
+            etag = entry.etag if entry is not None and entry.content is not None else None
+
+        status, content, new_etag = self.r2_storage.download_text_conditional(key, etag)
+
+        with self._lock:
+            if status == 'offline':
+                self._go_offline()
+                return entry.content if entry is not None else None
+            if status == 'error':
+                return entry.content if entry is not None else None
+
+            now = time.monotonic()
+            if status == 'not_modified':
+                entry.checked = now
+                self.revalidated += 1
+                return entry.content
+
+            if status == 'missing':
+                self._entries[key] = _Entry(None, None, now)
+            else:
+                self._entries[key] = _Entry(content, new_etag, now)
+                self.downloads += 1
+            self._save_disk()
+            return self._entries[key].content
+
+    def load_prompt(self, name: str) -> Optional[dict]:
+        """
+        Промпт по имени: prefix/name.json, затем старый формат prefix/name.txt
+
+        Args:
+            name: имя промпта ('text', 'table', 'image' или 'category_XXX')
+
+        Returns:
+            Dict с ключами 'system' и 'user' или None
+        """
+        content = self.get_text(f"{self.prefix}{name}.json")
+        if content:
+            try:
+                data = json.loads(content)
+                return {
+                    "system": data.get("system", ""),
+                    "user": data.get("user", "")
+                }
+            except json.JSONDecodeError:
+                # Старый формат - простой текст
+                logger.info(f"Конвертация старого формата промта: {name}")
+                return {"system": "", "user": content}
+
+        old_content = self.get_text(f"{self.prefix}{name}.txt")
+        if old_content:
+            logger.info(f"Миграция промта из .txt: {name}")
+            return {"system": "", "user": old_content}
+        return None
+
+    def prefetch(self) -> int:
+        """
+        Загрузить все промпты префикса одним листингом
+
+        ETag из листинга сравнивается с сохранёнными: скачиваются только новые
+        и изменённые объекты, отсутствующие в R2 помечаются как удалённые.
+
+        Returns:
+            Число промптов в кеше после загрузки
+        """
+        if self.r2_storage is None or self._is_offline():
+            return self._count()
+
+        started = time.perf_counter()
+        try:
+            # iter_objects, а не list_objects_with_metadata: ошибка не должна
+            # выглядеть как пустой префикс (все промпты были бы помечены удалёнными)
+            objects = list(self.r2_storage.iter_objects(self.prefix))
+        except Exception as e:
+            logger.warning(f"Промпты: R2 недоступен, используется локальный кеш ({e})")
+            self._go_offline()
+            return self._count()
+
+        now = time.monotonic()
+        listed = {obj['Key']: obj.get('ETag') for obj in objects}
+        with self._lock:
+            stale = []
+            for key, etag in listed.items():
+                entry = self._entries.get(key)
+                if entry is not None and entry.content is not None and etag and entry.etag == etag:
+                    entry.checked = now
+                else:
+                    stale.append(key)
+            # Удалённые из R2 промпты
+            for key, entry in self._entries.items():
+                if key.startswith(self.prefix) and key not in listed:
+                    entry.content, entry.etag, entry.checked = None, None, now
+            self._listed_at = now
+
+        def download(key):
+            return key, self.r2_storage.download_text_conditional(key, None)
+
+        if stale:
+            with ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix="prompt-prefetch") as pool:
+                fetched = list(pool.map(download, stale))
+            with self._lock:
+                for key, (status, content, etag) in fetched:
+                    if status == 'ok':
+                        self._entries[key] = _Entry(content, etag, now)
+                        self.downloads += 1
+                    elif status == 'missing':
+                        self._entries[key] = _Entry(None, None, now)
+
+        with self._lock:
+            self._save_disk()
+        logger.info(f"Промпты: {len(listed)} в R2, загружено {len(stale)} за "
+                    f"{time.perf_counter() - started:.2f} с")
+        return self._count()
+
+    def prefetch_async(self) -> threading.Thread:
+        """
+        prefetch() в фоновом потоке (запуск GUI не ждёт листинга R2)
+
+        До завершения промпты читаются по одному через get_text.
+        """
+        def run():
+            try:
+                self.prefetch()
+            except Exception as e:
+                logger.warning(f"Промпты: фоновая загрузка не удалась: {e}")
+
+        thread = threading.Thread(target=run, name="prompt-prefetch", daemon=True)
+        thread.start()
+        return thread
+
+    def put(self, key: str, content: Optional[str], etag: Optional[str] = None):
+        """Записать промпт после сохранения в R2 (None - после удаления)"""
+        with self._lock:
+            self._entries[key] = _Entry(content, etag, time.monotonic())
+            self._save_disk()
+
+    def invalidate(self, key: Optional[str] = None):
+        """Проверить промпт (None - все) в R2 при следующем запросе"""
+        with self._lock:
+            if key is None:
+                self._listed_at = 0.0
+            for cached_key, entry in self._entries.items():
+                if key is None or cached_key == key:
+                    entry.checked = 0.0
+
+    def keys(self) -> list[str]:
+        """Ключи промптов, имеющихся в кеше"""
+        with self._lock:
+            return sorted(k for k, e in self._entries.items() if e.content is not None)
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {
+                "prompts": self._count(),
+                "hits": self.hits,
+                "revalidated": self.revalidated,
+                "downloads": self.downloads,
+                "offline": self._is_offline(),
+            }
+
+    def _count(self) -> int:
+        with self._lock:
+            return sum(1 for e in self._entries.values() if e.content is not None)
+
+    def _is_offline(self) -> bool:
+        return time.monotonic() < self._offline_until
+
+    def _go_offline(self):
+        if not self._is_offline():
+            logger.warning(f"Промпты: R2 недоступен, работа с локальным кешем "
+                           f"(повторная попытка через {OFFLINE_RETRY} с)")
+        self._offline_until = time.monotonic() + OFFLINE_RETRY
+
+    def _load_disk(self):
+        """Промпты прошлых запусков (проверяются в R2 при первом запросе)"""
+        try:
+            data = json.loads(self.cache_path.read_text(encoding="utf-8"))
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning(f"Кеш промптов не прочитан ({self.cache_path}): {e}")
+            return
+        for key, item in data.get("prompts", {}).items():
+            self._entries[key] = _Entry(item.get("content"), item.get("etag"))
+        logger.info(f"Кеш промптов: {len(self._entries)} из {self.cache_path}")
+
+    def _save_disk(self):
+        """
+        Сохранить промпты (под блокировкой)
+
+        Запись через уникальный временный файл: кеш могут одновременно
+        сохранять несколько процессов (python -m app.cli -j N).
+        """
+        data = {"prompts": {
+            key: {"content": e.content, "etag": e.etag}
+            for key, e in self._entries.items() if e.content is not None
+        }}
+        tmp_path = None
+        try:
+            self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+            with tempfile.NamedTemporaryFile(
+                "w", encoding="utf-8", dir=self.cache_path.parent,
+                prefix=f"{self.cache_path.name}.", suffix=".tmp", delete=False
+            ) as tmp:
+                tmp_path = tmp.name
+                json.dump(data, tmp, ensure_ascii=False)
+            os.replace(tmp_path, self.cache_path)
+        except OSError as e:
+            logger.warning(f"Кеш промптов не сохранён ({self.cache_path}): {e}")
+            if tmp_path is not None:
+                try:
+                    os.unlink(tmp_path)
+                except OSError:
+                    pass
@@ -0,0 +1,142 @@
+"""
+Таблица промптов прогона OCR
+Цепочка "промпт категории → промпт типа блока" разрешается один раз на
+прогон для каждой различной пары (категория, тип блока): промпты
+загружаются параллельно, результат замораживается с хешем версии и
+передаётся всем движкам.
+"""
+
+import hashlib
+import json
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from types import MappingProxyType
+from typing import Callable, Dict, Iterable, Mapping, Optional, Tuple
+
+from app.models import Block, BlockType
+
+logger = logging.getLogger(__name__)
+
+# Параллельных загрузок промптов
+RESOLVE_WORKERS = 8
+
+# Имена промптов типов блоков
+TYPE_PROMPTS = {
+    BlockType.TEXT: "text",
+    BlockType.TABLE: "table",
+    BlockType.IMAGE: "image",
+}
+
+
+@dataclass(frozen=True)
+class ResolvedPrompt:
+    """Промпт пары (категория, тип блока)"""
+    key: str                # "category_X" или "type_text/table/image" (ключ группы batch OCR)
+    prompt: Optional[dict]  # dict с system/user из prompt_loader (None - промпта нет)
+
+
+def _category(block: Block) -> str:
+    return (block.category or "").strip()
+
+
+class PromptTable:
+    """
+    Неизменяемая таблица промптов прогона
+
+    Использование:
+        prompts = resolve_prompts(blocks, prompt_manager.load_prompt)
+        prompt = prompts.prompt(block)          # dict system/user или None
+        key = prompts.for_block(block).key      # ключ группы
+    """
+
+    def __init__(self, entries: Mapping[Tuple[str, BlockType], ResolvedPrompt], loaded: Mapping[str, Optional[dict]]):
+        """
+        Args:
+            entries: (категория, тип блока) -> ResolvedPrompt
+            loaded: имя промпта -> результат prompt_loader
+        """
+        self._entries = MappingProxyType(dict(entries))
+        self._loaded = MappingProxyType(dict(loaded))
+        digest = hashlib.sha256(
+            json.dumps(sorted(self._loaded.items()), ensure_ascii=False, default=str).encode("utf-8")
+        )
+        self.version = digest.hexdigest()[:12]
+
+    def for_block(self, block: Block) -> ResolvedPrompt:
+        """Промпт блока (категория, не вошедшая в таблицу, - промпт типа блока)"""
+        resolved = self._entries.get((_category(block), block.block_type))
+        if resolved is None:
+            logger.warning(f"Промпт для категории '{_category(block)}' не разрешён заранее, "
+                           f"используется промпт типа блока")
+            resolved = self._entries.get(("", block.block_type)) or ResolvedPrompt(
+                f"type_{TYPE_PROMPTS.get(block.block_type, 'text')}", None
+            )
+        return resolved
+
+    def prompt(self, block: Block) -> Optional[dict]:
+        """dict system/user для блока или None"""
+        return self.for_block(block).prompt
+
+    def named(self, name: str) -> Optional[dict]:
+        """Промпт по имени ('text', 'category_X'), загруженный при разрешении"""
+        return self._loaded.get(name)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+def resolve_prompts(
+    blocks: Iterable[Block],
+    prompt_loader: Optional[Callable[[str], Optional[dict]]],
+    max_workers: int = RESOLVE_WORKERS
+) -> PromptTable:
+    """
+    Разрешить промпты всех блоков прогона
+
+    Загружаются промпты всех встречающихся категорий и всех типов блоков
+    (каждый один раз, параллельно); ошибка загрузки равносильна отсутствию
+    промпта.
+
+    Args:
+        blocks: блоки прогона
+        prompt_loader: функция имя промпта -> dict system/user (None - без промптов)
+        max_workers: параллельных загрузок
+
+    Returns:
+        PromptTable
+    """
+    pairs = {(_category(block), block.block_type) for block in blocks}
+    pairs |= {("", block_type) for block_type in TYPE_PROMPTS}
+
+    names = sorted({f"category_{category}" for category, _ in pairs if category} | set(TYPE_PROMPTS.values()))
+
+    def load(name):
+        try:
+            return prompt_loader(name)
+        except Exception as e:
+            logger.warning(f"Промпт '{name}' не загружен: {e}")
+            return None
+
+    started = time.perf_counter()
+    if prompt_loader is None:
+        loaded: Dict[str, Optional[dict]] = {}
+    else:
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(names))),
+                                thread_name_prefix="prompt-resolve") as pool:
+            loaded = dict(zip(names, pool.map(load, names)))
+
+    entries = {}
+    for category, block_type in pairs:
+        category_name = f"category_{category}"
+        if category and loaded.get(category_name):
+            entries[(category, block_type)] = ResolvedPrompt(category_name, loaded[category_name])
+        else:
+            type_name = TYPE_PROMPTS.get(block_type, "text")
+            entries[(category, block_type)] = ResolvedPrompt(f"type_{type_name}", loaded.get(type_name))
+
+    table = PromptTable(entries, loaded)
+    logger.info(f"Промпты прогона: {len(loaded)} загружено за {time.perf_counter() - started:.2f} с, "
+                f"{len(pairs)} пар (категория, тип), версия {table.version}")
+    return table
@@ -3,13 +3,17 @@ Cloudflare R2 Object Storage интеграция
 Загрузка результатов OCR в S3-совместимое хранилище
 """
 
+import hashlib
 import logging
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Optional
+from typing import Dict, Iterator, List, Optional, Tuple
 import boto3
 from botocore.config import Config
-from botocore.exceptions import ClientError
+from botocore.exceptions import BotoCoreError, ClientError
 from boto3.s3.transfer import TransferConfig
 from dotenv import load_dotenv
 
@@ -19,9 +23,62 @@ logger = logging.getLogger(__name__)
 load_dotenv()
 
 
+# Время жизни локального индекса листингов (переопределяется через R2_LIST_CACHE_TTL, 0 - без индекса)
+DEFAULT_LIST_CACHE_TTL = 30
+
+
+class _ListingIndex:
+    """
+    Локальный индекс метаданных объектов по прочитанным префиксам
+    
+    Повторный листинг префикса (или вложенного в него) в пределах TTL
+    отвечается из памяти. Запись через этот клиент сбрасывает листинги,
+    покрывающие ключ; изменения из других клиентов видны после TTL.
+    """
+    
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._listings: Dict[str, Tuple[float, List[dict]]] = {}
+        self._lock = threading.Lock()
+    
+    def get(self, prefix: str) -> Optional[List[dict]]:
+        if self.ttl <= 0:
+            return None
+        now = time.monotonic()
+        with self._lock:
+            for cached_prefix, (stored, objects) in self._listings.items():
+                if prefix.startswith(cached_prefix) and now - stored < self.ttl:
+                    if cached_prefix == prefix:
+                        return list(objects)
+                    return [obj for obj in objects if obj['Key'].startswith(prefix)]
+        return None
+    
+    def put(self, prefix: str, objects: List[dict]):
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            self._listings[prefix] = (time.monotonic(), list(objects))
+    
+    def invalidate(self, key: Optional[str] = None):
+        """Сбросить листинги, содержащие key (None - все)"""
+        with self._lock:
+            if key is None:
+                self._listings.clear()
+                return
+            for cached_prefix in [p for p in self._listings if key.startswith(p)]:
+                del self._listings[cached_prefix]
+
+
 class R2Storage:
     """Клиент для работы с Cloudflare R2 Object Storage"""
     
+    # Соединений в пуле клиента = потоков параллельной загрузки директории
+    MAX_POOL_CONNECTIONS = 10
+    
+    # Multipart загрузка (ETag таких объектов - не MD5 файла, см. _local_etag)
+    MULTIPART_THRESHOLD = 100 * 1024 * 1024  # 100MB - только для очень больших файлов
+    MULTIPART_CHUNKSIZE = 50 * 1024 * 1024   # 50MB chunks
+    
     def __init__(
         self,
         account_id: Optional[str] = None,
@@ -63,6 +120,8 @@ class R2Storage:
         
         logger.info(f"R2_ENDPOINT_URL: {self.endpoint_url}")
         
+        self._listing_index = _ListingIndex(float(os.getenv("R2_LIST_CACHE_TTL", DEFAULT_LIST_CACHE_TTL)))
+        
         # Проверка обязательных параметров
         if not all([self.access_key_id, self.secret_access_key, self.endpoint_url]):
             error_msg = (
@@ -82,14 +141,14 @@ class R2Storage:
                 },
                 connect_timeout=30,
                 read_timeout=120,
-                max_pool_connections=10
+                max_pool_connections=self.MAX_POOL_CONNECTIONS
             )
             
             # Настройки multipart upload - оптимизированы для скорости
             self.transfer_config = TransferConfig(
-                multipart_threshold=100 * 1024 * 1024,  # 100MB - только для очень больших файлов
+                multipart_threshold=self.MULTIPART_THRESHOLD,
                 max_concurrency=20,  # Больше параллельных соединений
-                multipart_chunksize=50 * 1024 * 1024,  # 50MB chunks
+                multipart_chunksize=self.MULTIPART_CHUNKSIZE,
                 use_threads=True
             )
             
@@ -155,6 +214,7 @@ class R2Storage:
                 Config=self.transfer_config
             )
             
+            self._listing_index.invalidate(remote_key)
             logger.info(f"✅ Файл загружен в R2: {remote_key} ({file_size} байт)")
             return True
             
@@ -175,18 +235,25 @@ class R2Storage:
         self,
         local_dir: str,
         remote_prefix: str = "",
-        recursive: bool = True
+        recursive: bool = True,
+        skip_unchanged: bool = True
     ) -> tuple[int, int]:
         """
         Загрузить директорию в R2
         
+        Файлы загружаются параллельно (MAX_POOL_CONNECTIONS потоков на общем
+        клиенте). При skip_unchanged сначала читается список объектов под
+        remote_prefix: файл, совпадающий с объектом по размеру и ETag (MD5),
+        не загружается повторно.
+        
         Args:
             local_dir: Локальная директория
             remote_prefix: Префикс для объектов в R2
             recursive: Рекурсивная загрузка поддиректорий
+            skip_unchanged: Пропускать файлы, уже загруженные без изменений
         
         Returns:
-            (успешно загружено, ошибок)
+            (успешно загружено или без изменений, ошибок)
         """
         logger.info(f"=== Начало загрузки директории в R2 ===")
         logger.info(f"Локальная директория: {local_dir}")
@@ -198,9 +265,6 @@ class R2Storage:
             logger.error(f"❌ Директория не найдена: {local_dir}")
             return (0, 1)
         
-        success_count = 0
-        error_count = 0
-        
         # Получаем список файлов
         if recursive:
             files = list(local_path.rglob("*"))
@@ -211,21 +275,78 @@ class R2Storage:
         
         logger.info(f"Найдено файлов для загрузки: {len(files)}")
         
-        for idx, file_path in enumerate(files, 1):
-            # Формируем remote_key с сохранением структуры
+        # Объекты, уже лежащие в bucket: ключ -> (размер, ETag)
+        remote: Dict[str, tuple] = {}
+        if skip_unchanged and files:
+            listing_prefix = f"{remote_prefix}/" if remote_prefix else ""
+            for obj in self.list_objects_with_metadata(listing_prefix):
+                remote[obj['Key']] = (obj.get('Size'), obj.get('ETag'))
+            logger.info(f"Объектов в R2 под префиксом: {len(remote)}")
+        
+        def upload_one(file_path: Path) -> tuple:
+            """(статус, байт): 'uploaded', 'skipped' или 'error'"""
             relative_path = file_path.relative_to(local_path)
             remote_key = f"{remote_prefix}/{relative_path.as_posix()}" if remote_prefix else relative_path.as_posix()
-            
-            logger.info(f"[{idx}/{len(files)}] Загрузка: {relative_path.as_posix()}")
+            try:
+                size = file_path.stat().st_size
+                existing = remote.get(remote_key)
+                if existing and existing[0] == size and existing[1] == self._local_etag(file_path, size):
+                    logger.debug(f"Без изменений: {relative_path.as_posix()}")
+                    return 'skipped', size
+            except OSError as e:
+                logger.error(f"❌ Ошибка чтения файла {file_path}: {e}")
+                return 'error', 0
             
             if self.upload_file(str(file_path), remote_key):
-                success_count += 1
-            else:
-                error_count += 1
-        
+                return 'uploaded', size
+            return 'error', size
+        
+        started = time.perf_counter()
+        counts = {'uploaded': 0, 'skipped': 0, 'error': 0}
+        uploaded_bytes = 0
+        skipped_bytes = 0
+        
+        with ThreadPoolExecutor(max_workers=self.MAX_POOL_CONNECTIONS, thread_name_prefix="r2-upload") as pool:
+            for status, size in pool.map(upload_one, files):
+                counts[status] += 1
+                if status == 'uploaded':
+                    uploaded_bytes += size
+                elif status == 'skipped':
+                    skipped_bytes += size
+        
+        elapsed = max(time.perf_counter() - started, 1e-6)
+        logger.info(
+            f"R2: загружено {counts['uploaded']} файлов ({uploaded_bytes / (1024 * 1024):.2f} MB), "
+            f"без изменений {counts['skipped']} ({skipped_bytes / (1024 * 1024):.2f} MB) "
+            f"за {elapsed:.1f} с: {uploaded_bytes / elapsed / (1024 * 1024):.2f} MB/с, "
+            f"{counts['uploaded'] / elapsed:.1f} файлов/с"
+        )
+        
+        success_count = counts['uploaded'] + counts['skipped']
+        error_count = counts['error']
         logger.info(f"=== Загрузка завершена: ✅ {success_count} успешно, ❌ {error_count} ошибок ===")
         return (success_count, error_count)
     
+    def _local_etag(self, file_path: Path, size: int) -> str:
+        """
+        ETag, который R2 выдаст для файла после upload_file
+        
+        Обычная загрузка - MD5 содержимого; multipart (от MULTIPART_THRESHOLD) -
+        MD5 склейки MD5 частей по MULTIPART_CHUNKSIZE с суффиксом "-<число частей>".
+        """
+        if size < self.MULTIPART_THRESHOLD:
+            md5 = hashlib.md5()
+            with open(file_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    md5.update(chunk)
+            return md5.hexdigest()
+        
+        part_digests = []
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(self.MULTIPART_CHUNKSIZE), b''):
+                part_digests.append(hashlib.md5(chunk).digest())
+        return f"{hashlib.md5(b''.join(part_digests)).hexdigest()}-{len(part_digests)}"
+    
     def upload_ocr_results(
         self,
         output_dir: str,
@@ -297,21 +418,69 @@ class R2Storage:
         Returns:
             Список ключей объектов
         """
+        return [obj['Key'] for obj in self.list_objects_with_metadata(prefix)]
+    
+    def iter_objects(self, prefix: str = "", delimiter: Optional[str] = None) -> Iterator[dict]:
+        """
+        Объекты под префиксом, постранично (по 1000 ключей на запрос)
+        
+        Страницы запрашиваются по мере перебора (continuation token), поэтому
+        большой префикс не читается целиком, если перебор прерван.
+        
+        Args:
+            prefix: Префикс для поиска
+            delimiter: Разделитель "директорий" (например '/') - только объекты
+                этого уровня, вложенные префиксы см. list_prefixes
+        
+        Yields:
+            dict с ключами: Key, LastModified, Size, ETag (без кавычек)
+        
+        Raises:
+            ClientError: ошибка запроса к R2
+        """
+        for page in self._iter_pages(prefix, delimiter):
+            for obj in page.get('Contents', []):
+                yield {
+                    'Key': obj['Key'],
+                    'LastModified': obj.get('LastModified'),
+                    'Size': obj.get('Size', 0),
+                    'ETag': (obj.get('ETag') or '').strip('"')
+                }
+    
+    def list_prefixes(self, prefix: str = "", delimiter: str = "/") -> list[str]:
+        """
+        Вложенные "директории" префикса (CommonPrefixes)
+        
+        Args:
+            prefix: Префикс (обычно оканчивается на delimiter)
+            delimiter: Разделитель
+        
+        Returns:
+            Список префиксов следующего уровня (с завершающим delimiter)
+        """
         try:
-            response = self.s3_client.list_objects_v2(
-                Bucket=self.bucket_name,
-                Prefix=prefix
-            )
-            
-            if 'Contents' not in response:
-                return []
-            
-            return [obj['Key'] for obj in response['Contents']]
-            
+            return [
+                common['Prefix']
+                for page in self._iter_pages(prefix, delimiter)
+                for common in page.get('CommonPrefixes', [])
+            ]
         except ClientError as e:
-            logger.error(f"Ошибка получения списка объектов: {e}")
+            logger.error(f"❌ Ошибка получения списка из R2: {e}")
             return []
     
+    def _iter_pages(self, prefix: str, delimiter: Optional[str]) -> Iterator[dict]:
+        """Страницы list_objects_v2 с продолжением по NextContinuationToken"""
+        params = {'Bucket': self.bucket_name, 'Prefix': prefix}
+        if delimiter:
+            params['Delimiter'] = delimiter
+        
+        while True:
+            page = self.s3_client.list_objects_v2(**params)
+            yield page
+            if not page.get('IsTruncated'):
+                return
+            params['ContinuationToken'] = page['NextContinuationToken']
+    
     def delete_object(self, remote_key: str) -> bool:
         """
         Удалить объект из R2
@@ -327,6 +496,7 @@ class R2Storage:
                 Bucket=self.bucket_name,
                 Key=remote_key
             )
+            self._listing_index.invalidate(remote_key)
             logger.info(f"✅ Объект удален из R2: {remote_key}")
             return True
             
@@ -386,6 +556,7 @@ class R2Storage:
                 Body=content.encode('utf-8'),
                 ContentType='text/plain; charset=utf-8'
             )
+            self._listing_index.invalidate(remote_key)
             logger.info(f"✅ Текст загружен в R2: {remote_key}")
             return True
         except ClientError as e:
@@ -421,6 +592,42 @@ class R2Storage:
                 logger.error(f"❌ Ошибка загрузки текста из R2: {e}")
             return None
     
+    def download_text_conditional(
+        self,
+        remote_key: str,
+        etag: Optional[str] = None
+    ) -> tuple[str, Optional[str], Optional[str]]:
+        """
+        Скачать текст, если он изменился (If-None-Match)
+        
+        Args:
+            remote_key: Ключ объекта
+            etag: ETag имеющейся версии (None - скачать безусловно)
+        
+        Returns:
+            (статус, текст, ETag): статус 'ok', 'not_modified' (304),
+            'missing' (объекта нет), 'offline' (нет связи с R2) или 'error'
+        """
+        params = {'Bucket': self.bucket_name, 'Key': remote_key}
+        if etag:
+            params['IfNoneMatch'] = f'"{etag}"'
+        try:
+            response = self.s3_client.get_object(**params)
+            content = response['Body'].read().decode('utf-8')
+            logger.debug(f"Текст загружен из R2: {remote_key}")
+            return 'ok', content, (response.get('ETag') or '').strip('"') or None
+        except ClientError as e:
+            error_code = str(e.response.get('Error', {}).get('Code', 'Unknown'))
+            if error_code in ('304', 'NotModified'):
+                return 'not_modified', None, etag
+            if error_code in ('NoSuchKey', '404'):
+                return 'missing', None, None
+            logger.error(f"❌ Ошибка загрузки текста из R2: {e}")
+            return 'error', None, None
+        except BotoCoreError as e:
+            logger.warning(f"⚠️ R2 недоступен ({remote_key}): {e}")
+            return 'offline', None, None
+    
     def list_by_prefix(self, prefix: str) -> list[str]:
         """
         Получить список ключей с определенным префиксом
@@ -431,50 +638,36 @@ class R2Storage:
         Returns:
             Список ключей
         """
-        try:
-            response = self.s3_client.list_objects_v2(
-                Bucket=self.bucket_name,
-                Prefix=prefix
-            )
-            
-            if 'Contents' not in response:
-                return []
-            
-            return [obj['Key'] for obj in response['Contents']]
-        except ClientError as e:
-            logger.error(f"❌ Ошибка получения списка из R2: {e}")
-            return []
+        return [obj['Key'] for obj in self.list_objects_with_metadata(prefix)]
     
-    def list_objects_with_metadata(self, prefix: str) -> list[dict]:
+    def list_objects_with_metadata(self, prefix: str, use_index: bool = True) -> list[dict]:
         """
-        Получить список объектов с метаданными (LastModified, Size)
+        Получить список объектов с метаданными (LastModified, Size, ETag)
+        
+        Читаются все страницы листинга; результат запоминается в локальном
+        индексе, и повторный запрос того же (или вложенного) префикса в
+        пределах R2_LIST_CACHE_TTL не обращается к R2.
         
         Args:
             prefix: Префикс для поиска
+            use_index: Разрешить ответ из локального индекса
         
         Returns:
-            Список dict с ключами: Key, LastModified, Size
+            Список dict с ключами: Key, LastModified, Size, ETag (без кавычек)
         """
+        if use_index:
+            cached = self._listing_index.get(prefix)
+            if cached is not None:
+                return cached
+        
         try:
-            response = self.s3_client.list_objects_v2(
-                Bucket=self.bucket_name,
-                Prefix=prefix
-            )
-            
-            if 'Contents' not in response:
-                return []
-            
-            return [
-                {
-                    'Key': obj['Key'],
-                    'LastModified': obj.get('LastModified'),
-                    'Size': obj.get('Size', 0)
-                }
-                for obj in response['Contents']
-            ]
+            objects = list(self.iter_objects(prefix))
         except ClientError as e:
             logger.error(f"❌ Ошибка получения списка из R2: {e}")
             return []
+        
+        self._listing_index.put(prefix, objects)
+        return objects
 
 
 def upload_ocr_to_r2(output_dir: str, project_name: Optional[str] = None) -> bool:
@@ -0,0 +1,456 @@
+"""
+Многопроцессный рендеринг страниц и кропов блоков PDF
+PyMuPDF держит GIL, поэтому параллельный рендеринг возможен только в процессах.
+Каждый процесс открывает собственный fitz.Document, а пиксели возвращаются
+через shared memory (без сериализации изображений через pipe).
+"""
+
+import logging
+import math
+import multiprocessing
+import os
+import queue
+import sys
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+from PIL import Image
+from app.models import Block, Page
+from app.pdf_utils import (
+    open_pdf, render_block_region, norm_to_page_rect, get_crop_zoom, get_crop_dpi,
+    PDFDocument, PDF_RENDER_DPI
+)
+
+logger = logging.getLogger(__name__)
+
+# Область кропа (x1, y1, x2, y2) в пикселях страницы
+CropBox = Tuple[int, int, int, int]
+
+# Область рендеринга: (нормализованные координаты, DPI)
+Region = Tuple[Tuple[float, float, float, float], int]
+
+# Число процессов по умолчанию (переопределяется через RENDER_WORKERS)
+DEFAULT_RENDER_WORKERS = max(1, min(4, (os.cpu_count() or 1) - 1))
+
+# Изображения передаются как RGB (3 байта на пиксель)
+_CHANNELS = 3
+
+# Предел суммарного размера сегментов shared memory в работе (байт);
+# переопределяется через RENDER_MAX_INFLIGHT_MB
+DEFAULT_MAX_INFLIGHT_BYTES = 512 * 1024 * 1024
+
+# Глубина очереди iter_prefetched по умолчанию
+DEFAULT_PREFETCH = 4
+
+# Документ, открытый в процессе-рабочем (инициализируется в _init_worker)
+_worker_doc = None
+
+
+def get_render_workers() -> int:
+    """Число процессов рендеринга из окружения (RENDER_WORKERS)"""
+    try:
+        return max(1, int(os.getenv("RENDER_WORKERS", DEFAULT_RENDER_WORKERS)))
+    except ValueError:
+        return DEFAULT_RENDER_WORKERS
+
+
+def get_max_inflight_bytes() -> int:
+    """Предел байт в shared memory одновременно из окружения (RENDER_MAX_INFLIGHT_MB)"""
+    value = os.getenv("RENDER_MAX_INFLIGHT_MB")
+    if not value:
+        return DEFAULT_MAX_INFLIGHT_BYTES
+    try:
+        return max(1, int(value)) * 1024 * 1024
+    except ValueError:
+        return DEFAULT_MAX_INFLIGHT_BYTES
+
+
+def block_crop_boxes(block: Block) -> List[CropBox]:
+    """
+    Области кропа блока в пикселях (высокие блоки делятся на части по MAX_BLOCK_HEIGHT)
+
+    Returns:
+        [(x1, y1, x2, y2), ...] или [] для некорректных координат
+    """
+    from app.datalab_ocr import MAX_BLOCK_HEIGHT
+
+    x1, y1, x2, y2 = block.coords_px
+    if x1 >= x2 or y1 >= y2:
+        return []
+
+    boxes = []
+    y_start = y1
+    while y_start < y2:
+        y_end = min(y_start + MAX_BLOCK_HEIGHT, y2)
+        boxes.append((x1, y_start, x2, y_end))
+        y_start = y_end
+    return boxes
+
+
+def _attach_shared_memory(name: str) -> shared_memory.SharedMemory:
+    """
+    Подключиться к сегменту, созданному родительским процессом
+
+    Сегмент создаёт и удаляет (unlink) родитель. Рабочие процессы (spawn)
+    используют resource_tracker родителя, поэтому регистрацию здесь не снимаем:
+    иначе пропадёт запись родителя и сегменты утекут при его падении.
+    На 3.13+ рабочий процесс просто не регистрирует сегмент (track=False).
+    """
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    return shared_memory.SharedMemory(name=name)
+
+
+def _release_shared_memory(shm: shared_memory.SharedMemory):
+    """Закрыть и удалить сегмент (повторный вызов безопасен)"""
+    shm.close()
+    try:
+        shm.unlink()
+    except FileNotFoundError:
+        pass
+
+
+def _init_worker(pdf_path: str):
+    """Инициализация процесса: открываем свой экземпляр документа"""
+    global _worker_doc
+    _worker_doc = open_pdf(pdf_path)
+
+
+def _render_task(page_index: int, shm_name: str, regions: List[Region]) -> List[Tuple[int, int]]:
+    """
+    Отрендерить области страницы (clip) и записать их подряд в shared memory
+
+    Ошибка одной области (пустая или вне страницы) не прерывает задачу:
+    для неё возвращается размер (0, 0), как render_block_crop возвращает None.
+
+    Returns:
+        Размеры (width, height) отрендеренных областей
+    """
+    shm = _attach_shared_memory(shm_name)
+    sizes = []
+    try:
+        offset = 0
+        for coords_norm, dpi in regions:
+            try:
+                img = render_block_region(_worker_doc, page_index, coords_norm, dpi)
+            except Exception as e:
+                logger.error(f"Ошибка рендеринга кропа {coords_norm} страницы {page_index}: {e}")
+                sizes.append((0, 0))
+                continue
+            if img.mode != "RGB":
+                img = img.convert("RGB")
+            data = img.tobytes()
+            shm.buf[offset:offset + len(data)] = data
+            offset += len(data)
+            sizes.append(img.size)
+    finally:
+        shm.close()
+    return sizes
+
+
+class RenderPool:
+    """
+    Пул процессов рендеринга для одного PDF
+
+    Использование:
+        with RenderPool(pdf_path, workers=4) as pool:
+            for page_num, crops in pool.render_regions({0: [((0.1, 0.1, 0.5, 0.2), 300)]}):
+                ...
+    """
+
+    def __init__(self, pdf_path: str, workers: Optional[int] = None):
+        """
+        Args:
+            pdf_path: путь к PDF
+            workers: число процессов (None - из RENDER_WORKERS)
+        """
+        self.pdf_path = pdf_path
+        self.workers = workers if workers is not None else get_render_workers()
+
+        # Документ в родительском процессе нужен только для оценки размеров областей
+        self._doc = open_pdf(pdf_path)
+        # spawn: родитель (GUI) многопоточный, fork из него небезопасен
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(pdf_path,)
+        )
+        logger.info(f"RenderPool: {self.workers} процессов для {pdf_path}")
+
+    def render_pages(self, page_indices: Iterable[int], dpi: int = PDF_RENDER_DPI) -> Iterator[Tuple[int, Optional[Image.Image]]]:
+        """
+        Параллельный рендеринг страниц целиком
+
+        Yields:
+            (page_index, PIL.Image или None при ошибке) в порядке page_indices
+        """
+        requests = {page_index: [((0.0, 0.0, 1.0, 1.0), dpi)] for page_index in page_indices}
+        for page_index, images in self.render_regions(requests):
+            yield page_index, images[0]
+
+    def render_regions(self, requests: Dict[int, List[Region]]) -> Iterator[Tuple[int, List[Image.Image]]]:
+        """
+        Параллельный рендеринг областей страниц (clip) в рабочих процессах
+
+        Рендерятся и передаются родителю только пиксели областей, а не страницы целиком.
+
+        Args:
+            requests: {page_index: [(coords_norm, dpi), ...]}
+
+        Yields:
+            (page_index, [PIL.Image, ...]) в порядке requests, кропы в порядке областей
+            (None на месте области, которую не удалось отрендерить)
+        """
+        # Окно отправленных задач ограничено по числу задач и по байтам, чтобы
+        # не держать в shared memory весь документ (страница A0 - около 1 ГБ)
+        max_in_flight = self.workers * 2
+        max_bytes = get_max_inflight_bytes()
+        in_flight_bytes = 0
+        items = iter(requests.items())
+        next_item = None
+        pending = deque()
+        try:
+            while True:
+                while len(pending) < max_in_flight:
+                    if next_item is None:
+                        item = next(items, None)
+                        if item is None:
+                            break
+                        page_index, regions = item
+                        nbytes = sum(self._region_nbytes_bound(page_index, region) for region in regions)
+                        next_item = (page_index, regions, nbytes)
+                    page_index, regions, nbytes = next_item
+                    # Хотя бы одна задача в работе, даже если она больше предела
+                    if pending and in_flight_bytes + nbytes > max_bytes:
+                        break
+                    pending.append(self._submit(page_index, regions, nbytes) + (nbytes,))
+                    in_flight_bytes += nbytes
+                    next_item = None
+                if not pending:
+                    break
+
+                page_index, shm, future, nbytes = pending.popleft()
+                try:
+                    sizes = future.result()
+                    yield page_index, self._read_crops(shm, sizes)
+                finally:
+                    in_flight_bytes -= nbytes
+                    _release_shared_memory(shm)
+        finally:
+            # Прерванная итерация или ошибка: освобождаем оставшиеся сегменты
+            for _, shm, future, _ in pending:
+                future.cancel()
+                _release_shared_memory(shm)
+
+    def _region_nbytes_bound(self, page_index: int, region: Region) -> int:
+        """Оценка сверху размера области в байтах (точный размер знает только fitz)"""
+        coords_norm, dpi = region
+        page = self._doc[page_index]
+        rect = norm_to_page_rect(page, coords_norm)
+        zoom = get_crop_zoom(page, dpi)
+        width = math.ceil(rect.width * zoom) + 2
+        height = math.ceil(rect.height * zoom) + 2
+        return width * height * _CHANNELS
+
+    def _submit(self, page_index: int, regions: List[Region], nbytes: int):
+        shm = shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+        future = self._executor.submit(_render_task, page_index, shm.name, regions)
+        return page_index, shm, future
+
+    @staticmethod
+    def _read_crops(shm: shared_memory.SharedMemory, sizes: List[Tuple[int, int]]) -> List[Optional[Image.Image]]:
+        crops = []
+        offset = 0
+        for width, height in sizes:
+            if not width or not height:
+                crops.append(None)
+                continue
+            size = width * height * _CHANNELS
+            # Копия пикселей в память процесса (сегмент сразу освобождается)
+            with shm.buf[offset:offset + size] as view:
+                crops.append(Image.frombytes("RGB", (width, height), view))
+            offset += size
+        return crops
+
+    def close(self):
+        """Остановить процессы и закрыть документ"""
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        self._doc.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def iter_page_crops(
+    pdf_document: PDFDocument,
+    pages: List[Page],
+    page_images=None,
+    is_cancelled: Optional[Callable[[], bool]] = None
+) -> Iterator[Tuple[Page, Dict[str, List[Image.Image]]]]:
+    """
+    Кропы блоков по страницам (в порядке страниц)
+
+    - Страница уже в кеше и DPI по умолчанию: кроп вырезается из неё
+    - Иначе рендерится только область блока (clip) с DPI типа блока
+      (get_crop_dpi); при нескольких страницах - параллельно в RenderPool
+
+    Args:
+        pdf_document: открытый PDFDocument
+        pages: страницы с блоками
+        page_images: кеш страниц {page_num: PIL.Image} (опционально)
+        is_cancelled: функция проверки отмены
+
+    Yields:
+        (page, {block.id: [кроп части 0, кроп части 1, ...]})
+    """
+    page_regions = {}
+    for page in sorted(pages, key=lambda p: p.page_number):
+        dims = pdf_document.get_page_dimensions(page.page_number)
+        if not dims:
+            continue
+        width, height = dims
+        items = []
+        for block in page.blocks:
+            dpi = get_crop_dpi(block.block_type.value)
+            for box in block_crop_boxes(block):
+                coords_norm = Block.px_to_norm(box, width, height)
+                items.append((block.id, box, (coords_norm, dpi)))
+        if items:
+            page_regions[page.page_number] = (page, items)
+
+    def crop_from_cache(page_num, items):
+        if page_images is None or any(region[1] != PDF_RENDER_DPI for _, _, region in items):
+            return None
+        page_img = page_images.get(page_num)
+        if page_img is None:
+            return None
+        return [(block_id, page_img.crop(box)) for block_id, box, _ in items]
+
+    def group_by_block(pairs) -> Dict[str, List[Image.Image]]:
+        crops = {}
+        for block_id, crop in pairs:
+            crops.setdefault(block_id, []).append(crop)
+        return crops
+
+    # Кропы из кеша не требуют рендеринга - в пул только остальные страницы
+    to_render = [pn for pn, (_, items) in page_regions.items()
+                 if page_images is None or pn not in page_images
+                 or any(region[1] != PDF_RENDER_DPI for _, _, region in items)]
+    workers = min(get_render_workers(), len(to_render))
+
+    pool = None
+    rendered = None
+    if workers > 1 and pdf_document.pdf_path:
+        try:
+            pool = RenderPool(pdf_document.pdf_path, workers=workers)
+            rendered = pool.render_regions(
+                {pn: [region for _, _, region in page_regions[pn][1]] for pn in to_render}
+            )
+            logger.info(f"Кропы: параллельный рендеринг {len(to_render)} страниц ({workers} процессов)")
+        except Exception as e:
+            logger.warning(f"RenderPool недоступен, последовательный рендеринг: {e}")
+            pool = None
+
+    try:
+        for page_num, (page, items) in page_regions.items():
+            if is_cancelled and is_cancelled():
+                return
+
+            if rendered is not None and page_num in to_render:
+                _, images = next(rendered)
+                yield page, group_by_block((block_id, img) for (block_id, _, _), img in zip(items, images)
+                                           if img is not None)
+                continue
+
+            pairs = crop_from_cache(page_num, items)
+            if pairs is None:
+                pairs = []
+                for block_id, _, (coords_norm, dpi) in items:
+                    crop = pdf_document.render_block_crop(page_num, coords_norm, dpi)
+                    if crop is not None:
+                        pairs.append((block_id, crop))
+            yield page, group_by_block(pairs)
+    finally:
+        if rendered is not None:
+            rendered.close()
+        if pool is not None:
+            pool.close()
+
+
+_PREFETCH_END = object()
+
+
+def iter_prefetched(
+    items: Iterable[Any],
+    max_pending: int = DEFAULT_PREFETCH,
+    is_cancelled: Optional[Callable[[], bool]] = None
+) -> Iterator[Any]:
+    """
+    Перебрать items в фоновом потоке через ограниченную очередь
+    
+    Рендеринг кропов идёт, пока потребитель ждёт ответа API, но не уходит
+    вперёд больше чем на max_pending элементов - в памяти O(max_pending),
+    а не весь документ.
+    
+    Args:
+        items: исходная последовательность (обычно генератор кропов)
+        max_pending: размер очереди
+        is_cancelled: функция проверки отмены
+    
+    Yields:
+        Элементы items в исходном порядке (исключение источника пробрасывается)
+    """
+    pending = queue.Queue(maxsize=max(1, max_pending))
+    stop = threading.Event()
+    error: List[BaseException] = []
+    
+    def produce():
+        try:
+            for item in items:
+                while not stop.is_set():
+                    try:
+                        pending.put(item, timeout=0.2)
+                        break
+                    except queue.Full:
+                        continue
+                if stop.is_set() or (is_cancelled and is_cancelled()):
+                    return
+        except BaseException as e:
+            error.append(e)
+        finally:
+            # Прерванный генератор кропов закрывается здесь же (освобождает RenderPool)
+            close = getattr(items, "close", None)
+            if close is not None:
+                close()
+            while True:
+                try:
+                    pending.put(_PREFETCH_END, timeout=0.2)
+                    break
+                except queue.Full:
+                    if stop.is_set():
+                        break
+    
+    producer = threading.Thread(target=produce, name="crop-prefetch", daemon=True)
+    producer.start()
+    try:
+        while True:
+            item = pending.get()
+            if item is _PREFETCH_END:
+                break
+            yield item
+        if error:
+            raise error[0]
+    finally:
+        stop.set()
+        # Освобождаем место в очереди, чтобы производитель увидел stop
+        while producer.is_alive():
+            try:
+                pending.get(timeout=0.2)
+            except queue.Empty:
+                pass
@@ -131,8 +131,9 @@ def segment_with_api(pdf_path: str, pages: List[Page],
             page = pages[real_page_idx]
             
             # Размеры страницы: приоритет у реального изображения из page_images
-            if page_images and real_page_idx in page_images:
-                real_img = page_images[real_page_idx]
+            # (один get: кеш страниц ограничен и может вытеснить страницу между проверкой и чтением)
+            real_img = page_images.get(real_page_idx) if page_images is not None else None
+            if real_img is not None:
                 page_width = real_img.width
                 page_height = real_img.height
                 logger.debug(f"Используем размеры из page_images: {page_width}x{page_height}")
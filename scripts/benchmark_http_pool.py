@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+Микро-бенчмарк накладных расходов HTTP на один OCR запрос
+
+Поднимает локальный stub-сервер с ответом в формате chat/completions и
+сравнивает:
+  - новый httpx.Client на каждый запрос (прежний LocalVLMBackend)
+  - LocalVLMBackend с долгоживущим клиентом
+  - requests.post без Session (прежний OpenRouterBackend)
+  - OpenRouterBackend с requests.Session
+
+Запуск:
+    python scripts/benchmark_http_pool.py [--requests 200]
+"""
+
+import argparse
+import json
+import statistics
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+# Добавляем корневую папку проекта в путь
+project_root = Path(__file__).parent.parent
+sys.path.insert(0, str(project_root))
+
+import httpx
+import requests
+from PIL import Image
+
+from app.ocr import LocalVLMBackend, OpenRouterBackend, image_to_base64
+
+
+STUB_RESPONSE = json.dumps({
+    "choices": [{"message": {"content": "распознанный текст"}}]
+}).encode("utf-8")
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Мгновенный ответ chat/completions с поддержкой keep-alive"""
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        self.rfile.read(length)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(STUB_RESPONSE)))
+        self.end_headers()
+        self.wfile.write(STUB_RESPONSE)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub_server() -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def measure(name: str, func, count: int):
+    """Медиана и среднее времени одного запроса"""
+    func()  # прогрев
+    timings = []
+    for _ in range(count):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    print(f"{name:<42}{statistics.median(timings) * 1000:>10.2f}{statistics.mean(timings) * 1000:>10.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк пулинга HTTP соединений OCR движков")
+    parser.add_argument("--requests", type=int, default=200, help="запросов на вариант")
+    args = parser.parse_args()
+
+    server = start_stub_server()
+    url = f"http://127.0.0.1:{server.server_address[1]}/v1/chat/completions"
+
+    image = Image.new("RGB", (400, 200), "white")
+
+    def build_payload():
+        # Кодирование изображения входит во все варианты, как в recognize()
+        return {
+            "model": "stub",
+            "messages": [{"role": "user", "content": [
+                {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{image_to_base64(image)}"}}
+            ]}]
+        }
+
+    def fresh_httpx_client():
+        with httpx.Client(timeout=60.0) as client:
+            client.post(url, json=build_payload()).raise_for_status()
+
+    def plain_requests_post():
+        requests.post(url, json=build_payload(), timeout=60).raise_for_status()
+
+    print(f"stub: {url}, запросов: {args.requests}")
+    print(f"{'вариант':<42}{'медиана':>10}{'среднее':>10}  (мс)")
+
+    measure("httpx.Client на каждый запрос", fresh_httpx_client, args.requests)
+    with LocalVLMBackend(model_name="stub", api_url=url) as vlm:
+        measure("LocalVLMBackend (пул соединений)", lambda: vlm.recognize(image), args.requests)
+
+    measure("requests.post без Session", plain_requests_post, args.requests)
+    openrouter = OpenRouterBackend(api_key="stub", model_name="stub", api_url=url)
+    openrouter._provider_order = []  # без запроса списка провайдеров
+    with openrouter:
+        measure("OpenRouterBackend (requests.Session)", lambda: openrouter.recognize(image), args.requests)
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
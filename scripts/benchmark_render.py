@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк конвертации отрендеренной страницы PDF в PIL Image
+
+Сравнивает прежний путь (pix.tobytes("png") + Image.open) с прямым
+построением изображения по сэмплам pixmap (pixmap_to_image) для
+синтетических страниц форматов A4-A0.
+
+Запуск:
+    python scripts/benchmark_render.py [--repeats 3] [--zoom 4.1667]
+"""
+
+import argparse
+import io
+import statistics
+import sys
+import time
+from pathlib import Path
+
+# Добавляем корневую папку проекта в путь
+project_root = Path(__file__).parent.parent
+sys.path.insert(0, str(project_root))
+
+import fitz  # PyMuPDF
+from PIL import Image
+
+from app.pdf_utils import PDF_RENDER_ZOOM, get_effective_zoom, pixmap_to_image
+
+
+# Размеры страниц в PDF points (1/72 дюйма)
+PAGE_SIZES = {
+    "A4": fitz.paper_size("a4"),
+    "A3": fitz.paper_size("a3"),
+    "A2": fitz.paper_size("a2"),
+    "A1": fitz.paper_size("a1"),
+    "A0": fitz.paper_size("a0"),
+}
+
+
+def build_document() -> fitz.Document:
+    """Синтетический PDF: по странице каждого формата с сеткой линий и текстом"""
+    doc = fitz.open()
+    for name, (width, height) in PAGE_SIZES.items():
+        page = doc.new_page(width=width, height=height)
+        step = 36
+        for x in range(0, int(width), step):
+            page.draw_line((x, 0), (x, height), color=(0.7, 0.7, 0.7), width=0.3)
+        for y in range(0, int(height), step):
+            page.draw_line((0, y), (width, y), color=(0.7, 0.7, 0.7), width=0.3)
+        for y in range(40, int(height) - 20, 14):
+            page.insert_text((30, y), f"{name} строка {y} - lorem ipsum dolor sit amet", fontsize=10)
+    return doc
+
+
+def convert_png(pix: fitz.Pixmap) -> Image.Image:
+    """Прежний путь: PNG encode + decode"""
+    img = Image.open(io.BytesIO(pix.tobytes("png")))
+    img.load()
+    return img
+
+
+def convert_raw(pix: fitz.Pixmap) -> Image.Image:
+    """Новый путь: сырые сэмплы pixmap"""
+    return pixmap_to_image(pix)
+
+
+def measure(doc: fitz.Document, page_index: int, zoom: float, convert, repeats: int) -> float:
+    """Медианное время рендеринга + конвертации одной страницы (сек)"""
+    page = doc[page_index]
+    effective_zoom = get_effective_zoom(page, zoom)
+    mat = fitz.Matrix(effective_zoom, effective_zoom)
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        pix = page.get_pixmap(matrix=mat)
+        convert(pix)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк рендеринга страниц PDF")
+    parser.add_argument("--repeats", type=int, default=3, help="повторов на страницу")
+    parser.add_argument("--zoom", type=float, default=PDF_RENDER_ZOOM, help="коэффициент масштабирования")
+    args = parser.parse_args()
+
+    doc = build_document()
+    print(f"zoom={args.zoom:.4f}, повторов={args.repeats}")
+    print(f"{'формат':<8}{'пиксели':>16}{'PNG, мс':>12}{'raw, мс':>12}{'ускорение':>12}")
+
+    for page_index, name in enumerate(PAGE_SIZES):
+        page = doc[page_index]
+        effective_zoom = get_effective_zoom(page, args.zoom)
+        irect = (page.rect * fitz.Matrix(effective_zoom, effective_zoom)).irect
+
+        png_time = measure(doc, page_index, args.zoom, convert_png, args.repeats)
+        raw_time = measure(doc, page_index, args.zoom, convert_raw, args.repeats)
+
+        print(
+            f"{name:<8}{f'{irect.width}x{irect.height}':>16}"
+            f"{png_time * 1000:>12.1f}{raw_time * 1000:>12.1f}"
+            f"{png_time / raw_time:>11.1f}x"
+        )
+
+    doc.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+"""
+Локальный имитатор Datalab Marker API для проверки пакетного режима
+
+POST /api/v1/marker  - принимает файл, возвращает request_check_url
+GET  /check/<id>     - 'processing' до истечения задержки, затем 'complete'
+                       с markdown, содержащим имя и размер файла
+
+Запуск сервера:
+    python scripts/fake_datalab_server.py --port 8765 --delay 3
+
+Проверка клиента (сервер поднимается в том же процессе):
+    python scripts/fake_datalab_server.py --selftest --files 8 --delay 3
+
+Для приложения:
+    DATALAB_API_URL=http://127.0.0.1:8765/api/v1/marker
+"""
+
+import argparse
+import json
+import random
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+# Добавляем корневую папку проекта в путь
+project_root = Path(__file__).parent.parent
+sys.path.insert(0, str(project_root))
+
+
+class FakeDatalabState:
+    """Задачи сервера: id -> (время готовности, markdown или None при сбое)"""
+
+    def __init__(self, delay: float, jitter: float, fail_rate: float):
+        self.delay = delay
+        self.jitter = jitter
+        self.fail_rate = fail_rate
+        self.jobs = {}
+        self.uploads = 0
+        self.polls = 0
+        self.lock = threading.Lock()
+
+    def add_job(self, filename: str, size: int) -> str:
+        job_id = uuid.uuid4().hex
+        ready_at = time.monotonic() + self.delay + random.uniform(0, self.jitter)
+        markdown = None if random.random() < self.fail_rate else f"# {filename}\n\nfake markdown ({size} bytes)"
+        with self.lock:
+            self.jobs[job_id] = (ready_at, markdown)
+            self.uploads += 1
+        return job_id
+
+
+def make_handler(state: FakeDatalabState):
+    class FakeDatalabHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _send_json(self, status: int, payload: dict):
+            body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            if not self.headers.get("X-Api-Key"):
+                self._send_json(401, {"success": False, "error": "no api key"})
+                return
+            length = int(self.headers.get("Content-Length", 0))
+            body = self.rfile.read(length)
+
+            # Имя файла из multipart без полного разбора формы
+            filename = "upload"
+            marker = b'filename="'
+            start = body.find(marker)
+            if start >= 0:
+                end = body.find(b'"', start + len(marker))
+                filename = body[start + len(marker):end].decode("utf-8", errors="replace")
+
+            job_id = state.add_job(filename, length)
+            host, port = self.server.server_address[:2]
+            self._send_json(200, {
+                "success": True,
+                "request_id": job_id,
+                "request_check_url": f"http://{host}:{port}/check/{job_id}",
+            })
+
+        def do_GET(self):
+            job_id = self.path.rsplit("/", 1)[-1]
+            with state.lock:
+                state.polls += 1
+                job = state.jobs.get(job_id)
+            if job is None:
+                self._send_json(404, {"status": "failed", "error": "unknown request"})
+                return
+            ready_at, markdown = job
+            if time.monotonic() < ready_at:
+                self._send_json(200, {"status": "processing"})
+            elif markdown is None:
+                self._send_json(200, {"status": "failed", "error": "fake failure"})
+            else:
+                self._send_json(200, {"status": "complete", "success": True, "markdown": markdown})
+
+        def log_message(self, format, *args):
+            pass
+
+    return FakeDatalabHandler
+
+
+def start_server(state: FakeDatalabState, port: int = 0) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(state))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def selftest(server: ThreadingHTTPServer, state: FakeDatalabState, files: int):
+    """Сравнить последовательный recognize() и recognize_many() на одном наборе файлов"""
+    from PIL import Image
+    from app.datalab_ocr import DatalabOCRClient
+
+    api_url = f"http://127.0.0.1:{server.server_address[1]}/api/v1/marker"
+    client = DatalabOCRClient("fake-key", api_url=api_url)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = []
+        for i in range(files):
+            path = Path(tmp) / f"strip_{i}.png"
+            Image.new("RGB", (200, 100 + i), "white").save(path)
+            paths.append(str(path))
+
+        start = time.perf_counter()
+        sequential = [client.recognize(path) for path in paths]
+        sequential_time = time.perf_counter() - start
+
+        polls_before = state.polls
+        start = time.perf_counter()
+        results = client.recognize_many(paths, progress_callback=lambda done, total: print(f"  {done}/{total}"))
+        batch_time = time.perf_counter() - start
+
+    client.close()
+    ok = all(isinstance(r, str) for r in results) and results == sequential
+    print(f"последовательно: {sequential_time:.1f} с")
+    print(f"recognize_many:  {batch_time:.1f} с, опросов: {state.polls - polls_before}")
+    print(f"порядок и содержимое совпадают: {ok}")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Имитатор Datalab Marker API")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--delay", type=float, default=3.0, help="время обработки задачи (с)")
+    parser.add_argument("--jitter", type=float, default=1.0, help="случайная добавка к задержке (с)")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="доля задач со статусом failed")
+    parser.add_argument("--selftest", action="store_true", help="прогнать клиент против сервера и выйти")
+    parser.add_argument("--files", type=int, default=8, help="число изображений для --selftest")
+    args = parser.parse_args()
+
+    state = FakeDatalabState(args.delay, args.jitter, args.fail_rate)
+
+    if args.selftest:
+        server = start_server(state)
+        ok = selftest(server, state, args.files)
+        server.shutdown()
+        sys.exit(0 if ok else 1)
+
+    server = start_server(state, args.port)
+    print(f"Fake Datalab: http://127.0.0.1:{args.port}/api/v1/marker (Ctrl+C - остановка)")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()